@@ -0,0 +1,136 @@
+'''
+cbModbus addressindex
+-----------------
+
+A bitmap index of the addresses that exist in the Modbus data collections, per unit id and table.
+It lets the server adapter validate Modbus requests without querying the ClearBlade Platform.
+'''
+import logging
+import numbers
+import threading
+import cbData
+from constants import ModbusErrorCodes
+
+class AddressIndex(object):
+    ''' A per-unit, per-table bitmap of existing Modbus addresses
+
+    Each bitmap is a python integer in which bit N is set when address N exists.
+    '''
+
+    def __init__(self):
+        #(unit id, table) -> bitmap
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+
+    def load(self, cbsystem, cbauth):
+        ''' Rebuilds the index from the Modbus data collections, one table at a time
+
+        :param cbsystem: The ClearBlade system object representing the ClearBlade System the
+                         adapter will communicate with.
+        :param cbauth: The object representing the ClearBlade Platform authentication credentials.
+        '''
+        logging.debug("In AddressIndex.load")
+
+        for table, collection in cbData.MODBUS_DATA_COLLECTIONS.items():
+            self.load_table(table, cbData.read_unit_addresses(cbsystem, cbauth, collection))
+
+    def load_table(self, table, unit_addresses):
+        ''' Replaces the bitmaps of a table
+
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param unit_addresses: A dictionary of unit id -> iterable of existing addresses. Addresses
+                               that are not non-negative integers are skipped.
+        '''
+        bitmaps = {}
+        for slave, addresses in unit_addresses.items():
+            bitmap = 0
+            for address in addresses:
+                if not _is_address(address):
+                    logging.warning("Skipping invalid address %r of unit %s in %s", address, slave, \
+                        table)
+                    continue
+                bitmap |= 1 << address
+            bitmaps[(slave, table)] = bitmap
+
+        with self._lock:
+            for key in [key for key in self._bitmaps if key[1] == table and key not in bitmaps]:
+                del self._bitmaps[key]
+            self._bitmaps.update(bitmaps)
+
+        logging.debug("Indexed %d units for %s", len(bitmaps), table)
+
+    def add(self, slave, table, address, count=1):
+        ''' Marks a range of addresses as existing
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param address: The starting address
+        :param count: The number of addresses
+
+        :raises ValueError: If address is negative
+        '''
+        _check_address(address)
+        with self._lock:
+            self._bitmaps[(slave, table)] = self._bitmaps.get((slave, table), 0) | \
+                _range_mask(address, count)
+
+    def remove(self, slave, table, address, count=1):
+        ''' Marks a range of addresses as no longer existing
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param address: The starting address
+        :param count: The number of addresses
+
+        :raises ValueError: If address is negative
+        '''
+        _check_address(address)
+        with self._lock:
+            bitmap = self._bitmaps.get((slave, table), 0) & ~_range_mask(address, count)
+            if bitmap:
+                self._bitmaps[(slave, table)] = bitmap
+            else:
+                self._bitmaps.pop((slave, table), None)
+
+    def units(self):
+        ''' Returns the set of unit ids with at least one existing address '''
+        with self._lock:
+            return set([key[0] for key in self._bitmaps])
+
+    def check(self, slave, table, address, count=1):
+        ''' Checks that every address of a range exists
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param address: The starting address
+        :param count: The number of addresses
+
+        :returns: None if every address exists, ModbusErrorCodes.IllegalDataAddress otherwise
+        '''
+        missing = address < 0 or count < 1
+        if not missing:
+            mask = _range_mask(address, count)
+            missing = self._bitmaps.get((slave, table), 0) & mask != mask
+
+        if missing:
+            logging.debug("Addresses missing for unit %s, %s %d:%d", slave, table, address, count)
+            return ModbusErrorCodes.IllegalDataAddress
+
+        return None
+
+    def validate(self, slave, table, address, count=1):
+        ''' Returns True if every address of a range exists, False otherwise '''
+        return self.check(slave, table, address, count) is None
+
+def _is_address(address):
+    ''' Returns True if address is a valid Modbus address '''
+    return isinstance(address, numbers.Integral) and not isinstance(address, bool) and address >= 0
+
+def _check_address(address):
+    ''' Raises ValueError if address is negative '''
+    if address < 0:
+        raise ValueError("Invalid Modbus address " + str(address))
+
+def _range_mask(address, count):
+    ''' Returns a bitmap with the bits for address:address+count set '''
+    return ((1 << max(count, 0)) - 1) << address
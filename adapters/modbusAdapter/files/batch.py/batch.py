@@ -0,0 +1,51 @@
+'''
+cbModbus batch
+-----------------
+
+Collects the results of an array of Modbus commands received in a single MQTT message, so one
+aggregated response can be published once every command has completed.
+'''
+import logging
+import threading
+
+class ModbusBatch(object):
+    ''' The results of a batch of Modbus commands
+
+    :param commands: The array of Modbus commands in the batch
+    :param on_done: Invoked with the array of results once every command has completed. Each
+                    result holds the command as 'request' and either 'response' or 'error'.
+    '''
+
+    def __init__(self, commands, on_done):
+        self.commands = commands
+        self.on_done = on_done
+        self._results = [None] * len(commands)
+        self._remaining = len(commands)
+        self._lock = threading.Lock()
+
+        if self._remaining == 0:
+            on_done([])
+
+    def complete(self, ndx, response):
+        ''' Records the result of a command. May be called from any thread.
+
+        :param ndx: The index of the command within the batch
+        :param response: The response dictionary, containing either 'Data' or 'error'
+        '''
+        result = {"request": self.commands[ndx]}
+        if response is not None and response.get('error') is None:
+            result["response"] = response
+        else:
+            result["error"] = response.get('error') if response is not None else \
+                "No response received for Modbus command."
+
+        with self._lock:
+            if self._results[ndx] is not None:
+                logging.warning("Ignoring duplicate result for batch command %d", ndx)
+                return
+            self._results[ndx] = result
+            self._remaining -= 1
+            done = self._remaining == 0
+
+        if done:
+            self.on_done(self._results)
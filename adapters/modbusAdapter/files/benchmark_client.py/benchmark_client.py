@@ -0,0 +1,435 @@
+"""benchmark_client
+
+Measures the sustained throughput of the client adapter without a ClearBlade Platform or real
+PLCs. The adapter runs in process, connected to an in-process stand-in of the ClearBlade Messaging
+client, and sends its Modbus requests to a fleet of simulated pymodbus TCP slaves with injectable
+latency and faults. A traffic generator publishes commands on the request topic at a fixed rate
+and matches the responses and errors published by the adapter to them.
+
+The completed commands per second, the latency distribution of every device and the error rates
+are reported, so the number of devices and the polling rate a gateway can sustain can be sized.
+Arguments not recognized by the benchmark are passed to the adapter:
+
+    python benchmark_client.py --devices 20 --rate 200 --duration 30 --latency 0.02 -- \\
+        --asyncEngine --readCacheTTL 1
+"""
+import sys
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import mqtt
+from constants import ModbusFunctionCodes
+
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.server.sync import ModbusTcpServer
+
+ADAPTER_FILE = "modbus-client-adapter.py"
+
+class FakeMessage(object):
+    """An MQTT message delivered by FakeMessaging"""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class FakeMessaging(object):
+    """A stand-in for the ClearBlade Messaging client. Messages are delivered to the callbacks of
+    their topic on a single network loop thread, as they are by the MQTT client."""
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.published = 0
+        self._callbacks = {}
+        self._messages = Queue()
+        self._thread = None
+
+    def connect(self):
+        """Start the network loop and report a successful connection"""
+        self._thread = threading.Thread(target=self._loop, name="FakeMessaging")
+        self._thread.daemon = True
+        self._thread.start()
+        if self.on_connect is not None:
+            self.on_connect(self, None, None, 0)
+
+    def disconnect(self):
+        """Stop the network loop"""
+        self._messages.put(None)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+
+    def subscribe(self, topic):
+        """Subscriptions are implied by message_callback_add"""
+        pass
+
+    def unsubscribe(self, topic):
+        """Stop delivering messages published on topic"""
+        self._callbacks.pop(topic, None)
+
+    def message_callback_add(self, topic, callback):
+        """Deliver the messages published on topic to callback"""
+        self._callbacks[topic] = callback
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Queue a message for delivery to the callback of its topic"""
+        self.published += 1
+        self._messages.put(FakeMessage(topic, payload))
+
+    def _loop(self):
+        """Deliver queued messages until disconnected"""
+        while True:
+            message = self._messages.get()
+            if message is None:
+                return
+
+            callback = self._callbacks.get(message.topic)
+            if callback is not None:
+                try:
+                    callback(self, None, message)
+                except Exception as exc:
+                    logging.error("Error while handling message on %s: %s", message.topic, \
+                        str(exc))
+
+class SimulatedSlaveContext(ModbusSlaveContext):
+    """A pymodbus slave context that delays its answers and injects faults
+
+    :param latency: The mean number of seconds taken to answer a request
+    :param jitter: The maximum number of seconds added to or removed from latency
+    :param fault_rate: The fraction of requests answered with Slave Device Failure
+    :param drop_rate: The fraction of requests answered only after drop_delay seconds
+    :param drop_delay: The number of seconds a dropped request is held, longer than the adapter
+                       waits for a response
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, fault_rate=0.0, drop_rate=0.0, drop_delay=10.0, \
+        **kwargs):
+        ModbusSlaveContext.__init__(self, **kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_rate = fault_rate
+        self.drop_rate = drop_rate
+        self.drop_delay = drop_delay
+
+    def getValues(self, fx, address, count=1):
+        """Return the requested values once the simulated device has answered"""
+        self._simulate()
+        return ModbusSlaveContext.getValues(self, fx, address, count)
+
+    def setValues(self, fx, address, values):
+        """Set the requested values once the simulated device has answered"""
+        self._simulate()
+        ModbusSlaveContext.setValues(self, fx, address, values)
+
+    def _simulate(self):
+        """Wait for the simulated response time, raising to inject a fault"""
+        chance = random.random()
+        if chance < self.drop_rate:
+            time.sleep(self.drop_delay)
+        elif chance < self.drop_rate + self.fault_rate:
+            raise IOError("Injected fault")
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+class SimulatedFleet(object):
+    """A fleet of simulated Modbus TCP slaves listening on consecutive local ports
+
+    :param devices: The number of devices
+    :param base_port: The port of the first device
+    :param registers: The number of holding registers of each device
+    :param simulation: Keyword arguments of SimulatedSlaveContext
+    """
+
+    def __init__(self, devices, base_port, registers, **simulation):
+        self.servers = []
+        for ndx in range(0, devices):
+            block = ModbusSequentialDataBlock(0, [0] * (registers + 1))
+            slave = SimulatedSlaveContext(hr=block, zero_mode=True, **simulation)
+            server = ModbusTcpServer(ModbusServerContext(slaves=slave, single=True), \
+                address=("127.0.0.1", base_port + ndx))
+            server.daemon_threads = True
+            self.servers.append(server)
+
+    def addresses(self):
+        """Return the (host, port) tuples of the devices"""
+        return [server.server_address for server in self.servers]
+
+    def start(self):
+        """Serve requests on a thread per device"""
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, name="SimulatedDevice")
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop every device"""
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+class TrafficGenerator(object):
+    """Publishes Modbus commands at a fixed rate and records how each of them completed
+
+    :param messaging: The FakeMessaging the adapter is connected to
+    :param topic_root: The topic root of the adapter
+    :param devices: The (host, port) tuples of the simulated devices
+    :param registers: The number of holding registers of each device
+    :param count: The number of registers each command reads or writes
+    :param write_ratio: The fraction of commands that are writes
+    """
+
+    def __init__(self, messaging, topic_root, devices, registers, count, write_ratio):
+        self.messaging = messaging
+        self.topic_root = topic_root
+        self.devices = devices
+        self.registers = registers
+        self.count = count
+        self.write_ratio = write_ratio
+
+        #command id -> (device, time published)
+        self.pending = {}
+        #device -> array of latencies of the commands that completed
+        self.latencies = dict([("%s:%d" % device, []) for device in devices])
+        #device -> number of commands that failed
+        self.errors = dict([("%s:%d" % device, 0) for device in devices])
+        self.completed = threading.Condition()
+
+        messaging.message_callback_add(mqtt.create_topic(topic_root, \
+            mqtt.MODBUS_CLIENT_TOPICS['MODBUS_RESPONSE']), lambda client, userdata, message: \
+                self._complete(message, False))
+        messaging.message_callback_add(mqtt.create_topic(topic_root, \
+            mqtt.MODBUS_CLIENT_TOPICS['MODBUS_ERROR']), lambda client, userdata, message: \
+                self._complete(message, True))
+
+    def run(self, rate, duration):
+        """Publish rate commands per second for duration seconds
+
+        :returns: The number of commands published
+        """
+        topic = mqtt.create_topic(self.topic_root, mqtt.MODBUS_CLIENT_TOPICS['MODBUS_REQUEST'])
+        started = time.time()
+        total = int(rate * duration)
+
+        for command_id in range(0, total):
+            #Keep to the schedule rather than sleeping a fixed interval after each publish
+            delay = started + float(command_id) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            device = random.choice(self.devices)
+            command = self._create_command(command_id, device)
+            with self.completed:
+                self.pending[command_id] = ("%s:%d" % device, time.time())
+            self.messaging.publish(topic, json.dumps(command))
+
+        return total
+
+    def wait(self, timeout):
+        """Wait for the responses to every published command
+
+        :returns: The number of commands that never completed
+        """
+        deadline = time.time() + timeout
+        with self.completed:
+            while self.pending and time.time() < deadline:
+                self.completed.wait(deadline - time.time())
+            return len(self.pending)
+
+    def _create_command(self, command_id, device):
+        """Create a read or write of a random range of holding registers"""
+        address = random.randint(0, self.registers - self.count)
+        command = {
+            'BenchmarkID': command_id,
+            'ModbusHost': device[0],
+            'ModbusPort': device[1],
+            'UnitID': 1,
+            'StartAddress': address,
+            'AddressCount': self.count
+        }
+        if random.random() < self.write_ratio:
+            command['FunctionCode'] = ModbusFunctionCodes.WriteMultipleHoldingRegisters
+            command['Data'] = [random.randint(0, 65535) for _ in range(0, self.count)]
+        else:
+            command['FunctionCode'] = ModbusFunctionCodes.ReadHoldingRegisters
+
+        return command
+
+    def _complete(self, message, failed):
+        """Record the completion of the command a response or error was published for"""
+        command_id = json.loads(message.payload)['request'].get('BenchmarkID')
+        with self.completed:
+            pending = self.pending.pop(command_id, None)
+            if pending is None:
+                return
+
+            device, published = pending
+            self.latencies[device].append(time.time() - published)
+            if failed:
+                self.errors[device] += 1
+            if not self.pending:
+                self.completed.notify_all()
+
+def load_adapter(path=None):
+    """Load the client adapter module from its file
+
+    :param path: The path of the adapter, by default the adapter next to the benchmark
+    """
+    if path is None:
+        #The repository keeps every adapter file in a directory of the same name, next to the
+        #directory of the benchmark, while deployed adapter files share a single directory
+        here = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(here, ADAPTER_FILE)
+        if not os.path.exists(path):
+            path = os.path.join(os.path.dirname(here), ADAPTER_FILE)
+
+    if os.path.isdir(path):
+        path = os.path.join(path, os.path.basename(path))
+
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source("modbus_client_adapter", path)
+
+    spec = importlib.util.spec_from_file_location("modbus_client_adapter", path)
+    adapter = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(adapter)
+    return adapter
+
+def parse_args(argv):
+    """Parse the command line arguments
+    :param argv: An array containing the command line arguments
+
+    :returns: A dictionary containing the benchmark arguments and their values, and an array of
+              the arguments to pass to the adapter
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the Modbus client adapter')
+    parser.add_argument('--adapter', dest="adapter", default=None, \
+                        help='The path of the client adapter. The default is the \
+                        modbus-client-adapter.py next to the benchmark.')
+
+    parser.add_argument('--devices', dest="devices", default=10, type=int, \
+                        help='The number of simulated Modbus devices. The default is 10.')
+
+    parser.add_argument('--basePort', dest="basePort", default=15020, type=int, \
+                        help='The TCP port of the first simulated device. The others listen on \
+                        the following ports. The default is 15020.')
+
+    parser.add_argument('--registers', dest="registers", default=100, type=int, \
+                        help='The number of holding registers of each device. The default is 100.')
+
+    parser.add_argument('--count', dest="count", default=10, type=int, \
+                        help='The number of registers each command reads or writes. The default \
+                        is 10.')
+
+    parser.add_argument('--writeRatio', dest="writeRatio", default=0.1, type=float, \
+                        help='The fraction of commands that are writes. The default is 0.1.')
+
+    parser.add_argument('--rate', dest="rate", default=100, type=float, \
+                        help='The number of commands published per second. The default is 100.')
+
+    parser.add_argument('--duration', dest="duration", default=10, type=float, \
+                        help='The number of seconds commands are published for. The default is \
+                        10.')
+
+    parser.add_argument('--latency', dest="latency", default=0.01, type=float, \
+                        help='The mean number of seconds a device takes to answer. The default is \
+                        0.01.')
+
+    parser.add_argument('--jitter', dest="jitter", default=0.0, type=float, \
+                        help='The maximum number of seconds added to or removed from the latency \
+                        of each answer. The default is 0.')
+
+    parser.add_argument('--faultRate', dest="faultRate", default=0.0, type=float, \
+                        help='The fraction of requests devices answer with Slave Device Failure. \
+                        The default is 0.')
+
+    parser.add_argument('--dropRate', dest="dropRate", default=0.0, type=float, \
+                        help='The fraction of requests devices answer only after --dropDelay \
+                        seconds. The default is 0.')
+
+    parser.add_argument('--dropDelay', dest="dropDelay", default=10.0, type=float, \
+                        help='The number of seconds a dropped request is held by a device. The \
+                        default is 10.')
+
+    parser.add_argument('--drainTimeout', dest="drainTimeout", default=30.0, type=float, \
+                        help='The number of seconds to wait for outstanding commands once \
+                        publishing stops. The default is 30.')
+
+    args, adapter_args = parser.parse_known_args(args=argv[1:])
+    return vars(args), [arg for arg in adapter_args if arg != "--"]
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted values fall"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(args, adapter_args):
+    """Run the benchmark and print its results"""
+    adapter = load_adapter(args['adapter'])
+    adapter.CB_CONFIG = adapter.parse_args(["benchmark", "--systemKey", "benchmark", \
+        "--systemSecret", "benchmark", "--deviceID", "benchmark", "--activeKey", "benchmark", \
+        "--logLevel", "WARNING"] + adapter_args)
+    logging.basicConfig(level=adapter.CB_CONFIG['logLevel'])
+    #Every injected fault would otherwise be logged by the simulated devices
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+
+    fleet = SimulatedFleet(args['devices'], args['basePort'], args['registers'], \
+        latency=args['latency'], jitter=args['jitter'], fault_rate=args['faultRate'], \
+        drop_rate=args['dropRate'], drop_delay=args['dropDelay'])
+    fleet.start()
+
+    adapter.start_request_execution()
+    messaging = FakeMessaging()
+    messaging.on_connect = adapter.on_connect
+    messaging.connect()
+
+    generator = TrafficGenerator(messaging, adapter.CB_CONFIG['adapterTopicRoot'], \
+        fleet.addresses(), args['registers'], args['count'], args['writeRatio'])
+
+    started = time.time()
+    published = generator.run(args['rate'], args['duration'])
+    unanswered = generator.wait(args['drainTimeout'])
+    elapsed = time.time() - started
+
+    adapter.shutdown(messaging, adapter.CB_CONFIG['shutdownTimeout'])
+    fleet.stop()
+
+    completed = published - unanswered
+    errors = sum(generator.errors.values())
+    latencies = sorted([latency for device in generator.latencies.values() \
+        for latency in device])
+
+    print("%-22s %8s %8s %10s %10s %10s" % ("device", "commands", "errors", "p50 (ms)", \
+        "p99 (ms)", "max (ms)"))
+    for device in sorted(generator.latencies.keys()):
+        device_latencies = sorted(generator.latencies[device])
+        print("%-22s %8d %8d %10.2f %10.2f %10.2f" % (device, len(device_latencies), \
+            generator.errors[device], percentile(device_latencies, 0.50) * 1000.0, \
+            percentile(device_latencies, 0.99) * 1000.0, \
+            percentile(device_latencies, 1.0) * 1000.0))
+
+    print("")
+    print("commands published    %d (%.1f/s requested)" % (published, args['rate']))
+    print("commands completed    %d (%.1f/s sustained)" % (completed, completed / elapsed))
+    print("commands unanswered   %d" % unanswered)
+    print("error rate            %.2f%%" % (100.0 * errors / max(completed, 1)))
+    print("p50 latency (ms)      %.2f" % (percentile(latencies, 0.50) * 1000.0))
+    print("p99 latency (ms)      %.2f" % (percentile(latencies, 0.99) * 1000.0))
+
+if __name__ == '__main__':
+    ARGS, ADAPTER_ARGS = parse_args(sys.argv)
+    run(ARGS, ADAPTER_ARGS)
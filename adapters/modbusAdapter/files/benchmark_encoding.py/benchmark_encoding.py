@@ -0,0 +1,73 @@
+"""benchmark_encoding
+
+Compares the cost of the message encodings supported by the client adapter. A register read
+response and a write request of the same size are encoded and decoded repeatedly with every
+available encoding, and the time per message and encoded size are reported.
+
+    python benchmark_encoding.py --registers 125 --iterations 10000
+"""
+import sys
+import argparse
+import random
+import timeit
+
+from constants import ModbusFunctionCodes
+from encoding import available_encodings, decode_request, encode_message, encode_request
+
+def parse_args(argv):
+    """Parse the command line arguments
+    :param argv: An array containing the command line arguments
+
+    :returns: A dictionary containing the command line arguments and their values
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark Modbus message encodings')
+    parser.add_argument('--registers', dest="registers", default=125, type=int, \
+                        help='The number of registers in each message. The default is 125.')
+
+    parser.add_argument('--iterations', dest="iterations", default=10000, type=int, \
+                        help='The number of times each message is encoded and decoded. The \
+                        default is 10000.')
+
+    return vars(parser.parse_args(args=argv[1:]))
+
+def create_messages(registers):
+    """Create a read response and a write request carrying the given number of registers"""
+    data = [random.randint(0, 65535) for _ in range(0, registers)]
+    read = {
+        'ModbusHost': "192.168.1.10",
+        'ModbusPort': 502,
+        'FunctionCode': ModbusFunctionCodes.ReadHoldingRegisters,
+        'UnitID': 1,
+        'StartAddress': 0,
+        'AddressCount': registers
+    }
+    write = dict(read)
+    write['FunctionCode'] = ModbusFunctionCodes.WriteMultipleHoldingRegisters
+    write['Data'] = data
+
+    return {'request': read, 'response': {'Data': data}}, write
+
+def time_per_call(func, iterations):
+    """Return the mean number of microseconds a call to func takes"""
+    return timeit.timeit(func, number=iterations) * 1000000.0 / iterations
+
+def run(registers, iterations):
+    """Encode and decode the benchmark messages with every available encoding"""
+    response, request = create_messages(registers)
+
+    print("%-10s %12s %12s %12s %12s" % ("encoding", "encode (us)", "decode (us)", \
+        "response (B)", "request (B)"))
+    for encoding in available_encodings():
+        encoded_response = encode_message(response, encoding)
+        encoded_request = encode_request(request, encoding)
+
+        encode_time = time_per_call(lambda: encode_message(response, encoding), iterations)
+        decode_time = time_per_call(lambda: decode_request(encoded_request, encoding), iterations)
+
+        print("%-10s %12.2f %12.2f %12d %12d" % (encoding, encode_time, decode_time, \
+            len(encoded_response), len(encoded_request)))
+
+if __name__ == '__main__':
+    ARGS = parse_args(sys.argv)
+    run(ARGS['registers'], ARGS['iterations'])
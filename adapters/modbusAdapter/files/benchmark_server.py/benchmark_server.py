@@ -0,0 +1,256 @@
+"""benchmark_server
+
+Measures the throughput of the server adapter without a ClearBlade Platform. The Modbus data
+collections are replaced by in-process fakes that evaluate ClearBlade queries against rows held in
+memory, after waiting a configurable platform round trip time. A number of concurrent masters then
+execute a mix of pymodbus requests against a ClearBladeModbusServerContext, exactly as the Modbus
+server does for every request it receives.
+
+The requests per second, the request latency percentiles and the number of platform calls made per
+request are reported, so the effect of the register image, the address index and write-behind can
+be quantified.
+
+    python benchmark_server.py --masters 16 --requests 500 --latency 0.02 --cacheTTL 5
+"""
+import sys
+import argparse
+import operator
+import random
+import threading
+import time
+
+from cbData import MODBUS_DATA_COLLECTIONS
+from constants import ModbusFunctionCodes
+from context import ClearBladeModbusServerContext
+from writebehind import WriteBehindQueue
+
+from pymodbus.bit_read_message import ReadCoilsRequest, ReadDiscreteInputsRequest
+from pymodbus.bit_write_message import WriteMultipleCoilsRequest, WriteSingleCoilRequest
+from pymodbus.register_read_message import ReadHoldingRegistersRequest, \
+    ReadInputRegistersRequest
+from pymodbus.register_write_message import WriteMultipleRegistersRequest, \
+    WriteSingleRegisterRequest
+
+#The comparison operators of ClearBlade query filters
+QUERY_OPERATORS = {
+    'EQ': operator.eq,
+    'NEQ': operator.ne,
+    'GT': operator.gt,
+    'GTE': operator.ge,
+    'LT': operator.lt,
+    'LTE': operator.le
+}
+
+READ_REQUESTS = {
+    ModbusFunctionCodes.ReadCoil: lambda address, count: ReadCoilsRequest(address, count),
+    ModbusFunctionCodes.ReadDiscreteInput: lambda address, count: \
+        ReadDiscreteInputsRequest(address, count),
+    ModbusFunctionCodes.ReadHoldingRegisters: lambda address, count: \
+        ReadHoldingRegistersRequest(address, count),
+    ModbusFunctionCodes.ReadInputRegisters: lambda address, count: \
+        ReadInputRegistersRequest(address, count)
+}
+
+WRITE_REQUESTS = {
+    ModbusFunctionCodes.WriteSingleCoil: lambda address, count: \
+        WriteSingleCoilRequest(address, random.randint(0, 1) == 1),
+    ModbusFunctionCodes.WriteSingleHoldingRegister: lambda address, count: \
+        WriteSingleRegisterRequest(address, random.randint(0, 65535)),
+    ModbusFunctionCodes.WriteMultipleCoils: lambda address, count: \
+        WriteMultipleCoilsRequest(address, [random.randint(0, 1) == 1 for _ in range(0, count)]),
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: lambda address, count: \
+        WriteMultipleRegistersRequest(address, [random.randint(0, 65535) \
+            for _ in range(0, count)])
+}
+
+class FakeCollection(object):
+    """A ClearBlade Collection stand-in serving the rows of a FakePlatform collection
+
+    :param platform: The FakePlatform holding the rows
+    :param name: The name of the collection
+    """
+
+    def __init__(self, platform, name):
+        self.platform = platform
+        self.name = name
+
+    def getItems(self, query=None, pagesize=100, pagenum=1):
+        """Return copies of a page of the rows matching query, paged like the ClearBlade SDK"""
+        self.platform.round_trip()
+        with self.platform.lock:
+            rows = [row for row in self.platform.rows.get(self.name, []) if matches(query, row)]
+            return [dict(row) for row in rows[(pagenum - 1) * pagesize:pagenum * pagesize]]
+
+    def updateItems(self, query, changes):
+        """Apply changes to the rows matching query"""
+        self.platform.round_trip()
+        with self.platform.lock:
+            for row in self.platform.rows.get(self.name, []):
+                if matches(query, row):
+                    row.update(changes)
+
+class FakePlatform(object):
+    """A ClearBlade System stand-in holding the rows of every collection in memory
+
+    :param latency: The number of seconds every collection call takes
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.rows = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def Collection(self, cbauth, collectionName=None):
+        """Return the named collection"""
+        return FakeCollection(self, collectionName)
+
+    def populate(self, units, addresses):
+        """Create a row for every address of every unit in each Modbus data collection"""
+        for collection in MODBUS_DATA_COLLECTIONS.values():
+            self.rows[collection] = [{"item_id": "%s-%d-%d" % (collection, unit, address), \
+                "unit_id": unit, "data_address": address, "data_value": 0} \
+                for unit in range(1, units + 1) for address in range(0, addresses + 1)]
+
+    def round_trip(self):
+        """Count a collection call and wait for the simulated platform latency"""
+        with self.lock:
+            self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+def matches(query, row):
+    """Return True if row satisfies query. Query filters are groups of conditions that are
+    combined with AND, and the groups are combined with OR."""
+    groups = getattr(query, 'filters', None)
+    if not groups:
+        return True
+
+    for group in groups:
+        if all([QUERY_OPERATORS[op](row.get(column), value) for condition in group \
+            for op, terms in condition.items() for term in terms \
+            for column, value in term.items()]):
+            return True
+
+    return False
+
+def parse_args(argv):
+    """Parse the command line arguments
+    :param argv: An array containing the command line arguments
+
+    :returns: A dictionary containing the command line arguments and their values
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the Modbus server datastore')
+    parser.add_argument('--masters', dest="masters", default=8, type=int, \
+                        help='The number of Modbus masters sending requests at the same time. The \
+                        default is 8.')
+
+    parser.add_argument('--requests', dest="requests", default=200, type=int, \
+                        help='The number of requests each master sends. The default is 200.')
+
+    parser.add_argument('--units', dest="units", default=4, type=int, \
+                        help='The number of Modbus unit ids in the data collections. The default \
+                        is 4.')
+
+    parser.add_argument('--addresses', dest="addresses", default=100, type=int, \
+                        help='The number of addresses of each unit in every data collection. The \
+                        default is 100.')
+
+    parser.add_argument('--maxCount', dest="maxCount", default=10, type=int, \
+                        help='The maximum number of addresses a request reads or writes. The \
+                        default is 10.')
+
+    parser.add_argument('--writeRatio', dest="writeRatio", default=0.2, type=float, \
+                        help='The fraction of requests that are writes. The default is 0.2.')
+
+    parser.add_argument('--latency', dest="latency", default=0.01, type=float, \
+                        help='The number of seconds every data collection call takes. The \
+                        default is 0.01.')
+
+    parser.add_argument('--cacheTTL', dest="cacheTTL", default=0, type=float, \
+                        help='The register image TTL of the server context. The default is 0, \
+                        which disables the register image.')
+
+    parser.add_argument('--noIndex', dest="noIndex", default=False, action='store_true', \
+                        help='Flag presence indicates requests should be validated against the \
+                        data collections rather than the address index.')
+
+    parser.add_argument('--writeBehind', dest="writeBehind", default=False, action='store_true', \
+                        help='Flag presence indicates writes should be saved in the background.')
+
+    return vars(parser.parse_args(args=argv[1:]))
+
+def create_request(units, addresses, max_count, write_ratio):
+    """Create a random pymodbus request"""
+    requests = WRITE_REQUESTS if random.random() < write_ratio else READ_REQUESTS
+    count = random.randint(1, max_count)
+    request = requests[random.choice(list(requests.keys()))](random.randint(0, addresses - \
+        count), count)
+    request.unit_id = random.randint(1, units)
+
+    return request
+
+def run_master(context, args, latencies, errors):
+    """Execute requests against the server context, recording their latencies and failures"""
+    for _ in range(0, args['requests']):
+        request = create_request(args['units'], args['addresses'], args['maxCount'], \
+            args['writeRatio'])
+
+        started = time.time()
+        try:
+            response = request.execute(context[request.unit_id])
+            if hasattr(response, 'exception_code'):
+                errors.append(response.exception_code)
+        except Exception as exc:
+            errors.append(exc.__class__.__name__)
+        latencies.append(time.time() - started)
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of the sorted values fall"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(args):
+    """Run the benchmark and print its results"""
+    platform = FakePlatform(args['latency'])
+    platform.populate(args['units'], args['addresses'])
+
+    writer = None
+    if args['writeBehind']:
+        writer = WriteBehindQueue(platform, None)
+
+    context = ClearBladeModbusServerContext(cbsystem=platform, cbauth=None, \
+        cache_ttl=args['cacheTTL'], writer=writer, max_units=args['units'], \
+        load_units=not args['noIndex'])
+    setup_calls = platform.calls
+
+    latencies = []
+    errors = []
+    masters = [threading.Thread(target=run_master, args=(context, args, latencies, errors)) \
+        for _ in range(0, args['masters'])]
+
+    started = time.time()
+    for master in masters:
+        master.start()
+    for master in masters:
+        master.join()
+    elapsed = time.time() - started
+
+    if writer is not None:
+        writer.stop()
+
+    latencies.sort()
+    total = len(latencies)
+    calls = platform.calls - setup_calls
+
+    print("requests          %d" % total)
+    print("requests/s        %.1f" % (total / elapsed))
+    print("p50 latency (ms)  %.2f" % (percentile(latencies, 0.50) * 1000.0))
+    print("p99 latency (ms)  %.2f" % (percentile(latencies, 0.99) * 1000.0))
+    print("errors            %d" % len(errors))
+    print("platform calls    %d (%.2f per request)" % (calls, float(calls) / max(total, 1)))
+
+if __name__ == '__main__':
+    run(parse_args(sys.argv))
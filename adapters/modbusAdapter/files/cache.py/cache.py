@@ -0,0 +1,143 @@
+'''
+cbModbus cache
+-----------------
+
+Caches the responses of Modbus reads for a short time and shares a single in-flight request
+between identical concurrent reads. Writes invalidate the cached reads of the addresses they
+overlap.
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from constants import ModbusFunctionCodes
+
+#The read function code whose values each write function code changes
+WRITE_FUNCTION_TABLES = {
+    ModbusFunctionCodes.WriteSingleCoil: ModbusFunctionCodes.ReadCoil,
+    ModbusFunctionCodes.WriteMultipleCoils: ModbusFunctionCodes.ReadCoil,
+    ModbusFunctionCodes.WriteSingleHoldingRegister: ModbusFunctionCodes.ReadHoldingRegisters,
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: ModbusFunctionCodes.ReadHoldingRegisters,
+    ModbusFunctionCodes.MaskWriteRegister: ModbusFunctionCodes.ReadHoldingRegisters,
+    ModbusFunctionCodes.ReadWriteMultipleRegisters: ModbusFunctionCodes.ReadHoldingRegisters
+}
+
+CACHEABLE_FUNCTION_CODES = (ModbusFunctionCodes.ReadCoil, ModbusFunctionCodes.ReadDiscreteInput, \
+    ModbusFunctionCodes.ReadHoldingRegisters, ModbusFunctionCodes.ReadInputRegisters)
+
+class _InFlight(object):
+    ''' A read sent to a device whose response is awaited by one or more requests '''
+
+    def __init__(self):
+        self.waiters = []
+        #Set when a write overlapping the read is made before the read completes
+        self.stale = False
+
+class ReadCache(object):
+    ''' A TTL and LRU bounded cache of Modbus read responses
+
+    :param ttl: The number of seconds a response is served from the cache
+    :param max_entries: The maximum number of responses cached
+    '''
+
+    def __init__(self, ttl, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        #(host, port, unit, function code, address, count) -> (expiry time, response)
+        self._entries = OrderedDict()
+        #(host, port, unit, function code, address, count) -> _InFlight
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def accepts(self, payload):
+        ''' Returns True if the request is a read whose response can be cached '''
+        return payload['FunctionCode'] in CACHEABLE_FUNCTION_CODES
+
+    def read(self, payload, modbus_port, on_result, submit):
+        ''' Answers a read from the cache, from an identical read in flight, or by submitting it
+
+        :param payload: The validated Modbus read request
+        :param modbus_port: The port of the Modbus host
+        :param on_result: Invoked with the response dictionary of the request
+        :param submit: A callable accepting an on_result callback that sends the read to the device
+        '''
+        key = _cache_key(payload, modbus_port)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries[key] = self._entries.pop(key)
+                    response = entry[1]
+                else:
+                    del self._entries[key]
+                    entry = None
+
+            if entry is None:
+                in_flight = self._in_flight.get(key)
+                if in_flight is not None:
+                    logging.debug("Sharing in-flight read %s", key)
+                    in_flight.waiters.append(on_result)
+                    return
+
+                in_flight = _InFlight()
+                in_flight.waiters.append(on_result)
+                self._in_flight[key] = in_flight
+
+        if entry is not None:
+            logging.debug("Returning cached read %s", key)
+            on_result(response)
+        else:
+            submit(lambda response: self._complete(key, in_flight, response))
+
+    def invalidate(self, payload, modbus_port):
+        ''' Discards the cached reads of the addresses changed by a write
+
+        :param payload: The Modbus write request
+        :param modbus_port: The port of the Modbus host
+        '''
+        table = WRITE_FUNCTION_TABLES.get(payload['FunctionCode'])
+        if table is None:
+            return
+
+        #The registers written by a read/write request start at its WriteAddress
+        start = payload.get('WriteAddress', payload['StartAddress']) \
+            if payload['FunctionCode'] == ModbusFunctionCodes.ReadWriteMultipleRegisters \
+            else payload['StartAddress']
+        end = start + max(len(payload.get('Data') or []), 1)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if _overlaps(key, payload['ModbusHost'], modbus_port, payload['UnitID'], table, \
+                    start, end):
+                    del self._entries[key]
+
+            for key, in_flight in self._in_flight.items():
+                if _overlaps(key, payload['ModbusHost'], modbus_port, payload['UnitID'], table, \
+                    start, end):
+                    in_flight.stale = True
+
+    def _complete(self, key, in_flight, response):
+        ''' Caches a successful response and passes it to every request waiting for it '''
+        with self._lock:
+            if self._in_flight.get(key) is in_flight:
+                del self._in_flight[key]
+
+            #Errors are never cached, nor are values that may predate a write
+            if response is not None and response.get('error') is None and not in_flight.stale:
+                self._entries.pop(key, None)
+                self._entries[key] = (time.time() + self.ttl, response)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        for on_result in in_flight.waiters:
+            on_result(response)
+
+def _cache_key(payload, modbus_port):
+    ''' Returns the cache key of a read request '''
+    return (payload['ModbusHost'], modbus_port, payload['UnitID'], payload['FunctionCode'], \
+        payload['StartAddress'], payload.get('AddressCount') or 1)
+
+def _overlaps(key, host, port, unit, table, start, end):
+    ''' Returns True if the cached read key covers any address in [start, end) of a table '''
+    return key[0:4] == (host, port, unit, table) and key[4] < end and start < key[4] + key[5]
@@ -6,7 +6,19 @@ A collection of utility functions for retrieving data from and writing data to t
 collections defined within the ClearBlade Platform.
 '''
 import logging
+import threading
+import time
+import requests
+from clearblade import cbErrors, restcall
 from clearblade.ClearBladeCore import Query
+from constants import ModbusErrorCodes
+from metrics import METRICS
+from pymodbus.exceptions import ModbusException
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 MODBUS_DATA_COLLECTIONS = {
     'COILS_COLLECTION': "Discrete_Output_Coils",
@@ -15,6 +27,93 @@ MODBUS_DATA_COLLECTIONS = {
     'OUTPUT_REGISTERS_COLLECTION': "Analog_Output_Holding_Registers"
 }
 
+MODBUS_QUERY_SETTINGS = {
+    # The number of rows requested per page when querying a collection. Pages are requested until
+    # one holds fewer rows, so this must not exceed the page size limit of the platform.
+    'PAGE_SIZE': 100
+}
+
+MODBUS_WRITE_SETTINGS = {
+    # The maximum number of updateItems calls a single multi-address write may have in flight
+    'MAX_CONCURRENT_UPDATES': 8
+}
+
+#Round trip time of every call made to the ClearBlade Platform
+PLATFORM_CALL_SECONDS = METRICS.histogram("modbus_platform_call_seconds", \
+    "Round trip time of ClearBlade Platform collection calls", ('operation', 'collection'))
+PLATFORM_CALL_ERRORS = METRICS.counter("modbus_platform_call_errors_total", \
+    "ClearBlade Platform collection calls that raised an exception", ('operation', 'collection'))
+PLATFORM_ROWS_FETCHED = METRICS.counter("modbus_platform_rows_fetched_total", \
+    "Rows returned by ClearBlade Platform collection queries", ('operation', 'collection'))
+
+class PlatformError(Exception):
+    ''' Raised when the ClearBlade SDK reports a failed platform call, once
+    configure_platform_calls has replaced its default of exiting the process '''
+
+class PlatformTimeout(PlatformError):
+    ''' Raised when the ClearBlade Platform does not answer a call within the request timeout '''
+
+class _RaisingErrorHandler(cbErrors.ErrorHandler):
+    ''' A ClearBlade SDK error handler raising PlatformError '''
+
+    def handle(self, code):
+        raise PlatformError("ClearBlade Platform call failed, code %s" % code)
+
+class _TimedRequests(object):
+    ''' Stands in for the requests module used by the ClearBlade SDK, passing a timeout to every
+    request and raising PlatformTimeout when it expires
+
+    :param timeout: The number of seconds to wait for the platform to answer
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def get(self, *args, **kwargs):
+        return self._request(requests.get, *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self._request(requests.post, *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self._request(requests.put, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._request(requests.delete, *args, **kwargs)
+
+    def _request(self, method, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return method(*args, **kwargs)
+        except requests.exceptions.Timeout as exc:
+            #Raised before the SDK sees it, as it treats connect timeouts as connection errors
+            raise PlatformTimeout(str(exc))
+
+def configure_platform_calls(timeout):
+    """Make failed ClearBlade Platform calls raise PlatformError instead of exiting the process, and
+    give up on calls that are not answered within timeout seconds
+
+    :param timeout: The number of seconds to wait for the platform to answer a call, 0 to wait
+                    indefinitely
+    """
+    cbErrors.ERROR_HANDLER = _RaisingErrorHandler()
+    restcall.requests = _TimedRequests(timeout) if timeout > 0 else requests
+
+class CbDataWriteException(ModbusException):
+    ''' Raised when some or all of the values of a write could not be saved to a collection
+
+    :param error_code: The ModbusErrorCodes value that should be returned to the Modbus master
+    :param addresses: The addresses whose values were not saved
+    '''
+
+    def __init__(self, string, error_code, addresses):
+        ModbusException.__init__(self, "[Write] %s" % string)
+        self.error_code = error_code
+        self.addresses = addresses
+
 
 def validate_coil_address(cbsystem, cbauth, slave, address, count):
     """Query the Discrete_Output_Coils collection to see if all of the addresses exist
@@ -81,7 +180,7 @@ def validate_input_reg_address(cbsystem, cbauth, slave, address, count):
     return validate_address(cbsystem, cbauth, slave, address, count, \
         MODBUS_DATA_COLLECTIONS['INPUT_REGISTERS_COLLECTION'])
 
-def validate_address(cbsystem, cbauth, slave, address, count, collection):
+def validate_address(cbsystem, cbauth, slave, address, count, collection, rows=None):
     """Query the specified collection to see if all of the addresses exist
 
     :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
@@ -90,6 +189,9 @@ def validate_address(cbsystem, cbauth, slave, address, count, collection):
     :param slave: The unit id of the modbus device validation should be performed against.
     :param address: The starting address
     :param count: The number of values to retrieve
+    :param collection: The name of the ClearBlade platform data collection in which to query
+    :param rows: Rows already read from the collection for this range, if any. The collection is
+                 only queried when rows is None.
 
     :returns: True if all addresses for a specific slave exist, False otherwise.
     """
@@ -98,7 +200,8 @@ def validate_address(cbsystem, cbauth, slave, address, count, collection):
     logging.debug("Address = %s", address)
     logging.debug("Count = %s", count)
 
-    rows = read_collection_data(cbsystem, cbauth, slave, address, count, collection)
+    if rows is None:
+        rows = read_collection_data(cbsystem, cbauth, slave, address, count, collection)
 
     # See if there are any addresses missing
     if len(rows) < count:
@@ -183,7 +286,7 @@ def read_input_registers(cbsystem, cbauth, slave, address, count):
         MODBUS_DATA_COLLECTIONS['INPUT_REGISTERS_COLLECTION'])
     return rows
 
-def read_modbus_data(cbsystem, cbauth, slave, address, count, collection):
+def read_modbus_data(cbsystem, cbauth, slave, address, count, collection, rows=None):
     """Retrieve Modbus data values for specified addresses from a named collection
 
     :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
@@ -193,10 +296,13 @@ def read_modbus_data(cbsystem, cbauth, slave, address, count, collection):
     :param address: The starting address
     :param count: The number of values to retrieve
     :param collection: The name of the ClearBlade platform data collection in which to query
+    :param rows: Rows already read from the collection for this range, if any. The collection is
+                 only queried when rows is None.
 
     :returns: Array of Modbus data values
     """
-    rows = read_collection_data(cbsystem, cbauth, slave, address, count, collection)
+    if rows is None:
+        rows = read_collection_data(cbsystem, cbauth, slave, address, count, collection)
 
     #Return data needs to be in an array
     values = []
@@ -222,6 +328,7 @@ def read_collection_data(cbsystem, cbauth, slave, address, count, collection):
     """
     logging.debug("Begin read_collection_data")
 
+    collection_name = collection
     collection = cbsystem.Collection(cbauth, collectionName=collection)
 
     the_query = Query()
@@ -233,7 +340,27 @@ def read_collection_data(cbsystem, cbauth, slave, address, count, collection):
     else:
         the_query.equalTo("data_address", address)
 
-    return collection.getItems(the_query)
+    return _timed_get_items(collection, the_query, 'read', collection_name)
+
+def read_unit_addresses(cbsystem, cbauth, collection):
+    """Retrieve the addresses that exist in the specified collection for every unit id
+
+    :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
+                     will communicate with.
+    :param cbauth: The object representing the ClearBlade Platform authentication credentials.
+    :param collection: The name of the ClearBlade platform data collection in which to query
+
+    :returns: A dictionary of unit id -> array of data addresses
+    """
+    logging.debug("Begin read_unit_addresses")
+
+    unit_addresses = {}
+    rows = _timed_get_items(cbsystem.Collection(cbauth, collectionName=collection), Query(), \
+        'scan', collection)
+    for row in rows:
+        unit_addresses.setdefault(row["unit_id"], []).append(row["data_address"])
+
+    return unit_addresses
 
 def write_coils(cbsystem, cbauth, slave, address, data):
     """Save coil values into the Discrete_Output_Coils collection
@@ -265,7 +392,13 @@ def write_holding_registers(cbsystem, cbauth, slave, address, data):
         MODBUS_DATA_COLLECTIONS['OUTPUT_REGISTERS_COLLECTION'])
 
 def write_collection_data(cbsystem, cbauth, slave, address, data, collection):
-    """Retrieve input register values from the Analog_Input_Registers collection
+    """Save data values for a range of addresses into the specified collection
+
+    Consecutive addresses being set to the same value are saved with a single updateItems call.
+    The platform has no call setting different values on several rows, so every other value needs
+    a call of its own. When more than one call is needed, up to
+    MODBUS_WRITE_SETTINGS['MAX_CONCURRENT_UPDATES'] of them are sent to the platform at the same
+    time, by threads shared with every other write.
 
     :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
                      will communicate with.
@@ -275,15 +408,163 @@ def write_collection_data(cbsystem, cbauth, slave, address, data, collection):
     :param data: The data values to write to the Analog_Output_Holding_Registers collection
     :param collection: The name of the ClearBlade platform data collection in which to write
                         the data to
+
+    :raises CbDataWriteException: If any of the values could not be saved
     """
     logging.debug("Begin write_collection_data")
 
-    collection = cbsystem.Collection(cbauth, collectionName=collection)
+    updates = group_write_data(address, data)
+    logging.debug("Writing %d values to %s using %d updates", len(data), collection, len(updates))
+
+    failures = []
+    if len(updates) == 1:
+        _write_update(cbsystem, cbauth, slave, updates[0], collection, failures)
+    else:
+        _update_executor().run_all([lambda update=update: _write_update(cbsystem, cbauth, \
+            slave, update, collection, failures) for update in updates])
+
+    if failures:
+        addresses = sorted([addr for update, _ in failures \
+            for addr in range(update[0], update[0] + update[1])])
+
+        #Report a gateway timeout only if the platform never answered any of the failed updates
+        if all([isinstance(error, PlatformTimeout) for _, error in failures]):
+            error_code = ModbusErrorCodes.GatewayDeviceFailedtoRespond
+        else:
+            error_code = ModbusErrorCodes.SlaveDeviceFailure
+
+        logging.error("Unable to save %d of %d values to %s: %s", len(addresses), len(data), \
+            collection, str(failures[0][1]))
+        raise CbDataWriteException("Unable to save values for addresses " + str(addresses) + \
+            " of unit " + str(slave) + " to collection " + collection, error_code, addresses)
 
+class _UpdateExecutor(object):
+    ''' A fixed set of threads sending collection updates, shared by every write
+
+    :param threads: The number of updates sent at the same time
+    '''
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._queue = Queue()
+        for ndx in range(0, threads):
+            thread = threading.Thread(target=self._run, name="CollectionUpdate-%d" % ndx)
+            thread.daemon = True
+            thread.start()
+
+    def run_all(self, tasks):
+        ''' Runs every task, returning once all of them have completed '''
+        remaining = [len(tasks)]
+        completed = threading.Condition()
+
+        def finish():
+            ''' Counts a completed task '''
+            with completed:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    completed.notify()
+
+        for task in tasks:
+            self._queue.put((task, finish))
+
+        with completed:
+            while remaining[0] > 0:
+                completed.wait()
+
+    def _run(self):
+        ''' Runs queued tasks for the lifetime of the process '''
+        while True:
+            task, finish = self._queue.get()
+            try:
+                task()
+            except Exception as exc:
+                logging.error("Collection update failed: %s", str(exc))
+            finally:
+                finish()
+
+_UPDATE_EXECUTOR = [None]
+_UPDATE_EXECUTOR_LOCK = threading.Lock()
+
+def _update_executor():
+    """Return the update executor, replacing it if MAX_CONCURRENT_UPDATES changed"""
+    threads = max(1, MODBUS_WRITE_SETTINGS['MAX_CONCURRENT_UPDATES'])
+    with _UPDATE_EXECUTOR_LOCK:
+        if _UPDATE_EXECUTOR[0] is None or _UPDATE_EXECUTOR[0].threads != threads:
+            _UPDATE_EXECUTOR[0] = _UpdateExecutor(threads)
+        return _UPDATE_EXECUTOR[0]
+
+def group_write_data(address, data):
+    """Group a range of data values into runs of consecutive addresses sharing the same value
+
+    :param address: The starting address
+    :param data: The data values being written
+
+    :returns: An array of (start address, address count, value) tuples
+    """
+    updates = []
     for ndx in range(0, len(data)):
+        if updates and updates[-1][2] == data[ndx]:
+            updates[-1] = (updates[-1][0], updates[-1][1] + 1, data[ndx])
+        else:
+            updates.append((address + ndx, 1, data[ndx]))
+
+    return updates
 
-        the_query = Query()
-        the_query.equalTo("unit_id", slave)
-        the_query.equalTo("data_address", address + ndx)
+def _write_update(cbsystem, cbauth, slave, update, collection, failures):
+    """Save a single run of data values, recording any failure
 
-        collection.updateItems(the_query, {"data_value": data[ndx]})
+    :param update: A (start address, address count, value) tuple
+    :param failures: An array that (update, exception) tuples are appended to on failure
+    """
+    start, count, value = update
+
+    the_query = Query()
+    the_query.equalTo("unit_id", slave)
+
+    if count > 1:
+        the_query.greaterThanEqualTo("data_address", start)
+        the_query.lessThan("data_address", start + count)
+    else:
+        the_query.equalTo("data_address", start)
+
+    started = time.time()
+    try:
+        cbsystem.Collection(cbauth, collectionName=collection).updateItems(the_query, \
+            {"data_value": value})
+    except Exception as exc:
+        PLATFORM_CALL_ERRORS.increment(('update', collection))
+        failures.append((update, exc))
+    finally:
+        PLATFORM_CALL_SECONDS.observe(time.time() - started, ('update', collection))
+
+def _timed_get_items(collection, the_query, operation, collection_name):
+    """Query a collection one page at a time, recording the round trip time of every page and the
+    number of rows returned
+
+    :param collection: The ClearBlade Collection object to query
+    :param the_query: The Query to execute
+    :param operation: The metric label describing why the collection is queried
+    :param collection_name: The name of the collection
+
+    :returns: The rows of every page returned by the platform
+    """
+    page_size = MODBUS_QUERY_SETTINGS['PAGE_SIZE']
+    rows = []
+    page = 1
+    while True:
+        started = time.time()
+        try:
+            page_rows = collection.getItems(the_query, pagesize=page_size, pagenum=page)
+        except Exception:
+            PLATFORM_CALL_ERRORS.increment((operation, collection_name))
+            raise
+        finally:
+            PLATFORM_CALL_SECONDS.observe(time.time() - started, (operation, collection_name))
+
+        PLATFORM_ROWS_FETCHED.increment((operation, collection_name), len(page_rows))
+        rows.extend(page_rows)
+
+        #A short page is the last one
+        if len(page_rows) < page_size:
+            return rows
+        page += 1
@@ -0,0 +1,159 @@
+'''
+cbModbus coalesce
+-----------------
+
+Merges read requests for nearby address ranges of the same host, unit and function code into a
+single Modbus read, and splits the result back into the responses of the original requests.
+'''
+import logging
+import threading
+import time
+
+from constants import ModbusFunctionCodes
+
+#The maximum number of values a single read may return, per function code
+MAX_READ_COUNTS = {
+    ModbusFunctionCodes.ReadCoil: 2000,
+    ModbusFunctionCodes.ReadDiscreteInput: 2000,
+    ModbusFunctionCodes.ReadHoldingRegisters: 125,
+    ModbusFunctionCodes.ReadInputRegisters: 125
+}
+
+def plan_reads(ranges, max_gap, max_count):
+    ''' Groups address ranges into as few reads as possible
+
+    :param ranges: An array of (start address, count) tuples
+    :param max_gap: The maximum number of unrequested addresses a read may span between two ranges
+    :param max_count: The maximum number of values a single read may return
+
+    :returns: An array of (start address, count, member indexes) tuples, where member indexes are
+              the positions in ranges of the ranges covered by the read
+    '''
+    reads = []
+    for ndx in sorted(range(0, len(ranges)), key=lambda ndx: ranges[ndx][0]):
+        start, count = ranges[ndx]
+        if reads:
+            read_start, read_count, members = reads[-1]
+            end = max(read_start + read_count, start + count)
+            if start - (read_start + read_count) <= max_gap and end - read_start <= max_count:
+                reads[-1] = (read_start, end - read_start, members + [ndx])
+                continue
+        reads.append((start, count, [ndx]))
+
+    return reads
+
+class ReadCoalescer(object):
+    ''' Holds read requests for a short window and sends nearby ranges as a single read
+
+    :param submit: A callable accepting (payload, modbus_port, on_result) that executes a request
+    :param window: The number of seconds a read waits for other reads it can be merged with
+    :param max_gap: The maximum number of unrequested addresses a merged read may span
+    '''
+
+    def __init__(self, submit, window=0.01, max_gap=0):
+        self.submit = submit
+        self.window = window
+        self.max_gap = max_gap
+
+        #(host, port, unit, function code) -> (deadline, array of (payload, on_result))
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        self._thread = threading.Thread(target=self._run, name="ReadCoalescer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def accepts(self, payload):
+        ''' Returns True if the request is a read that can be coalesced '''
+        return payload['FunctionCode'] in MAX_READ_COUNTS
+
+    def add(self, payload, modbus_port, on_result):
+        ''' Queues a read request until the window of its host, unit and function code closes
+
+        :param payload: The validated Modbus read request
+        :param modbus_port: The port of the Modbus host
+        :param on_result: Invoked with the response dictionary of the request
+        '''
+        key = (payload['ModbusHost'], modbus_port, payload['UnitID'], payload['FunctionCode'])
+        with self._condition:
+            if self._stopping:
+                self.submit(payload, modbus_port, on_result)
+                return
+            if key not in self._pending:
+                self._pending[key] = (time.time() + self.window, [])
+                self._condition.notify()
+            self._pending[key][1].append((payload, on_result))
+
+    def stop(self):
+        ''' Sends every held read and stops the window thread '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        ''' Flushes each group of reads once its window closes '''
+        while True:
+            with self._condition:
+                now = time.time()
+                due = [key for key, entry in self._pending.items() \
+                    if entry[0] <= now or self._stopping]
+                groups = [(key, self._pending.pop(key)[1]) for key in due]
+
+                if not groups:
+                    if self._stopping:
+                        return
+                    if self._pending:
+                        self._condition.wait(max(0, min([entry[0] for entry in \
+                            self._pending.values()]) - now))
+                    else:
+                        self._condition.wait()
+                    continue
+
+            for key, requests in groups:
+                self._flush(key, requests)
+
+    def _flush(self, key, requests):
+        ''' Sends a group of reads for the same host, unit and function code '''
+        ranges = [(payload['StartAddress'], payload.get('AddressCount') or 1) \
+            for payload, _ in requests]
+
+        for start, count, members in plan_reads(ranges, self.max_gap, MAX_READ_COUNTS[key[3]]):
+            if len(members) == 1:
+                payload, on_result = requests[members[0]]
+                self.submit(payload, key[1], on_result)
+                continue
+
+            logging.debug("Coalesced %d reads of %s:%s unit %s function %s into %d:%d", \
+                len(members), key[0], key[1], key[2], key[3], start, count)
+
+            merged = dict(requests[members[0]][0])
+            merged['StartAddress'] = start
+            merged['AddressCount'] = count
+
+            self.submit(merged, key[1], self._splitter(key, start, count, \
+                [requests[ndx] for ndx in members], [ranges[ndx] for ndx in members]))
+
+    def _splitter(self, key, start, count, members, ranges):
+        ''' Returns a callable splitting the result of a merged read between its members '''
+        spans_gap = sum([member_count for _, member_count in ranges]) < count
+
+        def split(response):
+            ''' Delivers each member its slice of the merged read '''
+            if response is not None and response.get('error') is None:
+                for (payload, on_result), (member_start, member_count) in zip(members, ranges):
+                    offset = member_start - start
+                    on_result({'Data': response['Data'][offset:offset + member_count]})
+            elif spans_gap and response is not None and \
+                response.get('exception') == 'ExceptionResponse':
+                #The device may not implement the unrequested addresses between the members
+                logging.debug("Coalesced read of %d:%d was rejected, reading members separately", \
+                    start, count)
+                for payload, on_result in members:
+                    self.submit(payload, key[1], on_result)
+            else:
+                for _, on_result in members:
+                    on_result(response)
+
+        return split
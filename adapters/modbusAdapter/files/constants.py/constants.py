@@ -41,6 +41,14 @@ class ModbusFunctionCodes(Singleton):
     .. attribute:: WriteMultipleHoldingRegisters
 
        Function code 16 - Modbus Write Single Coil function.
+
+    .. attribute:: MaskWriteRegister
+
+       Function code 22 - Modbus Mask Write Register function.
+
+    .. attribute:: ReadWriteMultipleRegisters
+
+       Function code 23 - Modbus Read/Write Multiple Registers function.
     '''
     ReadCoil = 1
     ReadDiscreteInput = 2
@@ -50,6 +58,8 @@ class ModbusFunctionCodes(Singleton):
     WriteSingleHoldingRegister = 6
     WriteMultipleCoils = 15
     WriteMultipleHoldingRegisters = 16
+    MaskWriteRegister = 22
+    ReadWriteMultipleRegisters = 23
 
 class ModbusErrorCodes(Singleton):
     ''' Represents the Modbus Error Code Values
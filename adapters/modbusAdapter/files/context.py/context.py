@@ -2,8 +2,11 @@
 # Logging
 #---------------------------------------------------------------------------#
 import logging
+import threading
+from collections import OrderedDict
 
-from store import CbModbusDatastore
+from addressindex import AddressIndex
+from store import CbModbusDatastore, RegisterImage
 from pymodbus.constants import Defaults
 from pymodbus.exceptions import NoSuchSlaveException
 from pymodbus.interfaces import IModbusSlaveContext
@@ -23,12 +26,18 @@ class ClearBladeModbusSlaveContext(IModbusSlaveContext):
     :param cbsystem:    The ClearBlade system object representing the ClearBlade System the adapter
                         will communicate with.
     :param cbauth:      The object representing the ClearBlade Platform authentication credentials.
+    :param image:       An optional RegisterImage used to serve reads from memory.
+    :param writer:      An optional WriteBehindQueue used to save writes in the background.
+    :param index:       An optional AddressIndex used to validate requests locally.
+    :param relay:       An optional WriteRelay that writes are sent to the other workers on.
     '''
     def __init__(self, **kwargs):
         self.zero_mode = kwargs.get('zero_mode', Defaults.ZeroMode)
         self.unit_id = kwargs.get('slave', 0)
         self.store = CbModbusDatastore(cbsystem=kwargs.get('cbsystem', None), \
-            cbauth=kwargs.get('cbauth', None))
+            cbauth=kwargs.get('cbauth', None), image=kwargs.get('image', None), \
+            writer=kwargs.get('writer', None), index=kwargs.get('index', None), \
+            relay=kwargs.get('relay', None))
 
     def __str__(self):
         ''' Returns a string representation of the context
@@ -97,6 +106,20 @@ class ClearBladeModbusServerContext(object):
     :param cbsystem:    The ClearBlade system object representing the ClearBlade System the adapter
                         will communicate with.
     :param cbauth:      The object representing the ClearBlade Platform authentication credentials.
+    :param cache_ttl:   The number of seconds values are served from the in-memory register image
+                        before being reloaded from the platform. 0 disables the register image and
+                        a negative value means values never expire.
+    :param writer:      An optional WriteBehindQueue. When present, writes are acknowledged once
+                        queued and saved to the platform in the background.
+    :param max_units:   The maximum number of slave contexts kept alive. The least recently used
+                        context, and its register image entries, are discarded beyond it.
+    :param load_units:  Set to False to skip loading the address index from the data collections.
+                        Every unit id is then accepted and requests are validated against the
+                        platform.
+    :param relay:       An optional WriteRelay connecting this worker process to the others. Writes
+                        are sent to them and their writes are applied to the register image.
+    :param snapshot:    An optional RegisterSnapshot the register image is loaded from at startup
+                        and mirrored to. Requires cache_ttl.
     '''
 
     def __init__(self, **kwargs):
@@ -106,12 +129,115 @@ class ClearBladeModbusServerContext(object):
                           will communicate with.
         :param cbauth:    The object representing the ClearBlade Platform authentication credentials.
         :param zero_mode: Set to true to treat this as a single context
+        :param cache_ttl: The register image TTL in seconds, 0 to disable the register image
+        :param writer:    An optional WriteBehindQueue used to save writes in the background
+        :param max_units: The maximum number of slave contexts kept alive
+        :param load_units: Set to False to accept every unit id without loading the address index
+        :param relay:     An optional WriteRelay connecting this worker process to the others
+        :param snapshot:  An optional RegisterSnapshot backing the register image
         '''
 
         self.cbauth = kwargs.get('cbauth', None)
         self.cbsystem = kwargs.get('cbsystem', None)
         self.zero_mode = kwargs.get('zero_mode', Defaults.ZeroMode)
-        self.store = CbModbusDatastore(cbsystem=self.cbsystem, cbauth=self.cbauth)
+        self.writer = kwargs.get('writer', None)
+        self.relay = kwargs.get('relay', None)
+
+        self.image = None
+        cache_ttl = kwargs.get('cache_ttl', 0)
+        if cache_ttl:
+            self.image = RegisterImage(ttl=cache_ttl, snapshot=kwargs.get('snapshot', None))
+
+        self.store = CbModbusDatastore(cbsystem=self.cbsystem, cbauth=self.cbauth, image=self.image, \
+            writer=self.writer, relay=self.relay)
+
+        self.max_units = kwargs.get('max_units', 64)
+        self._slaves = OrderedDict()
+        self._lock = threading.Lock()
+
+        #None means the address index is unavailable, every unit id is accepted and requests are
+        #validated against the platform
+        self.index = None
+        self.units = None
+        if kwargs.get('load_units', True):
+            self.refresh_index()
+
+        if self.relay is not None:
+            self.relay.start(self.apply_write)
+
+    def refresh_index(self):
+        ''' Reloads the index of addresses that exist in the Modbus data collections '''
+        logging.debug("In ClearBladeModbusServerContext.refresh_index")
+
+        index = self.index if self.index is not None else AddressIndex()
+        try:
+            index.load(self.cbsystem, self.cbauth)
+        except Exception as exc:
+            logging.error("Unable to load the Modbus address index, keeping the current index: %s", \
+                str(exc))
+            return
+
+        units = index.units()
+        logging.info("Loaded the addresses of %d Modbus unit ids from the data collections", \
+            len(units))
+        self.units = units
+
+        if self.index is None:
+            #Contexts created before the index existed validate against the platform
+            with self._lock:
+                self._slaves.clear()
+            self.index = index
+
+        #Drop contexts of units that no longer exist
+        with self._lock:
+            for slave in list(self._slaves.keys()):
+                if slave not in units:
+                    self._evict(slave)
+
+    def apply_write(self, slave, table, address, values):
+        ''' Records values written to the data collections by someone other than this context
+
+        :param slave: The unit id written to
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry written to
+        :param address: The starting address
+        :param values: The values written
+        '''
+        logging.debug("Applying write to unit %s, %s %d:%d", slave, table, address, len(values))
+        if self.image is not None:
+            self.image.put(slave, table, address, values)
+
+    def apply_change(self, slave, table, address, values=None, count=1, removed=False):
+        ''' Records a change made to the data collections that was announced by the platform
+
+        :param slave: The unit id changed
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry changed
+        :param address: The starting address
+        :param values: The new values, or None to reload the addresses from the platform when
+                       they are next read
+        :param count: The number of addresses changed when values is None
+        :param removed: Set to True when the addresses were deleted from the data collections
+        '''
+        if values is not None:
+            count = len(values)
+        logging.debug("Applying change to unit %s, %s %d:%d", slave, table, address, count)
+
+        if self.index is not None:
+            if removed:
+                self.index.remove(slave, table, address, count)
+            else:
+                self.index.add(slave, table, address, count)
+            self.units = self.index.units()
+
+            #Drop the context of a unit whose last address was removed
+            with self._lock:
+                if slave in self._slaves and slave not in self.units:
+                    self._evict(slave)
+
+        if self.image is not None:
+            if values is not None and not removed:
+                self.image.put(slave, table, address, values)
+            else:
+                self.image.invalidate(slave, table, address, count)
 
     def __contains__(self, slave):
         ''' Check if the given slave exists
@@ -121,8 +247,7 @@ class ClearBladeModbusServerContext(object):
         '''
         logging.debug("In ClearBladeModbusServerContext.__contains__")
 
-        #TODO Query the CB platform to see if the slave exists
-        return True
+        return self.units is None or slave in self.units
 
     def __getitem__(self, slave):
         ''' Used to get access to a slave context
@@ -132,7 +257,35 @@ class ClearBladeModbusServerContext(object):
         '''
         logging.debug("In ClearBladeModbusServerContext.__getitem__")
 
-        return ClearBladeModbusSlaveContext(cbauth=self.cbauth,
-                                            cbsystem=self.cbsystem,
-                                            zero_mode=self.zero_mode,
-                                            slave=slave)
+        if slave not in self:
+            raise NoSuchSlaveException("slave - {} does not exist, or is out of range".format(slave))
+
+        with self._lock:
+            context = self._slaves.pop(slave, None)
+            if context is None:
+                context = ClearBladeModbusSlaveContext(cbauth=self.cbauth,
+                                                       cbsystem=self.cbsystem,
+                                                       zero_mode=self.zero_mode,
+                                                       image=self.image,
+                                                       writer=self.writer,
+                                                       index=self.index,
+                                                       relay=self.relay,
+                                                       slave=slave)
+
+                while len(self._slaves) >= self.max_units:
+                    self._evict(next(iter(self._slaves)))
+
+            #Most recently used contexts are kept at the end
+            self._slaves[slave] = context
+
+        return context
+
+    def _evict(self, slave):
+        ''' Discards the context of a slave along with its register image entries
+
+        :param slave: The unit id of the slave to discard
+        '''
+        logging.debug("Evicting slave context for unit %s", slave)
+        del self._slaves[slave]
+        if self.image is not None:
+            self.image.invalidate(slave)
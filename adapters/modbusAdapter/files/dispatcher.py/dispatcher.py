@@ -0,0 +1,198 @@
+'''
+cbModbus dispatcher
+-----------------
+
+Moves Modbus requests off the MQTT network thread. Requests are queued per Modbus host and
+executed by a bounded pool of worker threads, with a limit on the number of requests a single
+host may have executing at the same time.
+'''
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+OVERFLOW_POLICIES = {
+    'REJECT': "reject",
+    'DROP_OLDEST': "drop_oldest",
+    'BLOCK': "block"
+}
+
+class RequestDispatcher(object):
+    ''' A bounded worker pool executing queued requests with per-host concurrency limits
+
+    :param workers: The number of worker threads
+    :param max_queued: The maximum number of requests waiting to be executed
+    :param per_host: The maximum number of requests executing for a single host at the same time
+    :param overflow: The OVERFLOW_POLICIES value applied when a request arrives at a full queue
+    :param block_timeout: With the block policy, the number of seconds to wait for room before the
+                          request is rejected. None waits forever, which blocks the caller, such
+                          as the MQTT network thread, for as long as the queue stays full.
+    '''
+
+    def __init__(self, workers=8, max_queued=1000, per_host=1, \
+        overflow=OVERFLOW_POLICIES['REJECT'], block_timeout=1.0):
+        if overflow not in OVERFLOW_POLICIES.values():
+            raise ValueError("Invalid overflow policy " + str(overflow))
+
+        self.max_queued = max_queued
+        self.per_host = per_host
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+
+        #host key -> deque of (sequence, run, reject)
+        self._queues = {}
+        #host key -> number of requests executing
+        self._active = {}
+        #host keys with queued requests and spare capacity, in the order they became ready
+        self._ready = deque()
+        self._queued = 0
+        self._sequence = itertools.count()
+        self._stopping = False
+        self._condition = threading.Condition()
+
+        self._workers = []
+        for ndx in range(0, workers):
+            worker = threading.Thread(target=self._run, name="ModbusWorker-" + str(ndx))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def dispatch(self, key, run, reject):
+        ''' Queues a request for execution
+
+        :param key: The key of the host the request is sent to, typically (host, port)
+        :param run: A callable executing the request
+        :param reject: A callable accepting a reason string, invoked instead of run if the request
+                       is rejected or dropped, and after run if run raises an exception
+
+        :returns: True if the request was queued, False if it was rejected
+        '''
+        dropped = None
+        with self._condition:
+            if self._stopping:
+                rejected = "Modbus adapter is shutting down"
+            elif self._queued < self.max_queued:
+                rejected = None
+            elif self.overflow == OVERFLOW_POLICIES['DROP_OLDEST']:
+                dropped = self._pop_oldest()
+                rejected = None
+            elif self.overflow == OVERFLOW_POLICIES['BLOCK']:
+                rejected = self._wait_for_room()
+            else:
+                rejected = "Modbus request queue is full"
+
+            if rejected is None:
+                self._queues.setdefault(key, deque()).append((next(self._sequence), run, reject))
+                self._queued += 1
+                self._mark_ready(key)
+
+        if dropped is not None:
+            logging.warning("Modbus request queue is full, dropping the oldest request")
+            _reject(dropped, "Modbus request dropped because the request queue is full")
+
+        if rejected is not None:
+            logging.warning("Rejecting Modbus request: %s", rejected)
+            _reject(reject, rejected)
+            return False
+
+        return True
+
+    def queue_depth(self):
+        ''' Returns the number of requests waiting to be executed '''
+        return self._queued
+
+    def stop(self, timeout=None):
+        ''' Stops accepting requests and waits for queued requests to finish
+
+        :param timeout: The maximum number of seconds to wait, None to wait forever
+
+        :returns: True if every queued request finished, False otherwise
+        '''
+        logging.info("Stopping Modbus request dispatcher")
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(0, deadline - time.time()))
+
+        remaining = self._queued + sum(self._active.values())
+        if remaining:
+            logging.error("%d Modbus requests did not finish before the dispatcher stopped", \
+                remaining)
+        return remaining == 0
+
+    def _run(self):
+        ''' Executes ready requests until the dispatcher is stopped and drained '''
+        while True:
+            with self._condition:
+                while not self._ready:
+                    if self._stopping and self._queued == 0:
+                        return
+                    self._condition.wait()
+
+                key = self._ready.popleft()
+                _, run, reject = self._queues[key].popleft()
+                self._queued -= 1
+                self._active[key] = self._active.get(key, 0) + 1
+                self._mark_ready(key)
+                self._condition.notify_all()
+
+            try:
+                run()
+            except Exception as exc:
+                logging.error("Error while executing Modbus request: %s", str(exc))
+                #Report the failure, so the caller is not left waiting for a result
+                _reject(reject, "Error while executing Modbus request: " + str(exc))
+            finally:
+                with self._condition:
+                    self._active[key] -= 1
+                    self._mark_ready(key)
+                    self._condition.notify_all()
+
+    def _mark_ready(self, key):
+        ''' Lists a host as ready once for each request it could start right now '''
+        startable = min(self.per_host - self._active.get(key, 0), len(self._queues.get(key, ())))
+        if self._ready.count(key) < startable:
+            self._ready.append(key)
+            self._condition.notify()
+
+    def _pop_oldest(self):
+        ''' Removes the oldest queued request
+
+        :returns: The reject callable of the removed request
+        '''
+        key = min([key for key in self._queues if self._queues[key]], \
+            key=lambda key: self._queues[key][0][0])
+        _, _, reject = self._queues[key].popleft()
+        self._queued -= 1
+
+        #The host may now be listed as ready more times than it has queued requests
+        while self._ready.count(key) > len(self._queues[key]):
+            self._ready.remove(key)
+        return reject
+
+    def _wait_for_room(self):
+        ''' Waits for the queue to have room
+
+        :returns: None once there is room, or the reason the request is rejected
+        '''
+        deadline = None if self.block_timeout is None else time.time() + self.block_timeout
+        while self._queued >= self.max_queued:
+            remaining = None if deadline is None else deadline - time.time()
+            if self._stopping:
+                return "Modbus adapter is shutting down"
+            if remaining is not None and remaining <= 0:
+                return "Timed out waiting for room in the Modbus request queue"
+            self._condition.wait(remaining)
+        return None
+
+def _reject(reject, reason):
+    ''' Invokes a reject callable, logging rather than propagating its errors '''
+    try:
+        reject(reason)
+    except Exception as exc:
+        logging.error("Error while rejecting Modbus request: %s", str(exc))
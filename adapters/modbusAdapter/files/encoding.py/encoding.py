@@ -0,0 +1,124 @@
+'''
+cbModbus encoding
+-----------------
+
+Encodes and decodes the messages exchanged on the Modbus MQTT topics. JSON is the default. When
+msgpack is installed, requests may also be sent msgpack encoded on the request topic suffixed
+with /msgpack, and their responses and errors are published msgpack encoded on the response and
+error topics suffixed with /msgpack.
+
+In msgpack encoded responses the Data of register function codes is a byte string of big-endian
+unsigned 16 bit values rather than an array, so a 125 register read costs 250 bytes. Data that is
+not an array, such as the value echoed by FC6 or the count of registers written by FC16, is left
+as it is.
+'''
+import json
+import struct
+
+from constants import ModbusFunctionCodes
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = {
+    'JSON': "json",
+    'MSGPACK': "msgpack"
+}
+
+#The function codes whose Data is packed as 16 bit registers in compact encodings
+REGISTER_FUNCTION_CODES = (ModbusFunctionCodes.ReadHoldingRegisters, \
+    ModbusFunctionCodes.ReadInputRegisters, ModbusFunctionCodes.WriteSingleHoldingRegister, \
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters, \
+    ModbusFunctionCodes.ReadWriteMultipleRegisters)
+
+def available_encodings():
+    ''' Returns the encodings that can be used with the installed packages '''
+    if msgpack is None:
+        return [ENCODINGS['JSON']]
+    return [ENCODINGS['JSON'], ENCODINGS['MSGPACK']]
+
+def encoded_topic(sub_topic, encoding):
+    ''' Returns the sub topic messages of an encoding are exchanged on '''
+    if encoding == ENCODINGS['JSON']:
+        return sub_topic
+    return sub_topic + '/' + encoding
+
+def topic_encoding(topic):
+    ''' Returns the encoding of the messages exchanged on a topic '''
+    if topic.endswith('/' + ENCODINGS['MSGPACK']):
+        return ENCODINGS['MSGPACK']
+    return ENCODINGS['JSON']
+
+def decode_request(payload, encoding):
+    ''' Decodes a Modbus command, or an array of commands, received on a request topic '''
+    if encoding == ENCODINGS['MSGPACK']:
+        request = msgpack.unpackb(payload, raw=False)
+        if isinstance(request, list):
+            return [_unpack_data(command) for command in request]
+        return _unpack_data(request)
+
+    try:
+        return json.loads(payload)
+    except ValueError:
+        #Older publishers send Python reprs, quoting strings with single quotes. Only copy and
+        #rewrite the payload for them.
+        return json.loads(payload.replace("'", '"'))
+
+def encode_request(request, encoding):
+    ''' Encodes a Modbus command, or an array of commands, for publishing on a request topic '''
+    if encoding == ENCODINGS['MSGPACK']:
+        if isinstance(request, list):
+            request = [_pack_command(command) for command in request]
+        else:
+            request = _pack_command(request)
+        return msgpack.packb(request, use_bin_type=True)
+
+    return json.dumps(request)
+
+def encode_message(message, encoding):
+    ''' Encodes a response, error or batch message for publishing '''
+    if encoding == ENCODINGS['MSGPACK']:
+        if 'results' in message:
+            message = {'results': [_pack_data(result) for result in message['results']]}
+        else:
+            message = _pack_data(message)
+        return msgpack.packb(message, use_bin_type=True)
+
+    return json.dumps(message)
+
+def pack_registers(values):
+    ''' Packs register values as big-endian unsigned 16 bit integers '''
+    return struct.pack('>%dH' % len(values), *values)
+
+def unpack_registers(data):
+    ''' Unpacks big-endian unsigned 16 bit integers into an array of register values '''
+    return list(struct.unpack('>%dH' % (len(data) // 2), data))
+
+def _pack_data(message):
+    ''' Returns a copy of a response message with register Data packed '''
+    response = message.get('response')
+    if response is None or not isinstance(response.get('Data'), list) or \
+        message['request'].get('FunctionCode') not in REGISTER_FUNCTION_CODES:
+        return message
+
+    packed = dict(response)
+    packed['Data'] = pack_registers(response['Data'])
+    return {'request': message['request'], 'response': packed}
+
+def _pack_command(command):
+    ''' Returns a copy of a write command with register Data packed '''
+    if not isinstance(command.get('Data'), list) or \
+        command.get('FunctionCode') not in REGISTER_FUNCTION_CODES:
+        return command
+
+    packed = dict(command)
+    packed['Data'] = pack_registers(command['Data'])
+    return packed
+
+def _unpack_data(command):
+    ''' Unpacks the register Data of a write command sent as a byte string '''
+    if isinstance(command, dict) and isinstance(command.get('Data'), bytes):
+        command['Data'] = unpack_registers(command['Data'])
+    return command
@@ -0,0 +1,247 @@
+'''
+cbModbus engine
+-----------------
+
+An asynchronous execution engine for the client adapter, built on the Twisted reactor and the
+pymodbus Twisted client. Requests to different Modbus hosts are in flight at the same time, so a
+slow or offline device only delays the requests sent to it.
+'''
+import importlib
+import logging
+import threading
+import time
+from collections import deque
+
+from functions import extract_response, record_connect, record_transaction, send_request
+from twisted.internet import protocol, reactor
+
+#async is a keyword from Python 3.7, so the pymodbus 1.x Twisted client cannot be named in an
+#import statement
+ModbusClientProtocol = importlib.import_module("pymodbus.client.async").ModbusClientProtocol
+
+class _ManagedClientProtocol(ModbusClientProtocol):
+    ''' A pymodbus Twisted client protocol that reports lost connections to the engine '''
+
+    on_lost = None
+
+    def connectionLost(self, reason=None):
+        ''' Called when the connection to the Modbus host is closed '''
+        ModbusClientProtocol.connectionLost(self, reason)
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+class _HostState(object):
+    ''' The connection and queued requests of a single (host, port) '''
+
+    def __init__(self):
+        self.client = None
+        self.connecting = False
+        self.in_flight = 0
+        self.queue = deque()
+
+class ModbusEngine(object):
+    ''' Executes Modbus requests asynchronously on a Twisted reactor running in its own thread
+
+    :param timeout: The number of seconds a request may take before it fails
+    :param max_in_flight_per_host: The maximum number of requests outstanding on a single
+                                   connection. Further requests to the host wait their turn.
+    :param reactor: The Twisted reactor requests are executed on. The default is the global
+                    reactor.
+    '''
+
+    #The client protocol connections to Modbus hosts are made with
+    client_protocol = _ManagedClientProtocol
+
+    def __init__(self, timeout=5.0, max_in_flight_per_host=1, reactor=reactor):
+        self.timeout = timeout
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.reactor = reactor
+        self._hosts = {}
+        self._thread = None
+
+        #The number of submitted requests whose callbacks have not been invoked yet
+        self._outstanding = 0
+        self._idle = threading.Condition()
+
+    def start(self):
+        ''' Starts the reactor thread '''
+        logging.info("Starting Modbus engine")
+        self._thread = threading.Thread(target=self.reactor.run, name="ModbusEngine", \
+            kwargs={'installSignalHandlers': False})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        ''' Closes every connection and stops the reactor thread
+
+        :param timeout: The maximum number of seconds to wait for the reactor to stop
+        '''
+        logging.info("Stopping Modbus engine")
+        self.reactor.callFromThread(self._close_all)
+        self.reactor.callFromThread(self.reactor.stop)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def drain(self, timeout=None):
+        ''' Waits for every submitted request to complete
+
+        :param timeout: The maximum number of seconds to wait, None to wait forever
+
+        :returns: True if every submitted request completed, False otherwise
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._idle:
+            while self._outstanding > 0:
+                if deadline is not None and deadline <= time.time():
+                    logging.error("%d Modbus requests did not complete before the engine " \
+                        "stopped", self._outstanding)
+                    return False
+                self._idle.wait(None if deadline is None else deadline - time.time())
+        return True
+
+    def queue_depth(self):
+        ''' Returns the number of submitted requests that have not completed '''
+        return self._outstanding
+
+    def submit(self, payload, modbus_port, callback):
+        ''' Queues a Modbus request. May be called from any thread.
+
+        :param payload: The validated Modbus request
+        :param modbus_port: The port of the Modbus host
+        :param callback: Invoked on the reactor thread with the response dictionary, containing
+                         either 'Data' or 'error'
+        '''
+        with self._idle:
+            self._outstanding += 1
+        self.reactor.callFromThread(self._enqueue, payload, modbus_port, \
+            lambda result: self._finished(callback, result))
+
+    def _finished(self, callback, result):
+        ''' Delivers the result of a request and wakes drain() once nothing is outstanding '''
+        _complete(callback, result)
+        with self._idle:
+            self._outstanding -= 1
+            if self._outstanding == 0:
+                self._idle.notify_all()
+
+    def _enqueue(self, payload, modbus_port, callback):
+        ''' Queues a request for its host and starts it if the host is free '''
+        key = (payload['ModbusHost'], int(modbus_port))
+        state = self._hosts.setdefault(key, _HostState())
+        state.queue.append((payload, callback))
+        self._pump(key)
+
+    def _pump(self, key):
+        ''' Starts queued requests for a host while it has capacity '''
+        state = self._hosts[key]
+
+        if state.client is None:
+            if not state.connecting and state.queue:
+                self._connect(key)
+            return
+
+        while state.queue and state.in_flight < self.max_in_flight_per_host:
+            payload, callback = state.queue.popleft()
+            state.in_flight += 1
+            self._execute(key, state.client, payload, callback)
+
+    def _connect(self, key):
+        ''' Opens the connection to a host '''
+        logging.debug("Connecting to Modbus host %s:%s", key[0], key[1])
+        state = self._hosts[key]
+        state.connecting = True
+        started = time.time()
+
+        deferred = protocol.ClientCreator(self.reactor, self.client_protocol).connectTCP( \
+            key[0], key[1], timeout=self.timeout)
+
+        def connected(client):
+            ''' Starts the queued requests on the new connection '''
+            record_connect(key[0], started, True)
+            state.connecting = False
+            state.client = client
+            client.on_lost = lambda lost: self._connection_lost(key, lost)
+            self._pump(key)
+
+        def failed(failure):
+            ''' Fails every queued request of the host '''
+            logging.error("Unable to connect to Modbus host %s:%s: %s", key[0], key[1], \
+                failure.getErrorMessage())
+            record_connect(key[0], started, False)
+            state.connecting = False
+            queued = list(state.queue)
+            state.queue.clear()
+            for _, callback in queued:
+                _complete(callback, {'error': "Modbus Connection Exception: " + \
+                    failure.getErrorMessage(), 'exception': 'ConnectionException'})
+
+        deferred.addCallbacks(connected, failed)
+
+    def _connection_lost(self, key, client):
+        ''' Forgets a closed connection so the next request reconnects '''
+        state = self._hosts.get(key)
+        if state is not None and state.client is client:
+            logging.debug("Connection to Modbus host %s:%s lost", key[0], key[1])
+            state.client = None
+            if state.queue:
+                self._pump(key)
+
+    def _execute(self, key, client, payload, callback):
+        ''' Sends a single request and arranges for its result to be delivered '''
+        count = payload.get('AddressCount') or 1
+        state = self._hosts[key]
+        finished = []
+        started = time.time()
+
+        def done(result):
+            ''' Delivers the result once, whether it was a response, an error or a timeout '''
+            if finished:
+                return
+            finished.append(True)
+            if timer.active():
+                timer.cancel()
+            state.in_flight -= 1
+            record_transaction(payload, started, result)
+            _complete(callback, result)
+            self._pump(key)
+
+        def timed_out():
+            ''' Fails the request and drops the connection so a late response is discarded '''
+            logging.error("Modbus request to %s:%s timed out after %s seconds", key[0], key[1], \
+                self.timeout)
+            #Drop the connection before completing, so the next queued request reconnects rather
+            #than being sent on it
+            if state.client is client:
+                state.client = None
+            client.transport.loseConnection()
+            done({'error': "Modbus IO Exception: No response received within " + \
+                str(self.timeout) + " seconds", 'exception': 'ModbusIOException'})
+
+        def failed(failure):
+            ''' Converts a failed deferred into an error response '''
+            done({'error': "Modbus Exception: " + failure.getErrorMessage(), \
+                'exception': failure.type.__name__})
+
+        timer = self.reactor.callLater(self.timeout, timed_out)
+        try:
+            deferred = send_request(client, payload, count)
+        except Exception as exc:
+            done({'error': "Modbus Exception: " + str(exc), 'exception': exc.__class__.__name__})
+            return
+
+        deferred.addCallback(lambda response: done(extract_response(payload, response, count)))
+        deferred.addErrback(failed)
+
+    def _close_all(self):
+        ''' Closes every open connection '''
+        for state in self._hosts.values():
+            if state.client is not None:
+                state.client.transport.loseConnection()
+                state.client = None
+
+def _complete(callback, result):
+    ''' Invokes a completion callback, logging rather than propagating its errors '''
+    try:
+        callback(result)
+    except Exception as exc:
+        logging.error("Error while handling Modbus response: %s", str(exc))
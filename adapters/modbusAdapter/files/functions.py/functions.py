@@ -0,0 +1,137 @@
+'''
+cbModbus functions
+-----------------
+
+Helpers shared by the synchronous and asynchronous Modbus request paths of the client adapter,
+including the metrics both paths record for every Modbus host.
+'''
+import time
+from constants import ModbusFunctionCodes
+from metrics import METRICS
+from pymodbus.exceptions import ModbusException
+
+CONNECT_SECONDS = METRICS.histogram("modbus_client_connect_seconds", \
+    "Time taken to open connections to Modbus hosts", ('host',))
+CONNECT_FAILURES = METRICS.counter("modbus_client_connect_failures_total", \
+    "Connections to Modbus hosts that could not be opened", ('host',))
+TRANSACT_SECONDS = METRICS.histogram("modbus_client_transact_seconds", \
+    "Time taken by Modbus hosts to answer requests", ('host', 'unit_id', 'function_code'))
+REQUEST_EXCEPTIONS = METRICS.counter("modbus_client_exceptions_total", \
+    "Modbus requests that failed, by exception class", ('host', 'unit_id', 'exception'))
+
+#Issues the pymodbus client call of each supported function code. The synchronous and Twisted
+#clients share these method names, returning a response or a deferred respectively.
+MODBUS_REQUESTS = {
+    ModbusFunctionCodes.ReadCoil: lambda client, payload, count: \
+        client.read_coils(payload['StartAddress'], count, unit=payload['UnitID']),
+    ModbusFunctionCodes.ReadDiscreteInput: lambda client, payload, count: \
+        client.read_discrete_inputs(payload['StartAddress'], count, unit=payload['UnitID']),
+    ModbusFunctionCodes.ReadHoldingRegisters: lambda client, payload, count: \
+        client.read_holding_registers(payload['StartAddress'], count, unit=payload['UnitID']),
+    ModbusFunctionCodes.ReadInputRegisters: lambda client, payload, count: \
+        client.read_input_registers(payload['StartAddress'], count, unit=payload['UnitID']),
+    ModbusFunctionCodes.WriteSingleCoil: lambda client, payload, count: \
+        client.write_coil(payload['StartAddress'], payload['Data'][0], unit=payload['UnitID']),
+    ModbusFunctionCodes.WriteSingleHoldingRegister: lambda client, payload, count: \
+        client.write_register(payload['StartAddress'], payload['Data'][0], \
+            unit=payload['UnitID']),
+    ModbusFunctionCodes.WriteMultipleCoils: lambda client, payload, count: \
+        client.write_coils(payload['StartAddress'], payload['Data'], unit=payload['UnitID']),
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: lambda client, payload, count: \
+        client.write_registers(payload['StartAddress'], payload['Data'], unit=payload['UnitID']),
+    ModbusFunctionCodes.MaskWriteRegister: lambda client, payload, count: \
+        client.mask_write_register(address=payload['StartAddress'], \
+            and_mask=payload['AndMask'], or_mask=payload['OrMask'], unit=payload['UnitID']),
+    ModbusFunctionCodes.ReadWriteMultipleRegisters: lambda client, payload, count: \
+        client.readwrite_registers(read_address=payload['StartAddress'], read_count=count, \
+            write_address=payload['WriteAddress'], write_registers=payload['Data'], \
+            unit=payload['UnitID'])
+}
+
+#Extracts the Data of the response to each supported function code
+RESPONSE_DATA = {
+    ModbusFunctionCodes.ReadCoil: lambda response, count: response.bits[0:count],
+    ModbusFunctionCodes.ReadDiscreteInput: lambda response, count: response.bits[0:count],
+    ModbusFunctionCodes.ReadHoldingRegisters: lambda response, count: \
+        response.registers[0:count],
+    ModbusFunctionCodes.ReadInputRegisters: lambda response, count: response.registers[0:count],
+    ModbusFunctionCodes.WriteSingleCoil: lambda response, count: response.value,
+    ModbusFunctionCodes.WriteSingleHoldingRegister: lambda response, count: response.value,
+    ModbusFunctionCodes.WriteMultipleCoils: lambda response, count: response.count,
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: lambda response, count: response.count,
+    ModbusFunctionCodes.MaskWriteRegister: lambda response, count: \
+        [response.and_mask, response.or_mask],
+    ModbusFunctionCodes.ReadWriteMultipleRegisters: lambda response, count: \
+        response.registers[0:count]
+}
+
+#The payload parameters each function code requires, besides ModbusHost, FunctionCode, UnitID
+#and StartAddress
+REQUIRED_PARAMETERS = {
+    ModbusFunctionCodes.WriteSingleCoil: ('Data', 'AddressCount'),
+    ModbusFunctionCodes.WriteSingleHoldingRegister: ('Data', 'AddressCount'),
+    ModbusFunctionCodes.WriteMultipleCoils: ('Data', 'AddressCount'),
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: ('Data', 'AddressCount'),
+    ModbusFunctionCodes.MaskWriteRegister: ('AndMask', 'OrMask'),
+    ModbusFunctionCodes.ReadWriteMultipleRegisters: ('Data', 'WriteAddress', 'AddressCount')
+}
+
+def send_request(client, payload, count):
+    ''' Issues the pymodbus client call for a request
+
+    :param client: A synchronous or Twisted pymodbus client
+    :param payload: The validated Modbus request
+    :param count: The number of values to read
+
+    :returns: The pymodbus response, or a deferred fired with it for Twisted clients
+    '''
+    request = MODBUS_REQUESTS.get(payload['FunctionCode'])
+    if request is None:
+        raise ValueError("Invalid Modbus function code " + str(payload['FunctionCode']))
+
+    return request(client, payload, count)
+
+def extract_response(payload, response, count):
+    ''' Converts a pymodbus response into the adapter's response dictionary
+
+    :param payload: The Modbus request the response answers
+    :param response: The pymodbus response
+    :param count: The number of values requested
+
+    :returns: A dictionary containing either 'Data', or 'error' and 'exception' if the device
+              answered with a Modbus exception response or no response was received
+    '''
+    #Some pymodbus versions return, rather than raise, the exception of a failed transaction
+    if isinstance(response, ModbusException):
+        return {'error': "Modbus Exception: " + str(response), \
+            'exception': response.__class__.__name__}
+
+    if hasattr(response, 'exception_code'):
+        return {'error': "Modbus Exception Response: exception code " + \
+            str(response.exception_code), 'exception': 'ExceptionResponse'}
+
+    return {'Data': RESPONSE_DATA[payload['FunctionCode']](response, count)}
+
+def record_connect(host, started, connected):
+    ''' Records the time taken to open a connection to a Modbus host
+
+    :param host: The Modbus host
+    :param started: The time the connection attempt started
+    :param connected: False if the connection could not be opened
+    '''
+    CONNECT_SECONDS.observe(time.time() - started, (str(host),))
+    if not connected:
+        CONNECT_FAILURES.increment((str(host),))
+
+def record_transaction(payload, started, response):
+    ''' Records the time taken by a Modbus request and the exception it failed with, if any
+
+    :param payload: The Modbus request
+    :param started: The time the request was sent
+    :param response: The response dictionary returned for the request
+    '''
+    host = str(payload['ModbusHost'])
+    unit_id = str(payload['UnitID'])
+    TRANSACT_SECONDS.observe(time.time() - started, (host, unit_id, str(payload['FunctionCode'])))
+    if response.get('exception') is not None:
+        REQUEST_EXCEPTIONS.increment((host, unit_id, response['exception']))
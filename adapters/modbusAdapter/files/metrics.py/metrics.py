@@ -0,0 +1,266 @@
+'''
+cbModbus metrics
+-----------------
+
+Lightweight counters and latency histograms describing where the adapters spend their time.
+Metrics are rendered in the Prometheus text exposition format by a small HTTP endpoint, and as a
+dictionary for periodic MQTT stats messages.
+
+Recording a value costs a dictionary lookup and an uncontended lock, so metrics are always
+collected. Only the endpoint and the stats messages are optional.
+'''
+import json
+import logging
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+#The upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, \
+    10.0)
+
+METRIC_TYPES = {
+    'COUNTER': "counter",
+    'GAUGE': "gauge",
+    'HISTOGRAM': "histogram"
+}
+
+class Metric(object):
+    ''' A named metric with one value, or one histogram, per combination of label values
+
+    :param name: The metric name
+    :param kind: One of METRIC_TYPES
+    :param description: The help text of the metric
+    :param label_names: The names of the labels the metric is keyed by
+    :param buckets: The histogram bucket upper bounds
+    '''
+
+    def __init__(self, name, kind, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+
+        #label values -> value, or [bucket counts, sum, count] for histograms
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def increment(self, labels=(), amount=1):
+        ''' Adds amount to a counter or gauge
+
+        :param labels: The label values, in the order of label_names
+        :param amount: The amount to add
+        '''
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value, labels=()):
+        ''' Sets the value of a gauge
+
+        :param value: The new value
+        :param labels: The label values, in the order of label_names
+        '''
+        with self._lock:
+            self._values[tuple(labels)] = value
+
+    def observe(self, value, labels=()):
+        ''' Records a value in a histogram
+
+        :param value: The value observed, typically a duration in seconds
+        :param labels: The label values, in the order of label_names
+        '''
+        labels = tuple(labels)
+        with self._lock:
+            histogram = self._values.get(labels)
+            if histogram is None:
+                histogram = [[0] * len(self.buckets), 0.0, 0]
+                self._values[labels] = histogram
+
+            for ndx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][ndx] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self, lines):
+        ''' Appends the Prometheus text exposition of the metric to lines '''
+        lines.append("# HELP %s %s" % (self.name, self.description))
+        lines.append("# TYPE %s %s" % (self.name, self.kind))
+
+        with self._lock:
+            values = [(labels, value if self.kind != METRIC_TYPES['HISTOGRAM'] else \
+                (list(value[0]), value[1], value[2])) for labels, value in self._values.items()]
+
+        for labels, value in sorted(values):
+            if self.kind != METRIC_TYPES['HISTOGRAM']:
+                lines.append("%s%s %s" % (self.name, self._format_labels(labels), value))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(self.buckets, value[0]):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, \
+                    self._format_labels(labels, ('le', repr(bound))), cumulative))
+            lines.append("%s_bucket%s %d" % (self.name, \
+                self._format_labels(labels, ('le', "+Inf")), value[2]))
+            lines.append("%s_sum%s %s" % (self.name, self._format_labels(labels), \
+                repr(value[1])))
+            lines.append("%s_count%s %d" % (self.name, self._format_labels(labels), value[2]))
+
+    def snapshot(self):
+        ''' Returns an array of dictionaries describing every label combination of the metric '''
+        with self._lock:
+            items = list(self._values.items())
+
+        snapshot = []
+        for labels, value in items:
+            entry = {'labels': dict(zip(self.label_names, labels))}
+            if self.kind == METRIC_TYPES['HISTOGRAM']:
+                entry['count'] = value[2]
+                entry['sum'] = value[1]
+                entry['buckets'] = dict(zip([repr(bound) for bound in self.buckets], value[0]))
+            else:
+                entry['value'] = value
+            snapshot.append(entry)
+
+        return snapshot
+
+    def _format_labels(self, labels, extra=None):
+        ''' Formats label values as a Prometheus label set '''
+        pairs = list(zip(self.label_names, labels))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace( \
+            '"', '\\"')) for name, value in pairs]) + "}"
+
+class MetricsRegistry(object):
+    ''' The set of metrics exposed by an adapter '''
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, description, label_names=()):
+        ''' Returns the counter with the given name, creating it if needed '''
+        return self._register(name, METRIC_TYPES['COUNTER'], description, label_names)
+
+    def gauge(self, name, description, label_names=()):
+        ''' Returns the gauge with the given name, creating it if needed '''
+        return self._register(name, METRIC_TYPES['GAUGE'], description, label_names)
+
+    def histogram(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        ''' Returns the histogram with the given name, creating it if needed '''
+        return self._register(name, METRIC_TYPES['HISTOGRAM'], description, label_names, \
+            buckets)
+
+    def on_collect(self, collector):
+        ''' Registers a callable invoked before the metrics are rendered or snapshotted, to set
+        gauges whose values are sampled rather than recorded as they change '''
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        ''' Returns every metric in the Prometheus text exposition format '''
+        self._collect()
+        lines = []
+        for metric in list(self._metrics):
+            metric.render(lines)
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        ''' Returns a dictionary of metric name -> metric snapshot '''
+        self._collect()
+        return dict([(metric.name, metric.snapshot()) for metric in list(self._metrics)])
+
+    def _collect(self):
+        ''' Invokes the registered collectors '''
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as exc:
+                logging.error("Unable to collect metrics: %s", str(exc))
+
+    def _register(self, name, kind, description, label_names, buckets=LATENCY_BUCKETS):
+        ''' Returns the metric with the given name, creating it if needed '''
+        with self._lock:
+            for metric in self._metrics:
+                if metric.name == name:
+                    return metric
+
+            metric = Metric(name, kind, description, label_names, buckets)
+            self._metrics.append(metric)
+            return metric
+
+#The metrics of the running adapter
+METRICS = MetricsRegistry()
+
+def start_metrics_server(registry, port, address=""):
+    ''' Serves the Prometheus text exposition of the registry on http://address:port/metrics
+
+    :param registry: The MetricsRegistry to expose
+    :param port: The port to listen on
+    :param address: The interface to listen on, all interfaces by default
+
+    :returns: The running HTTPServer
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        ''' Answers scrape requests '''
+
+        def do_GET(self):
+            ''' Returns the rendered metrics '''
+            if self.path.split('?')[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            ''' Logs scrapes at debug level rather than to stderr '''
+            logging.debug("Metrics request: " + format, *args)
+
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer")
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving metrics on port %d", port)
+
+    return server
+
+def publish_stats_periodically(registry, publish, interval, stop_event, extra=None):
+    ''' Publishes a JSON snapshot of the registry every interval seconds
+
+    :param registry: The MetricsRegistry to publish
+    :param publish: Invoked with the JSON encoded stats message
+    :param interval: The number of seconds between messages
+    :param stop_event: A threading.Event that ends publishing once set
+    :param extra: An optional dictionary of fields added to every message
+    '''
+    def run():
+        ''' Publishes stats until stop_event is set '''
+        while not stop_event.wait(interval):
+            message = dict(extra or {})
+            message['metrics'] = registry.snapshot()
+            try:
+                publish(json.dumps(message))
+            except Exception as exc:
+                logging.error("Unable to publish stats: %s", str(exc))
+
+    thread = threading.Thread(target=run, name="StatsPublisher")
+    thread.daemon = True
+    thread.start()
@@ -4,13 +4,27 @@ import argparse
 import logging
 import os
 import json
+import signal
+import threading
+import time
 from clearblade.ClearBladeCore import System, Query
 from clearblade.ClearBladeCore import cbLogs
 
 import mqtt
 from constants import ModbusFunctionCodes
+from batch import ModbusBatch
+from cache import ReadCache
+from coalesce import ReadCoalescer
+from dispatcher import OVERFLOW_POLICIES, RequestDispatcher
+from encoding import ENCODINGS, available_encodings, decode_request, encode_message, \
+    encoded_topic, topic_encoding
+from functions import MODBUS_REQUESTS, REQUIRED_PARAMETERS, extract_response, \
+    record_transaction, send_request
+from metrics import METRICS, publish_stats_periodically, start_metrics_server
+from outbox import Outbox, RingBuffer
+from pool import ModbusClientPool
+from scheduler import ScanScheduler
 
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 from pymodbus.constants import Defaults
 from pymodbus.exceptions import ConnectionException, ModbusException, \
     ModbusIOException, ParameterException, NoSuchSlaveException, InvalidMessageRecievedException
@@ -20,9 +34,25 @@ CB_CONFIG = {}
 
 SCOPE_VARS = {
     'MQTT_CONNECTED': False,
-    'EXIT_APP': False
+    'EXIT_APP': threading.Event(),
+    'CLIENT_POOL': None,
+    'ENGINE': None,
+    'DISPATCHER': None,
+    'COALESCER': None,
+    'READ_CACHE': None,
+    'SCHEDULER': None,
+    'OUTBOX': None
 }
 
+#The adapter settings column holding the scan lists polled by the adapter
+SCAN_LIST_COLUMN = "scan_list"
+
+REQUEST_SECONDS = METRICS.histogram("modbus_client_request_seconds", \
+    "Time from receiving Modbus requests to their results being available, including queueing", \
+    ('host', 'unit_id', 'function_code'))
+QUEUE_DEPTH = METRICS.gauge("modbus_client_queue_depth", \
+    "Modbus requests waiting for a worker thread, or awaiting a response from the engine")
+
 def parse_args(argv):
     """Parse the command line arguments"""
 
@@ -104,6 +134,106 @@ def parse_args(argv):
     parser.add_argument('--logMQTT', dest="logMQTT", default=False, action='store_true',\
                         help='Flag presence indicates MQTT logs should be printed.')
 
+    parser.add_argument('--maxConnectionsPerHost', dest="maxConnectionsPerHost", default=1, \
+                        type=int, help='The maximum number of TCP connections the adapter keeps \
+                        open to a single Modbus host and port. The default is 1.')
+
+    parser.add_argument('--connectionIdleTimeout', dest="connectionIdleTimeout", default=60, \
+                        type=float, help='The number of seconds an unused Modbus TCP connection \
+                        is kept open. The default is 60.')
+
+    parser.add_argument('--asyncEngine', dest="asyncEngine", default=False, action='store_true',\
+                        help='Flag presence indicates Modbus requests should be executed \
+                        asynchronously, so requests to different Modbus hosts are in flight at \
+                        the same time.')
+
+    parser.add_argument('--requestTimeout', dest="requestTimeout", default=5.0, type=float, \
+                        help='The number of seconds an asynchronously executed Modbus request may \
+                        take before an error is published. The default is 5.')
+
+    parser.add_argument('--workerThreads', dest="workerThreads", default=8, type=int, \
+                        help='The number of threads executing Modbus requests, so the MQTT network \
+                        loop is never blocked by Modbus I/O. 0 executes requests on the MQTT \
+                        network thread. The default is 8.')
+
+    parser.add_argument('--maxQueuedRequests', dest="maxQueuedRequests", default=1000, type=int, \
+                        help='The maximum number of Modbus requests waiting for a worker thread. \
+                        The default is 1000.')
+
+    parser.add_argument('--queueOverflowPolicy', dest="queueOverflowPolicy", \
+                        default=OVERFLOW_POLICIES['REJECT'], \
+                        choices=list(OVERFLOW_POLICIES.values()), help='What to do with a Modbus \
+                        request received while the request queue is full: publish an error for \
+                        it (reject), publish an error for the oldest queued request and queue the \
+                        new one (drop_oldest), or wait for room (block). The default is reject.')
+
+    parser.add_argument('--queueBlockTimeout', dest="queueBlockTimeout", default=1.0, \
+                        type=float, help='With the block queue overflow policy, the number of \
+                        seconds a Modbus request waits for room in the request queue before an \
+                        error is published for it. The MQTT network thread waits with it, so \
+                        this should stay well below the broker keep alive. The default is 1.')
+
+    parser.add_argument('--coalesceWindow', dest="coalesceWindow", default=0, type=float, \
+                        help='The number of seconds a Modbus read waits for other reads of the \
+                        same host, unit and function code it can be merged with. The default is \
+                        0, which disables read coalescing.')
+
+    parser.add_argument('--coalesceGap', dest="coalesceGap", default=0, type=int, \
+                        help='The maximum number of unrequested addresses a coalesced read may \
+                        span between two requested ranges. The default is 0.')
+
+    parser.add_argument('--readCacheTTL', dest="readCacheTTL", default=0, type=float, \
+                        help='The number of seconds the response to a Modbus read is reused for \
+                        identical reads. Identical reads in flight at the same time always share \
+                        a single request while the cache is enabled. The default is 0, which \
+                        disables the read cache.')
+
+    parser.add_argument('--readCacheSize', dest="readCacheSize", default=1000, type=int, \
+                        help='The maximum number of Modbus read responses cached. The default is \
+                        1000.')
+
+    parser.add_argument('--scanTimeout', dest="scanTimeout", default=30.0, type=float, \
+                        help='The number of seconds a scan list poll may take before it is \
+                        reported as failed and the entry is polled again. The default is 30.')
+
+    parser.add_argument('--msgpackTopics', dest="msgpackTopics", default=False, \
+                        action='store_true', help='Flag presence indicates msgpack encoded Modbus \
+                        requests should also be accepted, on the request topic suffixed with \
+                        /msgpack. Their responses are published msgpack encoded, with register \
+                        data packed as 16 bit values. Requires the msgpack package.')
+
+    parser.add_argument('--shutdownTimeout', dest="shutdownTimeout", default=10, type=float, \
+                        help='The maximum number of seconds spent completing in-flight Modbus \
+                        requests when the adapter is stopped. The default is 10.')
+
+    parser.add_argument('--metricsPort', dest="metricsPort", default=0, type=int, \
+                        help='The HTTP port per-device latency, error and queue depth metrics are \
+                        served on, in the Prometheus text format, at /metrics. The default is 0, \
+                        which disables the endpoint.')
+
+    parser.add_argument('--statsInterval', dest="statsInterval", default=0, type=float, \
+                        help='The number of seconds between publishes of the adapter metrics to \
+                        the modbus/client/stats topic below the topic root. The default is 0, \
+                        which disables publishing.')
+
+    parser.add_argument('--outboxFile', dest="outboxFile", default="", \
+                        help='The file Modbus responses, errors and scan data are stored in while \
+                        the adapter is disconnected from the message broker, to be published in \
+                        order once it reconnects. Stored messages survive restarts of the adapter. \
+                        The default is an empty string, which disables storing messages.')
+
+    parser.add_argument('--outboxSize', dest="outboxSize", default=16777216, type=int, \
+                        help='The number of bytes of messages the outbox file holds. The oldest \
+                        messages are discarded once it is full. The default is 16777216.')
+
+    parser.add_argument('--outboxBatchSize', dest="outboxBatchSize", default=100, type=int, \
+                        help='The number of stored messages published at a time once the adapter \
+                        reconnects. The default is 100.')
+
+    parser.add_argument('--outboxBatchInterval', dest="outboxBatchInterval", default=0.1, \
+                        type=float, help='The number of seconds between batches of stored \
+                        messages published once the adapter reconnects. The default is 0.1.')
+
     return vars(parser.parse_args(args=argv[1:]))
 
 
@@ -138,12 +268,43 @@ def get_adapter_config():
 
     rows = collection.getItems(the_query)
 
-    # Iterate through rows and display them
+    scans = []
     for row in rows:
-        #TODO - Implement implementation specific logic
         logging.debug(row)
 
+        scan_list = row.get(SCAN_LIST_COLUMN)
+        if scan_list is None or scan_list == "":
+            continue
+        if not isinstance(scan_list, list):
+            scan_list = json.loads(scan_list)
+
+        for entry in scan_list:
+            error = check_scan_entry(entry)
+            if error is not None:
+                logging.error("Ignoring scan list entry %s: %s", entry, error)
+            else:
+                scans.append(entry)
+
     logging.debug("End get_adapter_config")
+    return scans
+
+
+def check_scan_entry(entry):
+    """Validate a scan list entry. Return a description of the problem if it is not valid."""
+    error = check_modbus_request(entry)
+    if error is not None:
+        return error
+
+    if entry['FunctionCode'] not in (ModbusFunctionCodes.ReadCoil, \
+        ModbusFunctionCodes.ReadDiscreteInput, ModbusFunctionCodes.ReadHoldingRegisters, \
+        ModbusFunctionCodes.ReadInputRegisters):
+        return "Scan list entries must use a read function code."
+
+    interval = entry.get('Interval')
+    if interval is None or interval == "" or interval <= 0:
+        return "Scan interval not specified or invalid."
+
+    return None
 
 
 #########################
@@ -156,15 +317,16 @@ def on_connect(mqtt_client, userdata, flags, result_code):
         logging.info("Connected to ClearBlade Platform MQTT broker")
         SCOPE_VARS['MQTT_CONNECTED'] = True
 
-        logging.info("Subscribing to MQTT topics")
+        if SCOPE_VARS['OUTBOX'] is not None:
+            SCOPE_VARS['OUTBOX'].connected(mqtt_client)
 
-        the_topic = mqtt.create_topic(CB_CONFIG['adapterTopicRoot'],\
-            mqtt.MODBUS_CLIENT_TOPICS['MODBUS_REQUEST'])
+        logging.info("Subscribing to MQTT topics")
 
-        logging.debug("Subscribing to topic %s", the_topic)
+        for the_topic in request_topics():
+            logging.debug("Subscribing to topic %s", the_topic)
 
-        mqtt_client.subscribe(the_topic)
-        mqtt_client.message_callback_add(the_topic, handle_modbus_request)
+            mqtt_client.subscribe(the_topic)
+            mqtt_client.message_callback_add(the_topic, handle_modbus_request)
 
     else:
         logging.error("Error while connecting to ClearBlade Platform message broker: \
@@ -174,7 +336,7 @@ def on_connect(mqtt_client, userdata, flags, result_code):
         #MQTT will keep trying to connect for us
         if result_code != 3:
             logging.fatal("Unable to connect to mqtt. ResultCode = %s", result_code)
-            SCOPE_VARS['EXIT_APP'] = True
+            SCOPE_VARS['EXIT_APP'].set()
 
     logging.debug("End on_connect")
 
@@ -183,14 +345,18 @@ def on_disconnect(mqtt_client, userdata, result_code):
     logging.debug("Begin on_disconnect")
     SCOPE_VARS['MQTT_CONNECTED'] = False
 
+    if SCOPE_VARS['OUTBOX'] is not None:
+        SCOPE_VARS['OUTBOX'].disconnected()
+
     if result_code != 0:
         logging.warning("Connection to CB Platform MQTT broker was lost, result code = %s", \
                         result_code)
 
         #rc 3 = Server unavailable. If rc = 3, we don't need to do anything.
-        #MQTT will keep trying to connect for us
-        if result_code != 3:
-            SCOPE_VARS['EXIT_APP'] = True
+        #MQTT will keep trying to connect for us. With an outbox, the adapter keeps running
+        #through any outage and stores what it publishes until then.
+        if result_code != 3 and SCOPE_VARS['OUTBOX'] is None:
+            SCOPE_VARS['EXIT_APP'].set()
 
     logging.debug("End on_disconnect")
 
@@ -200,6 +366,88 @@ def on_disconnect(mqtt_client, userdata, result_code):
 #END MQTT CALLBACKS
 #########################
 
+def request_topics():
+    """Return the topics Modbus requests are received on, one per enabled encoding"""
+    encodings = [ENCODINGS['JSON']]
+    if CB_CONFIG['msgpackTopics']:
+        encodings.append(ENCODINGS['MSGPACK'])
+
+    return [mqtt.create_topic(CB_CONFIG['adapterTopicRoot'], \
+        encoded_topic(mqtt.MODBUS_CLIENT_TOPICS['MODBUS_REQUEST'], encoding)) \
+        for encoding in encodings]
+
+
+def start_request_execution():
+    """Create the connection pool, execution mode, read cache and read coalescer selected by the
+    command line arguments"""
+    SCOPE_VARS['CLIENT_POOL'] = ModbusClientPool(max_per_host=CB_CONFIG['maxConnectionsPerHost'], \
+        idle_timeout=CB_CONFIG['connectionIdleTimeout'])
+
+    if CB_CONFIG['asyncEngine']:
+        #Imported here so Twisted is only required when the engine is used
+        from engine import ModbusEngine
+        SCOPE_VARS['ENGINE'] = ModbusEngine(timeout=CB_CONFIG['requestTimeout'], \
+            max_in_flight_per_host=CB_CONFIG['maxConnectionsPerHost'])
+        SCOPE_VARS['ENGINE'].start()
+    elif CB_CONFIG['workerThreads'] > 0:
+        SCOPE_VARS['DISPATCHER'] = RequestDispatcher(workers=CB_CONFIG['workerThreads'], \
+            max_queued=CB_CONFIG['maxQueuedRequests'], \
+            per_host=CB_CONFIG['maxConnectionsPerHost'], \
+            overflow=CB_CONFIG['queueOverflowPolicy'], \
+            block_timeout=CB_CONFIG['queueBlockTimeout'])
+
+    if CB_CONFIG['readCacheTTL'] > 0:
+        SCOPE_VARS['READ_CACHE'] = ReadCache(CB_CONFIG['readCacheTTL'], \
+            max_entries=CB_CONFIG['readCacheSize'])
+
+    if CB_CONFIG['coalesceWindow'] > 0:
+        SCOPE_VARS['COALESCER'] = ReadCoalescer(dispatch_modbus_request, \
+            window=CB_CONFIG['coalesceWindow'], max_gap=CB_CONFIG['coalesceGap'])
+
+
+def open_outbox():
+    """Store the messages published while disconnected from the message broker in the outbox file
+    selected by the command line arguments"""
+    logging.info("Opening the outbox %s", CB_CONFIG['outboxFile'])
+    buffer = RingBuffer(CB_CONFIG['outboxFile'], CB_CONFIG['outboxSize'])
+    if buffer.count > 0:
+        logging.info("Outbox holds %d messages from a previous run", buffer.count)
+
+    SCOPE_VARS['OUTBOX'] = Outbox(buffer, batch_size=CB_CONFIG['outboxBatchSize'], \
+        batch_interval=CB_CONFIG['outboxBatchInterval'])
+    mqtt.MQTT_SETTINGS['OUTBOX'] = SCOPE_VARS['OUTBOX']
+
+
+def shutdown(mqtt_client, timeout):
+    """Stop accepting Modbus requests, complete the requests in flight within timeout seconds and
+    disconnect from the message broker"""
+    logging.info("Stopping the adapter")
+    deadline = time.time() + timeout
+
+    for the_topic in request_topics():
+        mqtt_client.unsubscribe(the_topic)
+    if SCOPE_VARS['SCHEDULER'] is not None:
+        SCOPE_VARS['SCHEDULER'].stop()
+
+    #Send any held reads before draining the execution mode they were handed to
+    if SCOPE_VARS['COALESCER'] is not None:
+        SCOPE_VARS['COALESCER'].stop()
+    if SCOPE_VARS['DISPATCHER'] is not None:
+        SCOPE_VARS['DISPATCHER'].stop(max(0, deadline - time.time()))
+    if SCOPE_VARS['ENGINE'] is not None:
+        SCOPE_VARS['ENGINE'].drain(max(0, deadline - time.time()))
+        SCOPE_VARS['ENGINE'].stop(max(0, deadline - time.time()))
+    SCOPE_VARS['CLIENT_POOL'].close_all()
+
+    #Messages not yet published stay in the outbox file for the next run
+    if SCOPE_VARS['OUTBOX'] is not None:
+        mqtt.MQTT_SETTINGS['OUTBOX'] = None
+        SCOPE_VARS['OUTBOX'].close()
+
+    mqtt_client.disconnect()
+    logging.info("Adapter stopped")
+
+
 def handle_modbus_request(mqtt_client, userdata, message):
     """Process the modbus request"""
     logging.debug("In handle_modbus_request")
@@ -214,53 +462,142 @@ def handle_modbus_request(mqtt_client, userdata, message):
     # }
 
     logging.debug("message payload = %s", message.payload)
-    payload = json.loads(message.payload.replace("'", '"'))
-
-    if validate_modbus_request(mqtt_client, payload):
-        modbus_port = payload.get('ModbusPort')
-        if modbus_port is None or modbus_port == "":
-            logging.info("Modbus port not specified. Defaulting port to %s", Defaults.Port)
-            modbus_port = Defaults.Port
-
-        if payload['FunctionCode'] == ModbusFunctionCodes.ReadCoil or \
-            payload['FunctionCode'] == ModbusFunctionCodes.ReadDiscreteInput or \
-            payload['FunctionCode'] == ModbusFunctionCodes.ReadHoldingRegisters or \
-            payload['FunctionCode'] == ModbusFunctionCodes.ReadInputRegisters or \
-            payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleCoil or \
-            payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleHoldingRegister or \
-            payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleCoils or \
-            payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
-
-            #Create a Modbus client and send the modbus request
-            client = ModbusClient(payload['ModbusHost'], modbus_port)
-            client.connect()
-
-            #Send the modbus request
-            response = send_modbus_request(client, payload)
-
-            logging.debug("response = %s", response)
-
-            # close the client
-            client.close()
-
-            if response is not None and response.get('error') is None:
-                # Publish the modbus response
-                logging.debug("respData = %s", response)
-                mqtt.publish_modbus_response(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
-                    create_modbus_response(payload, response))
-            else:
-                mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
-                    create_modbus_error(payload, response.get('error')))
-        else:
-            mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
-                create_modbus_error(payload, \
-                    "Invalid Modbus function code specified. Unable to process Modbus command."))
+    encoding = topic_encoding(message.topic)
+    payload = decode_request(message.payload, encoding)
+
+    if isinstance(payload, list):
+        handle_modbus_batch(mqtt_client, payload, encoding)
+    elif validate_modbus_request(mqtt_client, payload, encoding):
+        submit_modbus_request(payload, \
+            lambda response: publish_modbus_result(mqtt_client, payload, response, encoding))
 
     logging.debug("Exit handle_modbus_request")
 
 
-def validate_modbus_request(mqtt_client, payload):
+def handle_modbus_batch(mqtt_client, commands, encoding=ENCODINGS['JSON']):
+    """Process an array of modbus requests and publish a single aggregated response"""
+    logging.debug("In handle_modbus_batch")
+    logging.debug("Processing batch of %d Modbus commands", len(commands))
+
+    batch = ModbusBatch(commands, lambda results: mqtt.publish_modbus_response(mqtt_client, \
+        CB_CONFIG['adapterTopicRoot'], encode_message({"results": results}, encoding), encoding))
+
+    for ndx, command in enumerate(commands):
+        error = check_modbus_request(command)
+        if error is not None:
+            batch.complete(ndx, {'error': error})
+        else:
+            submit_modbus_request(command, lambda response, ndx=ndx: batch.complete(ndx, response))
+
+    logging.debug("Exit handle_modbus_batch")
+
+
+def submit_modbus_request(payload, on_result):
+    """Execute a validated modbus request, passing the response or error to on_result"""
+    modbus_port = payload.get('ModbusPort')
+    if modbus_port is None or modbus_port == "":
+        logging.info("Modbus port not specified. Defaulting port to %s", Defaults.Port)
+        modbus_port = Defaults.Port
+
+    started = time.time()
+    labels = (str(payload['ModbusHost']), str(payload['UnitID']), str(payload['FunctionCode']))
+    on_request_result = on_result
+
+    def on_result(response):
+        #Record the time taken by the request, whichever path it takes, before passing on its result
+        REQUEST_SECONDS.observe(time.time() - started, labels)
+        on_request_result(response)
+
+    cache = SCOPE_VARS['READ_CACHE']
+    if cache is not None and cache.accepts(payload):
+        cache.read(payload, modbus_port, on_result, \
+            lambda on_read: route_modbus_request(payload, modbus_port, on_read))
+    elif cache is not None:
+        def on_write(response):
+            #Invalidate again once the write completes, since a read sent while the write was
+            #in flight may have returned the old values
+            cache.invalidate(payload, modbus_port)
+            on_result(response)
+
+        cache.invalidate(payload, modbus_port)
+        route_modbus_request(payload, modbus_port, on_write)
+    else:
+        route_modbus_request(payload, modbus_port, on_result)
+
+
+def route_modbus_request(payload, modbus_port, on_result):
+    """Send a modbus request to the coalescer or straight to the execution mode"""
+    if SCOPE_VARS['COALESCER'] is not None and SCOPE_VARS['COALESCER'].accepts(payload):
+        #Hold the read briefly so it can be merged with reads of nearby addresses
+        SCOPE_VARS['COALESCER'].add(payload, modbus_port, on_result)
+    else:
+        dispatch_modbus_request(payload, modbus_port, on_result)
+
+
+def dispatch_modbus_request(payload, modbus_port, on_result):
+    """Hand a modbus request to the configured execution mode"""
+    if SCOPE_VARS['ENGINE'] is not None:
+        #Hand the request to the asynchronous engine, which reports the result once the Modbus
+        #host responds
+        SCOPE_VARS['ENGINE'].submit(payload, modbus_port, on_result)
+    elif SCOPE_VARS['DISPATCHER'] is not None:
+        #Queue the request for a worker thread so the MQTT network loop is not blocked
+        SCOPE_VARS['DISPATCHER'].dispatch((payload['ModbusHost'], modbus_port), \
+            lambda: on_result(execute_modbus_request(payload, modbus_port)), \
+            lambda reason: on_result({'error': reason}))
+    else:
+        try:
+            response = execute_modbus_request(payload, modbus_port)
+        except Exception as exc:
+            logging.error("Error while executing Modbus request: %s", str(exc))
+            response = {'error': "Error while executing Modbus request: " + str(exc)}
+        on_result(response)
+
+
+def queued_modbus_requests():
+    """Return the number of Modbus requests waiting to be executed"""
+    if SCOPE_VARS['ENGINE'] is not None:
+        return SCOPE_VARS['ENGINE'].queue_depth()
+    if SCOPE_VARS['DISPATCHER'] is not None:
+        return SCOPE_VARS['DISPATCHER'].queue_depth()
+    return 0
+
+
+def publish_scan_changes(mqtt_client, request, changes):
+    """Publish the values that changed since a scan list entry was last polled"""
+    mqtt.publish_modbus_scan_data(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
+        json.dumps({"request": request, "changes": changes}))
+
+
+def publish_modbus_result(mqtt_client, payload, response, encoding=ENCODINGS['JSON']):
+    """Publish the response or error returned for a modbus request"""
+    logging.debug("response = %s", response)
+
+    if response is not None and response.get('error') is None:
+        # Publish the modbus response
+        logging.debug("respData = %s", response)
+        mqtt.publish_modbus_response(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
+            create_modbus_response(payload, response, encoding), encoding)
+    else:
+        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
+            create_modbus_error(payload, response.get('error'), encoding), encoding)
+
+
+def validate_modbus_request(mqtt_client, payload, encoding=ENCODINGS['JSON']):
     """Validate the modbus request. Publish any errors if the request is not valid."""
+    logging.debug("In validate_modbus_request")
+
+    error = check_modbus_request(payload)
+    if error is not None:
+        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], create_modbus_error(\
+            payload, error, encoding), encoding)
+        return False
+
+    logging.debug("Exit validate_modbus_request, returning True")
+    return True
+
+def check_modbus_request(payload):
+    """Validate the modbus request. Return a description of the problem if it is not valid."""
     #{
     #   'ModbusHost': 'localhost',
     #   'ModbusPort': 5023,
@@ -271,68 +608,92 @@ def validate_modbus_request(mqtt_client, payload):
     #   'Data': [2, 3, 4]
     # }
 
-    logging.debug("In validate_modbus_request")
+    logging.debug("In check_modbus_request")
+
+    if not isinstance(payload, dict):
+        logging.debug("Invalid Modbus command")
+        return "Modbus command is not an object. Unable to process Modbus command."
 
     #Validate the ModbusHost value
     modbus_host = payload.get('ModbusHost')
     if modbus_host is None or modbus_host == "":
         logging.debug("Invalid ModbusHost")
-        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], create_modbus_error(\
-            payload, "Modbus host not specified. Unable to process Modbus command."))
-        return False
+        return "Modbus host not specified. Unable to process Modbus command."
 
     #Validate the FunctionCode value
     func_code = payload.get('FunctionCode')
     if func_code is None or func_code == "":
         logging.debug("Invalid Modbus FunctionCode")
-        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], create_modbus_error(\
-            payload, "Modbus function code not specified. Unable to process Modbus command."))
-        return False
+        return "Modbus function code not specified. Unable to process Modbus command."
 
     #Validate the UnitID value
     unit_id = payload.get('UnitID')
     if unit_id is None or unit_id == "":
         logging.debug("Invalid Modbus UnitID")
-        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], create_modbus_error(\
-            payload, "Modbus Unit ID not specified. Unable to process Modbus command."))
-        return False
+        return "Modbus Unit ID not specified. Unable to process Modbus command."
 
     #Validate the StartAddress value
     start_addr = payload.get('StartAddress')
     if start_addr is None or start_addr == "":
         logging.debug("Invalid Modbus StartAddress")
-        mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], create_modbus_error(\
-            payload, "Modbus StartAddress not specified. Unable to process Modbus command."))
-        return False
+        return "Modbus StartAddress not specified. Unable to process Modbus command."
 
-    #Check if a data parameter was specified for write operations
-    if payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleCoil or \
-        payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleHoldingRegister or \
-        payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleCoils or \
-        payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
+    if payload['FunctionCode'] not in MODBUS_REQUESTS:
+        logging.debug("Invalid Modbus FunctionCode")
+        return "Invalid Modbus function code specified. Unable to process Modbus command."
+
+    required = REQUIRED_PARAMETERS.get(payload['FunctionCode'], ())
 
+    #Check if a data parameter was specified for write operations
+    if 'Data' in required:
         data = payload.get('Data')
         if data is None or data == "" or len(data) == 0:
             logging.debug("Invalid Modbus Data")
-            mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
-                create_modbus_error(\
-                payload, "Modbus Data not specified. Unable to process Modbus command."))
-            return False
-        else:
-            # Validate the address count length for the write operations
-            # The count length must be specified if the data array length is greater than 1
-            addr_count = payload.get('AddressCount')
-            if (len(data) > 0 and addr_count != len(data)) or addr_count is None or \
-            addr_count == "":
-                logging.debug("Invalid Modbus AddressCount")
-                mqtt.publish_modbus_error(mqtt_client, CB_CONFIG['adapterTopicRoot'], \
-                    create_modbus_error(\
-                    payload, "Modbus address count not specified or invalid. \
-                        Unable to process Modbus command."))
-                return False
+            return "Modbus Data not specified. Unable to process Modbus command."
+
+        # Validate the address count length for the write operations
+        # The count length must be specified if the data array length is greater than 1.
+        # The address count of a read/write request is the number of registers read instead.
+        addr_count = payload.get('AddressCount')
+        if addr_count is None or addr_count == "" or (addr_count != len(data) and \
+            payload['FunctionCode'] != ModbusFunctionCodes.ReadWriteMultipleRegisters):
+            logging.debug("Invalid Modbus AddressCount")
+            return "Modbus address count not specified or invalid. \
+                    Unable to process Modbus command."
+
+    for parameter in required:
+        if payload.get(parameter) is None or payload.get(parameter) == "":
+            logging.debug("Invalid Modbus %s", parameter)
+            return "Modbus " + parameter + " not specified. Unable to process Modbus command."
+
+    return None
+
+def execute_modbus_request(payload, modbus_port):
+    """Send the request to the modbus server using a pooled connection"""
+    logging.debug("In execute_modbus_request")
+
+    while True:
+        conn = SCOPE_VARS['CLIENT_POOL'].acquire(payload['ModbusHost'], modbus_port)
+        started = time.time()
+        try:
+            response = send_modbus_request(conn.client, payload)
+        except Exception:
+            SCOPE_VARS['CLIENT_POOL'].release(conn, healthy=False)
+            raise
+        record_transaction(payload, started, response)
 
-    logging.debug("Exit validate_modbus_request, returning True")
-    return True
+        #Don't reuse a connection that may hold a partial or late response
+        SCOPE_VARS['CLIENT_POOL'].release(conn, \
+            healthy=response.get('exception') in (None, 'ExceptionResponse'))
+
+        #A pooled connection may have been closed by the device since it was last used. Retry
+        #on a new connection, since the request never reached the device.
+        if conn.reused and response.get('exception') == ConnectionException.__name__:
+            logging.info("Pooled connection to %s:%s was closed, retrying on a new connection", \
+                payload['ModbusHost'], modbus_port)
+            continue
+
+        return response
 
 def send_modbus_request(client, payload):
     """Send the request to the modbus server"""
@@ -348,82 +709,56 @@ def send_modbus_request(client, payload):
     logging.debug("payload = %s", payload)
     try:
         #Send the modbus request
-        if payload['FunctionCode'] == ModbusFunctionCodes.ReadCoil:
-            #Function code 1 - Read Coil
-            resp = client.read_coils(payload['StartAddress'], count, \
-                unit=payload['UnitID']).bits[0:count]
-        elif payload['FunctionCode'] == ModbusFunctionCodes.ReadDiscreteInput:
-            #Function code 2 - Read Discrete Input
-            resp = client.read_discrete_inputs(payload['StartAddress'], count, \
-                unit=payload['UnitID']).bits[0:count]
-        elif payload['FunctionCode'] == ModbusFunctionCodes.ReadHoldingRegisters:
-            #Function code 3 - Read Holding Registers
-            resp = client.read_holding_registers(payload['StartAddress'], count, \
-                unit=payload['UnitID']).registers[0:count]
-        elif payload['FunctionCode'] == ModbusFunctionCodes.ReadInputRegisters:
-            #Function code 4 - Read Input Registers
-            resp = client.read_input_registers(payload['StartAddress'], count, \
-                unit=payload['UnitID']).registers[0:count]
-        elif payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleCoil:
-            #Function code 5 - Write Single Coil
-            resp = client.write_coil(payload['StartAddress'], payload['Data'][0], \
-                unit=payload['UnitID']).value
-        elif payload['FunctionCode'] == ModbusFunctionCodes.WriteSingleHoldingRegister:
-            #Function code 6 - Write Single Holding Register
-            resp = client.write_register(payload['StartAddress'], payload['Data'][0], \
-                unit=payload['UnitID']).value
-        elif payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleCoils:
-            #Function code 15 - Write Multiple Coils
-            resp = client.write_coils(payload['StartAddress'], payload['Data'], \
-                unit=payload['UnitID']).count
-        elif payload['FunctionCode'] == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
-            #Function code 16 - Write Multiple Holding Registers
-            resp = client.write_registers(payload['StartAddress'], payload['Data'], \
-                unit=payload['UnitID']).count
+        resp = send_request(client, payload, count)
 
         logging.debug("resp = %s", resp)
 
-        payload = {}
-        payload["Data"] = resp
+        payload = extract_response(payload, resp, count)
 
         logging.debug("payload = %s", payload)
         return payload
     except ConnectionException as mce:
         logging.error("Modbus Connection Exception:: %s", str(mce))
-        return { 'error': "Modbus Connection Exception: " + str(mce)}
+        return { 'error': "Modbus Connection Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
     except ModbusIOException as mce:
         logging.error("Modbus IO Exception:: %s", str(mce))
-        return { 'error': "Modbus IO Exception: " + str(mce)}
+        return { 'error': "Modbus IO Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
     except ParameterException as mce:
         logging.error("Modbus Parameter Exception:: %s", str(mce))
-        return { 'error': "Modbus Parameter Exception: " + str(mce)}
+        return { 'error': "Modbus Parameter Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
     except NoSuchSlaveException as mce:
         logging.error("Modbus No Such Slave Exception:: %s", str(mce))
-        return { 'error': "Modbus No Such Slave Exception: " + str(mce)}
+        return { 'error': "Modbus No Such Slave Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
     except InvalidMessageRecievedException as mce:
         logging.error("Modbus Invalid Message Received Exception:: %s", str(mce))
-        return { 'error': "Modbus Invalid Message Received Exception: " + str(mce)}
+        return { 'error': "Modbus Invalid Message Received Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
     except ModbusException as mce:
         logging.error("Modbus Exception:: %s", str(mce))
-        return { 'error': "Modbus Exception: " + str(mce)}
+        return { 'error': "Modbus Exception: " + str(mce), \
+            'exception': mce.__class__.__name__}
 
-def create_modbus_response(request, resp):
+def create_modbus_response(request, resp, encoding=ENCODINGS['JSON']):
     """Create a modbus response"""
     logging.debug("In create_modbus_response")
     message = {}
     message["request"] = request
     message["response"] = resp
 
-    return json.dumps(message)
+    return encode_message(message, encoding)
 
-def create_modbus_error(request, error):
+def create_modbus_error(request, error, encoding=ENCODINGS['JSON']):
     """Create a modbus error response"""
     logging.debug("In create_modbus_error")
     message = {}
     message["request"] = request
     message["error"] = error
 
-    return json.dumps(message)
+    return encode_message(message, encoding)
 
 #Main Loop
 if __name__ == '__main__':
@@ -431,6 +766,10 @@ if __name__ == '__main__':
     CB_CONFIG = parse_args(sys.argv)
     LOGGER = setup_custom_logger(ADAPTER_NAME)
 
+    if CB_CONFIG['msgpackTopics'] and ENCODINGS['MSGPACK'] not in available_encodings():
+        logging.fatal("--msgpackTopics requires the msgpack package to be installed")
+        sys.exit(1)
+
     if not CB_CONFIG['logCB']:
         logging.debug("Setting cbLogs.DEBUG to False")
         cbLogs.DEBUG = False
@@ -454,14 +793,19 @@ if __name__ == '__main__':
     CB_AUTH = CB_SYSTEM.Device(CB_CONFIG['deviceID'], CB_CONFIG['activeKey'])
 
     #Retrieve the adapter configuration
+    SCANS = []
     if CB_CONFIG['adapterSettingsCollectionName'] != "":
         logging.info("Retrieving the adapter configuration settings")
-        get_adapter_config()
+        SCANS = get_adapter_config()
 
     #########################
     #BEGIN MQTT SPECIFIC CODE
     #########################
 
+    start_request_execution()
+    if CB_CONFIG['outboxFile'] != "":
+        open_outbox()
+
     #Connect to the message broker
     logging.info("Initializing the ClearBlade message broker")
     CB_MQTT = CB_SYSTEM.Messaging(CB_AUTH)
@@ -474,12 +818,28 @@ if __name__ == '__main__':
 
     #END MQTT SPECIFIC CODE
 
-    while not SCOPE_VARS['EXIT_APP']:
-        try:
-            pass
-        except KeyboardInterrupt:
-            SCOPE_VARS['EXIT_APP'] = True
-            CB_MQTT.disconnect()
-            sys.exit(0)
-        except Exception as e:
-            logging.info("EXCEPTION:: %s", str(e))
+    METRICS.on_collect(lambda: QUEUE_DEPTH.set(queued_modbus_requests()))
+    if CB_CONFIG['metricsPort'] > 0:
+        start_metrics_server(METRICS, CB_CONFIG['metricsPort'])
+    if CB_CONFIG['statsInterval'] > 0:
+        publish_stats_periodically(METRICS, lambda stats: mqtt.publish_modbus_client_stats( \
+            CB_MQTT, CB_CONFIG['adapterTopicRoot'], stats), CB_CONFIG['statsInterval'], \
+            SCOPE_VARS['EXIT_APP'])
+
+    if SCANS:
+        SCOPE_VARS['SCHEDULER'] = ScanScheduler(SCANS, submit_modbus_request, \
+            lambda request, changes: publish_scan_changes(CB_MQTT, request, changes), \
+            lambda request, error: mqtt.publish_modbus_error(CB_MQTT, \
+                CB_CONFIG['adapterTopicRoot'], create_modbus_error(request, error)), \
+            poll_timeout=CB_CONFIG['scanTimeout'])
+        SCOPE_VARS['SCHEDULER'].start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: SCOPE_VARS['EXIT_APP'].set())
+    signal.signal(signal.SIGINT, lambda signum, frame: SCOPE_VARS['EXIT_APP'].set())
+
+    #Block until a signal or an MQTT callback asks the adapter to exit. The timeout only keeps the
+    #main thread able to run signal handlers, which an untimed wait would block.
+    while not SCOPE_VARS['EXIT_APP'].wait(60):
+        pass
+
+    shutdown(CB_MQTT, CB_CONFIG['shutdownTimeout'])
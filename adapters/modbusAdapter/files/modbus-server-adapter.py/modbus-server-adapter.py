@@ -3,17 +3,36 @@ import sys
 import argparse
 import logging
 import os
+import threading
 from clearblade.ClearBladeCore import System, Query
 from clearblade.ClearBladeCore import cbLogs
-from pymodbus.server.async import StartTcpServer
 from pymodbus.device import ModbusDeviceIdentification
 
-from cbData import MODBUS_DATA_COLLECTIONS
+from cbData import MODBUS_DATA_COLLECTIONS, MODBUS_QUERY_SETTINGS, MODBUS_WRITE_SETTINGS, \
+    configure_platform_calls
 from context import ClearBladeModbusServerContext
+from encoding import ENCODINGS, decode_request
+from metrics import METRICS, publish_stats_periodically, start_metrics_server
+from mqtt import MODBUS_SERVER_TOPICS, create_topic, publish_modbus_server_stats
+from snapshot import RegisterSnapshot
+from workers import WorkerSupervisor
+from writebehind import WriteBehindQueue
 
 ADAPTER_NAME = "ModbusServerAdapter"
 CB_CONFIG = {}
 
+#Set when the Modbus server stops, to end the background threads of the adapter
+EXIT_EVENT = threading.Event()
+
+#Set once the connection to the MQTT broker has been lost, so the next connect is a reconnect
+RECONNECTING = threading.Event()
+
+#The server context change notifications are applied to, once it has been created
+SERVER_CONTEXT = None
+
+CHANGE_NOTIFICATIONS = METRICS.counter("modbus_server_change_notifications_total", \
+    "Changes to the data collections announced on the server changes topic", ('kind',))
+
 def parse_args(argv):
     """Parse the command line arguments
     :param argv: An array containing the command line arguments
@@ -105,6 +124,115 @@ def parse_args(argv):
     parser.add_argument('--modbusZeroMode', dest="modbusZeroMode", default=False, action='store_true',\
                         help='Flag presence indicates Modbus Zero Mode should be used')
 
+    parser.add_argument('--workers', dest="workers", default=1, type=int, \
+                        help='The number of processes serving Modbus requests on the Modbus port. \
+                        Each has its own ClearBlade Platform session, and writes are relayed \
+                        between their register images. The default is 1.')
+
+    parser.add_argument('--datastoreThreads', dest="datastoreThreads", default=10, type=int, \
+                        help='The maximum number of Modbus requests executed against the data \
+                        collections at the same time. The default is 10.')
+
+    parser.add_argument('--requestDeadline', dest="requestDeadline", default=5.0, type=float, \
+                        help='The number of seconds a Modbus request may take to execute against \
+                        the data collections before Gateway Target Device Failed to Respond is \
+                        returned. 0 waits indefinitely. The default is 5.')
+
+    parser.add_argument('--modbusCacheTTL', dest="modbusCacheTTL", default=0, type=float, \
+                        help='The number of seconds register values are served from an in-memory \
+                        image before being reloaded from the data collections. Writes update the \
+                        image and are written through to the collections. A negative value means \
+                        values never expire. The default is 0, which disables the image.')
+
+    parser.add_argument('--maxCachedUnits', dest="maxCachedUnits", default=64, type=int, \
+                        help='The maximum number of Modbus unit ids whose slave contexts and \
+                        register image entries are kept in memory. The default is 64.')
+
+    parser.add_argument('--indexRefreshInterval', dest="indexRefreshInterval", default=300, \
+                        type=float, help='The number of seconds between reloads of the index of \
+                        Modbus unit ids and addresses served by the adapter. Requests for unit ids \
+                        or addresses missing from the index are rejected. Modbus writes only \
+                        change existing addresses, so the index changes when rows are added to or \
+                        deleted from the collections. With --changeNotifications, the announced \
+                        changes update the index as they arrive and reloads only pick up changes \
+                        that were not announced. 0 disables reloading. The default is 300.')
+
+    parser.add_argument('--platformTimeout', dest="platformTimeout", default=4.0, type=float, \
+                        help='The number of seconds to wait for the platform to answer a call to \
+                        the data collections. Writes that time out are answered with Gateway \
+                        Target Device Failed to Respond, so keep it below --requestDeadline. 0 \
+                        waits indefinitely. The default is 4.')
+
+    parser.add_argument('--platformPageSize', dest="platformPageSize", default=100, type=int, \
+                        help='The number of rows requested per page when querying the data \
+                        collections. Pages are requested until one holds fewer rows, so this must \
+                        not exceed the page size limit of the platform. The default is 100.')
+
+    parser.add_argument('--snapshotFile', dest="snapshotFile", default="", \
+                        help='The path of a memory-mapped file the register image is saved to as \
+                        it changes and loaded from at startup, so reads are answered before the \
+                        platform is queried and last known values are served while the platform \
+                        cannot be reached. Requires --modbusCacheTTL. Worker processes append \
+                        their index to the path. The default is "", which disables the snapshot.')
+
+    parser.add_argument('--snapshotAddresses', dest="snapshotAddresses", default=10000, type=int, \
+                        help='The number of addresses, starting at 0, of each table of each unit \
+                        kept in the snapshot file. The default is 10000.')
+
+    parser.add_argument('--maxConcurrentUpdates', dest="maxConcurrentUpdates", default=8, \
+                        type=int, help='The maximum number of collection updates a single \
+                        multi-address Modbus write may send to the platform at the same time. \
+                        The default is 8.')
+
+    parser.add_argument('--writeBehind', dest="writeBehind", default=False, action='store_true',\
+                        help='Flag presence indicates Modbus writes should be acknowledged as soon \
+                        as they are queued and saved to the data collections in the background.')
+
+    parser.add_argument('--writeBehindInterval', dest="writeBehindInterval", default=1.0, \
+                        type=float, help='The maximum number of seconds a queued write waits \
+                        before being saved to the data collections. The default is 1.')
+
+    parser.add_argument('--writeBehindBatchSize', dest="writeBehindBatchSize", default=100, \
+                        type=int, help='The number of queued addresses that causes queued writes \
+                        to be saved immediately. The default is 100.')
+
+    parser.add_argument('--writeBehindMaxPending', dest="writeBehindMaxPending", default=10000, \
+                        type=int, help='The maximum number of queued addresses. Writes received \
+                        while the queue is full wait for room. The default is 10000.')
+
+    parser.add_argument('--writeBehindBlockTimeout', dest="writeBehindBlockTimeout", default=5.0, \
+                        type=float, help='The number of seconds a write waits for room in a full \
+                        queue before Slave Device Busy is returned. The default is 5.')
+
+    parser.add_argument('--writeBehindMaxRetries', dest="writeBehindMaxRetries", default=10, \
+                        type=int, help='The number of times a queued write that could not be \
+                        saved is retried before it is dropped. Retries wait twice as long after \
+                        every failure, up to 60 seconds. The default is 10.')
+
+    parser.add_argument('--shutdownTimeout', dest="shutdownTimeout", default=10, type=float, \
+                        help='The maximum number of seconds spent saving queued writes to the \
+                        platform when the adapter is stopped. The default is 10.')
+
+    parser.add_argument('--metricsPort', dest="metricsPort", default=0, type=int, \
+                        help='The HTTP port request latency, platform call and error metrics are \
+                        served on, in the Prometheus text format, at /metrics. Worker processes \
+                        use consecutive ports starting at this one. The default is 0, which \
+                        disables the endpoint.')
+
+    parser.add_argument('--statsInterval', dest="statsInterval", default=0, type=float, \
+                        help='The number of seconds between publishes of the adapter metrics to \
+                        the modbus/server/stats topic below the topic root. The default is 0, \
+                        which disables publishing.')
+
+    parser.add_argument('--changeNotifications', dest="changeNotifications", default=False, \
+                        action='store_true', help='Flag presence indicates the adapter should \
+                        apply the changes to the data collections announced on the \
+                        modbus/server/changes topic below the topic root to its register image \
+                        and address index. Combined with a negative --modbusCacheTTL, reads are \
+                        answered from memory and only reloaded when a change is announced \
+                        without its values, or after the connection to the message broker is \
+                        lost.')
+
     parser.add_argument('--inputContactsCollection', dest="inputContactsCollection", \
                         default="Discrete_Input_Contacts", \
                         help='The name of a data collection that will be used to store Modbus \
@@ -171,21 +299,45 @@ def get_adapter_config():
     logging.debug("End get_adapter_config")
 
 
+def refresh_index_periodically(context, interval):
+    """Reload the index of Modbus unit ids and addresses served by the adapter in the background
+
+    :param context: The ClearBladeModbusServerContext whose address index should be reloaded
+    :param interval: The number of seconds between reloads
+    """
+    def refresh():
+        """Reload the address index until the adapter exits"""
+        while not EXIT_EVENT.wait(interval):
+            context.refresh_index()
+
+    thread = threading.Thread(target=refresh, name="AddressIndexRefresh")
+    thread.daemon = True
+    thread.start()
+
+
 #########################
 #BEGIN MQTT CALLBACKS
 #########################
 def on_connect(mqtt_client, userdata, flags, result_code):
     """MQTT callback invoked when a connection is established with a broker"""
     logging.debug("Begin on_connect")
+    if result_code != 0:
+        logging.error("Error while connecting to ClearBlade Platform message broker: \
+            result code = %s", result_code)
+        return
+
     logging.info("Connected to ClearBlade Platform MQTT broker")
 
     #When the connection to the broker is complete, set up any subscriptions that are needed
+    if CB_CONFIG['changeNotifications']:
+        #Changes announced while disconnected were missed, so reload every value when next read
+        if RECONNECTING.is_set() and SERVER_CONTEXT.image is not None:
+            SERVER_CONTEXT.image.expire()
 
-    #TODO - If your implementation needs to subscribe to topics, uncomment this block and add your logic here
-    # log.Printf("[DEBUG] Begin Configuring Subscription(s)")
-    # client.subscribe(CB_CONFIG['adapterTopicRoot'+ '/mySubTopic'])
-    global EXIT_APP
-    EXIT_APP = True
+        the_topic = changes_topic()
+        logging.debug("Subscribing to topic %s", the_topic)
+        mqtt_client.subscribe(the_topic)
+        mqtt_client.message_callback_add(the_topic, handle_change_notification)
 
     logging.debug("End on_connect")
 
@@ -197,6 +349,9 @@ def on_disconnect(mqtt_client, userdata, result_code):
         logging.warning("Connection to CB Platform MQTT broker was lost, result code = %s", \
                         result_code)
 
+    #Values loaded before a reconnect may have missed change notifications
+    RECONNECTING.set()
+
     #We don't need to worry about manally re-initializing the mqtt client. The auto reconnect
     # logic will automatically try and reconnect. The reconnect interval could be as much as
     # 20 minutes.
@@ -253,21 +408,63 @@ def on_log(mqtt_client, userdata, level, buf):
 #END MQTT CALLBACKS
 #########################
 
+def changes_topic():
+    """Return the topic changes to the data collections are announced on"""
+    return create_topic(CB_CONFIG['adapterTopicRoot'], \
+        MODBUS_SERVER_TOPICS['MODBUS_SERVER_CHANGES'])
 
-#Main Loop
-if __name__ == '__main__':
-    EXIT_APP = False
 
-    CB_CONFIG = parse_args(sys.argv)
-    LOGGER = setup_custom_logger(ADAPTER_NAME)
+def handle_change_notification(mqtt_client, userdata, message):
+    """Apply the changes to the data collections announced in a message to the server context"""
+    logging.debug("In handle_change_notification")
+    logging.debug("Payload = %s", message.payload)
 
-    if not CB_CONFIG['logCB']:
-        logging.debug("Setting cbLogs.DEBUG to False")
-        cbLogs.DEBUG = False
+    try:
+        changes = decode_request(message.payload, ENCODINGS['JSON'])
+    except ValueError as exc:
+        logging.error("Discarding change notification that is not valid JSON: %s", str(exc))
+        CHANGE_NOTIFICATIONS.increment(('invalid',))
+        return
+
+    if not isinstance(changes, list):
+        changes = [changes]
+
+    tables = dict([(collection, table) for table, collection in \
+        MODBUS_DATA_COLLECTIONS.items()])
+    for change in changes:
+        try:
+            table = tables[change['Collection']]
+            values = change.get('Data', None)
+            removed = change.get('Removed', False)
+            SERVER_CONTEXT.apply_change(int(change['UnitID']), table, int(change['Address']), \
+                values=values, count=int(change.get('Count', 1)), removed=removed)
+        except (KeyError, TypeError, ValueError) as exc:
+            logging.error("Discarding invalid change notification %s: %s", change, str(exc))
+            CHANGE_NOTIFICATIONS.increment(('invalid',))
+            continue
+
+        if removed:
+            CHANGE_NOTIFICATIONS.increment(('removed',))
+        elif values is not None:
+            CHANGE_NOTIFICATIONS.increment(('updated',))
+        else:
+            CHANGE_NOTIFICATIONS.increment(('invalidated',))
+
+    logging.debug("Exit handle_change_notification")
+
+
+
+def run_server(sock=None, relay=None, slot=0):
+    """Connect to the ClearBlade Platform and serve Modbus requests until the server is stopped
+
+    :param sock: An optional listening socket shared with other worker processes
+    :param relay: An optional WriteRelay connecting this worker process to the others
+    :param slot: The index of this worker process
+    """
+    global CB_SYSTEM, CB_AUTH, SERVER_CONTEXT
 
-    if not CB_CONFIG['logMQTT']:
-        logging.debug("Setting cbLogs.MQTT_DEBUG to False")
-        cbLogs.MQTT_DEBUG = False
+    #Imported here so every worker process installs its own reactor after it is forked
+    from server import start_tcp_server
 
     logging.info("Intializing ClearBlade device client")
     logging.debug("System Key = %s", CB_CONFIG['systemKey'])
@@ -288,38 +485,59 @@ if __name__ == '__main__':
         logging.info("Retrieving the adapter configuration settings")
         get_adapter_config()
 
+    if CB_CONFIG['metricsPort'] > 0:
+        start_metrics_server(METRICS, CB_CONFIG['metricsPort'] + slot)
+
+    writer = None
+    if CB_CONFIG['writeBehind']:
+        logging.info("Enabling write-behind of Modbus writes")
+        writer = WriteBehindQueue(CB_SYSTEM, CB_AUTH, interval=CB_CONFIG['writeBehindInterval'], \
+            batch_size=CB_CONFIG['writeBehindBatchSize'], \
+            max_pending=CB_CONFIG['writeBehindMaxPending'], \
+            block_timeout=CB_CONFIG['writeBehindBlockTimeout'], \
+            max_retries=CB_CONFIG['writeBehindMaxRetries'])
+
+    snapshot = None
+    if CB_CONFIG['snapshotFile'] != "":
+        path = CB_CONFIG['snapshotFile']
+        if CB_CONFIG['workers'] > 1:
+            path += "." + str(slot)
+        snapshot = RegisterSnapshot(path, slots=CB_CONFIG['maxCachedUnits'], \
+            addresses=CB_CONFIG['snapshotAddresses'])
+
+    #Start Modbus Server
+    # 1. Create Modbus Server Context
+    context = ClearBladeModbusServerContext(cbsystem=CB_SYSTEM, cbauth=CB_AUTH, \
+        zero_mode=CB_CONFIG['modbusZeroMode'], cache_ttl=CB_CONFIG['modbusCacheTTL'], \
+        writer=writer, max_units=CB_CONFIG['maxCachedUnits'], relay=relay, snapshot=snapshot)
+
+    SERVER_CONTEXT = context
+
+    if CB_CONFIG['indexRefreshInterval'] > 0:
+        refresh_index_periodically(context, CB_CONFIG['indexRefreshInterval'])
+
     #########################
     #BEGIN MQTT SPECIFIC CODE
     #########################
 
-    #Connect to the message broker
-    # logging.info("Initializing the ClearBlade message broker")
-    # CB_MQTT = CB_SYSTEM.Messaging(CB_AUTH)
+    #Connect to the message broker once the context change notifications are applied to exists
+    mqtt_client = None
+    if CB_CONFIG['statsInterval'] > 0 or CB_CONFIG['changeNotifications']:
+        logging.info("Initializing the ClearBlade message broker")
+        mqtt_client = CB_SYSTEM.Messaging(CB_AUTH)
+        mqtt_client.on_connect = on_connect
+        mqtt_client.on_disconnect = on_disconnect
 
-    # CB_MQTT.on_log = on_log
-    # CB_MQTT.on_connect = on_connect
-    # CB_MQTT.on_disconnect = on_disconnect
-    # CB_MQTT.on_subscribe = on_subscribe
-    # CB_MQTT.on_unsubscribe = on_unsubscribe
-    # CB_MQTT.on_publish = on_publish
-    # CB_MQTT.on_message = on_message
+        logging.info("Connecting to the ClearBlade message broker")
+        mqtt_client.connect()
 
-    # logging.info("Connecting to the ClearBlade message broker")
-    # CB_MQTT.connect() #Connect to the msg broker
+    if CB_CONFIG['statsInterval'] > 0:
+        publish_stats_periodically(METRICS, lambda stats: publish_modbus_server_stats( \
+            mqtt_client, CB_CONFIG['adapterTopicRoot'], stats), CB_CONFIG['statsInterval'], \
+            EXIT_EVENT, extra={'worker': slot, 'pid': os.getpid()})
 
     #END MQTT SPECIFIC CODE
 
-    # Specify the correct data collection names
-    MODBUS_DATA_COLLECTIONS['COILS_COLLECTION'] = CB_CONFIG['outputCoilsCollection']
-    MODBUS_DATA_COLLECTIONS['CONTACTS_COLLECTION'] = CB_CONFIG['inputContactsCollection']
-    MODBUS_DATA_COLLECTIONS['INPUT_REGISTERS_COLLECTION'] = CB_CONFIG['inputRegisterCollection']
-    MODBUS_DATA_COLLECTIONS['OUTPUT_REGISTERS_COLLECTION'] = CB_CONFIG['outputRegisterCollection']
-
-    #Start Modbus Server
-    # 1. Create Modbus Server Context
-    context = ClearBladeModbusServerContext(cbsystem=CB_SYSTEM, cbauth=CB_AUTH, \
-        zero_mode=CB_CONFIG['modbusZeroMode'])
-
     # 2. Create Modbus Device Identification
     identity = ModbusDeviceIdentification()
     identity.VendorName = 'ClearBlade'
@@ -330,13 +548,68 @@ if __name__ == '__main__':
     identity.MajorMinorRevision = '1.0'
 
     try:
-        # 3. Run the Start TCP Server Command
+        # 3. Run the Start TCP Server Command. The reactor stops on SIGINT and SIGTERM, once it
+        # has stopped accepting connections and answered the requests it was processing.
         logging.info("Starting Modbus TCP server")
-        StartTcpServer(context, identity=identity, address=("localhost", CB_CONFIG['modbusPort']))
-        pass
-    except KeyboardInterrupt:
-        EXIT_APP = True
-        #CB_MQTT.disconnect()
-        sys.exit(0)
+        start_tcp_server(context, identity=identity, address=("localhost", CB_CONFIG['modbusPort']), \
+            datastore_threads=CB_CONFIG['datastoreThreads'], \
+            request_timeout=CB_CONFIG['requestDeadline'], sock=sock)
     except Exception as e:
         logging.info("EXCEPTION:: %s", str(e))
+    finally:
+        EXIT_EVENT.set()
+        if writer is not None:
+            writer.stop(CB_CONFIG['shutdownTimeout'])
+        if snapshot is not None:
+            snapshot.close()
+        if mqtt_client is not None:
+            if CB_CONFIG['changeNotifications']:
+                mqtt_client.unsubscribe(changes_topic())
+            mqtt_client.disconnect()
+        logging.info("Modbus TCP server stopped")
+
+
+#Main Loop
+if __name__ == '__main__':
+    EXIT_APP = False
+
+    CB_CONFIG = parse_args(sys.argv)
+    LOGGER = setup_custom_logger(ADAPTER_NAME)
+
+    if not CB_CONFIG['logCB']:
+        logging.debug("Setting cbLogs.DEBUG to False")
+        cbLogs.DEBUG = False
+
+    if not CB_CONFIG['logMQTT']:
+        logging.debug("Setting cbLogs.MQTT_DEBUG to False")
+        cbLogs.MQTT_DEBUG = False
+
+    # Specify the correct data collection names
+    MODBUS_DATA_COLLECTIONS['COILS_COLLECTION'] = CB_CONFIG['outputCoilsCollection']
+    MODBUS_DATA_COLLECTIONS['CONTACTS_COLLECTION'] = CB_CONFIG['inputContactsCollection']
+    MODBUS_DATA_COLLECTIONS['INPUT_REGISTERS_COLLECTION'] = CB_CONFIG['inputRegisterCollection']
+    MODBUS_DATA_COLLECTIONS['OUTPUT_REGISTERS_COLLECTION'] = CB_CONFIG['outputRegisterCollection']
+    MODBUS_QUERY_SETTINGS['PAGE_SIZE'] = CB_CONFIG['platformPageSize']
+    MODBUS_WRITE_SETTINGS['MAX_CONCURRENT_UPDATES'] = CB_CONFIG['maxConcurrentUpdates']
+
+    #Report failed platform calls as exceptions Modbus errors are derived from, rather than letting
+    #the ClearBlade SDK exit the thread that made them
+    configure_platform_calls(CB_CONFIG['platformTimeout'])
+
+    if CB_CONFIG['snapshotFile'] != "" and not CB_CONFIG['modbusCacheTTL']:
+        logging.warning("--snapshotFile requires --modbusCacheTTL, ignoring it")
+        CB_CONFIG['snapshotFile'] = ""
+
+    if CB_CONFIG['changeNotifications'] and not CB_CONFIG['modbusCacheTTL']:
+        logging.warning("Without --modbusCacheTTL, change notifications only update the " \
+            "address index")
+
+    if CB_CONFIG['workers'] > 1:
+        if CB_CONFIG['writeBehind'] and not CB_CONFIG['modbusCacheTTL']:
+            logging.warning("Workers only see the writes other workers queued for write-behind " \
+                "once they are saved, unless --modbusCacheTTL is set")
+        WorkerSupervisor(CB_CONFIG['workers'], ("localhost", CB_CONFIG['modbusPort']), \
+            lambda sock, relay, slot: run_server(sock=sock, relay=relay, slot=slot), \
+            shutdown_timeout=CB_CONFIG['shutdownTimeout'] + 5).run()
+    else:
+        run_server()
@@ -15,14 +15,70 @@ MODBUS Command structure
     'ZeroMode': true|false,
     'Data': []
 }
+
+An array of Modbus commands may also be sent in a single message. The commands are executed
+concurrently where their hosts differ, and a single response is published once all of them
+complete:
+
+{
+    'results': [
+        {'request': {...}, 'response': {'Data': []}},
+        {'request': {...}, 'error': 'description'}
+    ]
+}
+
+Values polled by the scan lists in the adapter settings collection are published on the scan
+data topic whenever they change:
+
+{
+    'request': {...},
+    'changes': {'address': value}
+}
+
+Requests may also be sent msgpack encoded on the request topic suffixed with /msgpack. Their
+responses and errors are then published msgpack encoded on the response and error topics
+suffixed with /msgpack. See encoding.py.
+
+When enabled, the client and server adapters periodically publish their metrics on the client
+and server stats topics.
+See metrics.py.
+
+Services on the ClearBlade Platform that change the Modbus data collections may announce the
+changes on the server changes topic, so a server adapter serving reads from its register image
+stays current without reloading values from the collections. Addresses are those stored in the
+collections, and an array of changes may be sent in a single message:
+
+{
+    'UnitID': int,
+    'Collection': name of the data collection changed,
+    'Address': int,
+    'Data': [],                 new values, or omitted to reload the addresses when next read
+    'Count': int,               number of addresses to reload when Data is omitted, default 1
+    'Removed': true|false       the addresses were deleted from the collection
+}
+
+When the client adapter is started with an outbox, the responses, errors and scan data published
+while it is disconnected from the message broker are stored and replayed once it reconnects.
+See outbox.py.
 '''
 
 import logging
+import time
+
+from encoding import ENCODINGS, encoded_topic
+from metrics import METRICS
 
 MODBUS_CLIENT_TOPICS = {
     'MODBUS_REQUEST': "modbus/command/request",
     'MODBUS_RESPONSE': "modbus/command/response",
-    'MODBUS_ERROR': "modbus/command/error"
+    'MODBUS_ERROR': "modbus/command/error",
+    'MODBUS_SCAN_DATA': "modbus/scan/data",
+    'MODBUS_CLIENT_STATS': "modbus/client/stats"
+}
+
+MODBUS_SERVER_TOPICS = {
+    'MODBUS_SERVER_STATS': "modbus/server/stats",
+    'MODBUS_SERVER_CHANGES': "modbus/server/changes"
 }
 
 def create_topic(topic_root, sub_topic):
@@ -41,14 +97,54 @@ def create_topic(topic_root, sub_topic):
 
     return topic + sub_topic
 
-def publish_modbus_error(mqtt_client, topic_root, error):
+#The Outbox messages are published through, set by the client adapter when store-and-forward is
+#enabled
+MQTT_SETTINGS = {
+    'OUTBOX': None
+}
+
+PUBLISH_SECONDS = METRICS.histogram("modbus_mqtt_publish_seconds", \
+    "Time taken to hand messages to the MQTT client", ('topic',))
+
+def publish(mqtt_client, topic_root, sub_topic, message, store=True):
+    '''Publish a message on a topic below topic_root, recording the time taken. Unless store is
+    False, the message is published through the outbox when one is set.'''
+    started = time.time()
+    try:
+        if store and MQTT_SETTINGS['OUTBOX'] is not None:
+            MQTT_SETTINGS['OUTBOX'].publish(mqtt_client, create_topic(topic_root, sub_topic), \
+                message)
+        else:
+            mqtt_client.publish(create_topic(topic_root, sub_topic), message)
+    finally:
+        PUBLISH_SECONDS.observe(time.time() - started, (sub_topic,))
+
+def publish_modbus_error(mqtt_client, topic_root, error, encoding=ENCODINGS['JSON']):
     '''Publish a modbus error to the ClearBlade Platform'''
     logging.debug("Publishing Modbus error: %s", error)
-    mqtt_client.publish(create_topic(topic_root, MODBUS_CLIENT_TOPICS['MODBUS_ERROR']), str(error))
+    publish(mqtt_client, topic_root, encoded_topic(MODBUS_CLIENT_TOPICS['MODBUS_ERROR'], \
+        encoding), str(error) if encoding == ENCODINGS['JSON'] else error)
 
 
-def publish_modbus_response(mqtt_client, topic_root, resp):
+def publish_modbus_response(mqtt_client, topic_root, resp, encoding=ENCODINGS['JSON']):
     '''Publish a modbus response to the ClearBlade Platform'''
     logging.debug("Publishing Modbus response: %s", resp)
-    mqtt_client.publish(create_topic(topic_root, MODBUS_CLIENT_TOPICS['MODBUS_RESPONSE']), \
-        str(resp))
+    publish(mqtt_client, topic_root, encoded_topic(MODBUS_CLIENT_TOPICS['MODBUS_RESPONSE'], \
+        encoding), str(resp) if encoding == ENCODINGS['JSON'] else resp)
+
+def publish_modbus_scan_data(mqtt_client, topic_root, data):
+    '''Publish the changed values found by a scan to the ClearBlade Platform'''
+    logging.debug("Publishing Modbus scan data: %s", data)
+    publish(mqtt_client, topic_root, MODBUS_CLIENT_TOPICS['MODBUS_SCAN_DATA'], str(data))
+
+def publish_modbus_server_stats(mqtt_client, topic_root, stats):
+    '''Publish the metrics of the server adapter to the ClearBlade Platform'''
+    logging.debug("Publishing Modbus server stats")
+    publish(mqtt_client, topic_root, MODBUS_SERVER_TOPICS['MODBUS_SERVER_STATS'], stats, \
+        store=False)
+
+def publish_modbus_client_stats(mqtt_client, topic_root, stats):
+    '''Publish the metrics of the client adapter to the ClearBlade Platform'''
+    logging.debug("Publishing Modbus client stats")
+    publish(mqtt_client, topic_root, MODBUS_CLIENT_TOPICS['MODBUS_CLIENT_STATS'], stats, \
+        store=False)
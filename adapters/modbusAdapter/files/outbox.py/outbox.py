@@ -0,0 +1,283 @@
+'''
+cbModbus outbox
+-----------------
+
+Store-and-forward of the messages the client adapter publishes. While the adapter is disconnected
+from the message broker, messages are appended to a bounded ring buffer kept in a memory-mapped
+file rather than handed to the MQTT client, which would drop or hold them in memory without
+limit. Once the connection is restored they are replayed in order, a batch at a time, before
+messages are published directly again.
+
+The file holds a header followed by the ring. Each record is a 32 bit length followed by the
+message: a flag byte, the 16 bit length of the topic, the topic and the payload. A record that
+does not fit before the end of the ring starts again at its beginning, after a WRAP_MARKER length.
+When the ring is full, the oldest messages are discarded to make room.
+
+    header  magic (8 bytes), version (uint16), reserved (uint16), capacity (uint32),
+            head (uint32), tail (uint32), count (uint32)
+
+All integers are little-endian.
+'''
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from metrics import METRICS
+
+OUTBOX_MAGIC = b"CBOUTBOX"
+OUTBOX_VERSION = 1
+
+#The record length written where the ring wraps before the end of the file
+WRAP_MARKER = 0xFFFFFFFF
+
+#Record flags describing the type of the payload
+TEXT_PAYLOAD = 0
+BINARY_PAYLOAD = 1
+
+_HEADER = struct.Struct("<8sHHIIII")
+_LENGTH = struct.Struct("<I")
+_MESSAGE = struct.Struct("<BH")
+
+OUTBOX_MESSAGES = METRICS.gauge("modbus_outbox_messages", \
+    "Messages held in the outbox waiting for the message broker connection")
+OUTBOX_DROPPED = METRICS.counter("modbus_outbox_dropped_total", \
+    "Messages discarded from the outbox because it was full")
+
+class RingBuffer(object):
+    ''' A bounded FIFO of MQTT messages stored in a memory-mapped file. Not thread safe.
+
+    :param path: The path of the buffer file. It is created if it does not exist, and recreated if
+                 it was written with a different capacity.
+    :param capacity: The number of bytes of messages the buffer holds
+    '''
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self._file, self._map = self._open()
+        _, _, _, _, self.head, self.tail, self.count = _HEADER.unpack_from(self._map, 0)
+
+    def append(self, topic, payload):
+        ''' Appends a message, discarding the oldest messages if there is not enough room
+
+        :returns: The number of messages discarded
+        '''
+        if isinstance(payload, bytes):
+            flag = BINARY_PAYLOAD
+        else:
+            flag = TEXT_PAYLOAD
+            payload = payload.encode('utf-8')
+        topic = topic.encode('utf-8')
+
+        size = _LENGTH.size + _MESSAGE.size + len(topic) + len(payload)
+        if size > self.capacity:
+            logging.error("Message of %d bytes is larger than the outbox, discarding it", size)
+            return 1
+
+        dropped = 0
+        position = self._reserve(size)
+        while position is None:
+            self._skip()
+            dropped += 1
+            position = self._reserve(size)
+
+        offset = _HEADER.size + position
+        _LENGTH.pack_into(self._map, offset, size - _LENGTH.size)
+        _MESSAGE.pack_into(self._map, offset + _LENGTH.size, flag, len(topic))
+        start = offset + _LENGTH.size + _MESSAGE.size
+        self._map[start:start + len(topic)] = topic
+        self._map[start + len(topic):offset + size] = payload
+
+        #Only make the record visible once it is complete
+        self.tail = position + size
+        self.count += 1
+        self._save()
+        return dropped
+
+    def peek(self, limit):
+        ''' Returns up to limit of the oldest messages as (topic, payload) tuples '''
+        messages = []
+        position = self.head
+        for _ in range(0, min(limit, self.count)):
+            position = self._record_start(position)
+            offset = _HEADER.size + position
+            length = _LENGTH.unpack_from(self._map, offset)[0]
+            flag, topic_length = _MESSAGE.unpack_from(self._map, offset + _LENGTH.size)
+            start = offset + _LENGTH.size + _MESSAGE.size
+            end = offset + _LENGTH.size + length
+
+            topic = self._map[start:start + topic_length].decode('utf-8')
+            payload = self._map[start + topic_length:end]
+            if flag == TEXT_PAYLOAD:
+                payload = payload.decode('utf-8')
+            messages.append((topic, payload))
+            position += _LENGTH.size + length
+
+        return messages
+
+    def remove(self, count):
+        ''' Removes the count oldest messages '''
+        for _ in range(0, min(count, self.count)):
+            self._skip()
+        self._save()
+
+    def close(self):
+        ''' Writes the buffer to disk and unmaps it '''
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def _reserve(self, size):
+        ''' Returns the position a record of size bytes can be written at without overwriting
+        older records, writing a wrap marker if it starts again at the beginning of the ring.
+        Returns None if there is not enough room. '''
+        if self.count == 0:
+            self.head = self.tail = 0
+            return 0
+
+        if self.tail > self.head:
+            if self.tail + size <= self.capacity:
+                return self.tail
+            if size <= self.head:
+                if self.capacity - self.tail >= _LENGTH.size:
+                    _LENGTH.pack_into(self._map, _HEADER.size + self.tail, WRAP_MARKER)
+                return 0
+            return None
+
+        if self.tail < self.head and self.tail + size <= self.head:
+            return self.tail
+
+        return None
+
+    def _skip(self):
+        ''' Removes the oldest message '''
+        position = self._record_start(self.head)
+        length = _LENGTH.unpack_from(self._map, _HEADER.size + position)[0]
+        self.head = position + _LENGTH.size + length
+        self.count -= 1
+        if self.count == 0:
+            self.head = self.tail = 0
+
+    def _record_start(self, position):
+        ''' Returns the position of the record at position, following a wrap of the ring '''
+        if self.capacity - position < _LENGTH.size or \
+            _LENGTH.unpack_from(self._map, _HEADER.size + position)[0] == WRAP_MARKER:
+            return 0
+        return position
+
+    def _save(self):
+        ''' Records the head, tail and count in the header '''
+        _HEADER.pack_into(self._map, 0, OUTBOX_MAGIC, OUTBOX_VERSION, 0, self.capacity, \
+            self.head, self.tail, self.count)
+
+    def _open(self):
+        ''' Maps the buffer file, creating it if it does not have the expected capacity '''
+        size = _HEADER.size + self.capacity
+
+        handle = open(self.path, "a+b")
+        handle.seek(0)
+        header = handle.read(_HEADER.size)
+        if len(header) != _HEADER.size or header[0:8] != OUTBOX_MAGIC or \
+            _HEADER.unpack(header)[3] != self.capacity or os.path.getsize(self.path) != size:
+            if header:
+                logging.warning("Outbox %s has a different layout, discarding it", self.path)
+            handle.truncate(0)
+            handle.write(_HEADER.pack(OUTBOX_MAGIC, OUTBOX_VERSION, 0, self.capacity, 0, 0, 0))
+            handle.truncate(size)
+            handle.flush()
+
+        return handle, mmap.mmap(handle.fileno(), size)
+
+class Outbox(object):
+    ''' Publishes messages directly while connected, and through a RingBuffer otherwise
+
+    :param buffer: The RingBuffer holding messages while disconnected
+    :param batch_size: The number of buffered messages replayed at a time once reconnected
+    :param batch_interval: The number of seconds between replayed batches
+    '''
+
+    def __init__(self, buffer, batch_size=100, batch_interval=0.1):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+
+        #True once connected and every buffered message has been replayed
+        self._direct = False
+        #Incremented on every change of connection, so only the replay started by the latest
+        #connection removes messages from the buffer
+        self._generation = 0
+        self._lock = threading.Lock()
+        OUTBOX_MESSAGES.set(buffer.count)
+
+    def publish(self, mqtt_client, topic, message):
+        ''' Publishes a message, or buffers it until the buffered messages have been replayed '''
+        with self._lock:
+            if self._direct or self.buffer is None:
+                mqtt_client.publish(topic, message)
+                return
+
+            dropped = self.buffer.append(topic, message)
+            OUTBOX_MESSAGES.set(self.buffer.count)
+        if dropped:
+            logging.warning("Outbox is full, discarded the %d oldest messages", dropped)
+            OUTBOX_DROPPED.increment(amount=dropped)
+
+    def connected(self, mqtt_client):
+        ''' Replays the buffered messages in the background, then publishes directly '''
+        with self._lock:
+            self._direct = False
+            self._generation += 1
+            generation = self._generation
+
+        thread = threading.Thread(target=self._replay, args=(mqtt_client, generation), \
+            name="OutboxReplay")
+        thread.daemon = True
+        thread.start()
+
+    def disconnected(self):
+        ''' Buffers messages until the connection is restored '''
+        with self._lock:
+            self._direct = False
+            self._generation += 1
+
+    def close(self):
+        ''' Stops buffering and closes the buffer file '''
+        with self._lock:
+            self._direct = False
+            self._generation += 1
+            self.buffer.close()
+            self.buffer = None
+
+    def _replay(self, mqtt_client, generation):
+        ''' Publishes the buffered messages in order until none remain or the connection the replay
+        was started for has changed '''
+        replayed = 0
+        while True:
+            with self._lock:
+                if generation != self._generation:
+                    break
+                batch = self.buffer.peek(self.batch_size)
+                if not batch:
+                    self._direct = True
+                    break
+
+            for topic, message in batch:
+                mqtt_client.publish(topic, message)
+
+            #A batch whose connection changed while it was published is left for the replay of the
+            #next connection, so it may be published twice but is never lost
+            with self._lock:
+                if generation != self._generation:
+                    break
+                self.buffer.remove(len(batch))
+                OUTBOX_MESSAGES.set(self.buffer.count)
+            replayed += len(batch)
+
+            if self.batch_interval > 0:
+                time.sleep(self.batch_interval)
+
+        if replayed:
+            logging.info("Replayed %d messages from the outbox", replayed)
@@ -0,0 +1,172 @@
+'''
+cbModbus pool
+-----------------
+
+A pool of persistent Modbus TCP client connections, keyed by (host, port), used by the client
+adapter so each Modbus request does not pay for a new TCP connection.
+'''
+import logging
+import select
+import socket
+import threading
+import time
+
+from functions import record_connect
+from pymodbus.client.sync import ModbusTcpClient as ModbusClient
+
+class PooledConnection(object):
+    ''' A Modbus client checked out of a ModbusClientPool
+
+    :param key: The (host, port) tuple the client is connected to
+    :param client: The ModbusTcpClient
+    '''
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.reused = False
+        self.last_used = time.time()
+
+class ModbusClientPool(object):
+    ''' A pool of persistent Modbus TCP clients
+
+    :param max_per_host: The maximum number of connections open to a single (host, port) at the
+                         same time. Callers wait for a connection once the limit is reached.
+    :param idle_timeout: The number of seconds an unused connection is kept open
+    :param client_factory: A callable accepting (host, port) and returning an unconnected client
+    '''
+
+    def __init__(self, max_per_host=1, idle_timeout=60, client_factory=ModbusClient):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory
+
+        #(host, port) -> array of idle PooledConnections, most recently used last
+        self._idle = {}
+        #(host, port) -> number of open connections, idle or checked out
+        self._open = {}
+        self._condition = threading.Condition()
+
+    def acquire(self, host, port, timeout=None):
+        ''' Checks out a connected client for a host, opening one if needed
+
+        :param host: The Modbus host
+        :param port: The Modbus port
+        :param timeout: The maximum number of seconds to wait for a connection, None to wait forever
+
+        :returns: A PooledConnection, or None if no connection became available within timeout
+        '''
+        key = (host, port)
+        deadline = None if timeout is None else time.time() + timeout
+
+        self.evict_idle()
+        with self._condition:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    conn = idle.pop()
+                    break
+
+                if self._open.get(key, 0) < self.max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    conn = None
+                    break
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    logging.warning("Timed out waiting for a Modbus connection to %s:%s", host, port)
+                    return None
+                self._condition.wait(remaining)
+
+        try:
+            if conn is None:
+                logging.debug("Opening Modbus connection to %s:%s", host, port)
+                conn = PooledConnection(key, self.client_factory(host, port))
+                _connect(conn.client, host)
+            elif not _is_open(conn.client):
+                logging.debug("Pooled Modbus connection to %s:%s was closed, reconnecting", \
+                    host, port)
+                conn.client.close()
+                _connect(conn.client, host)
+                conn.reused = False
+            else:
+                conn.reused = True
+        except Exception:
+            #The connection counted against max_per_host will never be released
+            with self._condition:
+                self._open[key] -= 1
+                self._condition.notify_all()
+            raise
+
+        return conn
+
+    def release(self, conn, healthy=True):
+        ''' Returns a connection to the pool
+
+        :param conn: The PooledConnection returned by acquire
+        :param healthy: False if the connection failed and should be closed rather than reused
+        '''
+        conn.last_used = time.time()
+        if not healthy or not _is_open(conn.client):
+            logging.debug("Closing Modbus connection to %s:%s", conn.key[0], conn.key[1])
+            conn.client.close()
+            with self._condition:
+                self._open[conn.key] -= 1
+                self._condition.notify_all()
+            return
+
+        with self._condition:
+            self._idle.setdefault(conn.key, []).append(conn)
+            self._condition.notify_all()
+
+    def evict_idle(self):
+        ''' Closes connections that have not been used within idle_timeout '''
+        cutoff = time.time() - self.idle_timeout
+        expired = []
+        with self._condition:
+            for key, idle in self._idle.items():
+                expired.extend([conn for conn in idle if conn.last_used < cutoff])
+                idle[:] = [conn for conn in idle if conn.last_used >= cutoff]
+                self._open[key] -= len([conn for conn in expired if conn.key == key])
+            if expired:
+                self._condition.notify_all()
+
+        for conn in expired:
+            logging.debug("Closing idle Modbus connection to %s:%s", conn.key[0], conn.key[1])
+            conn.client.close()
+
+    def close_all(self):
+        ''' Closes every idle connection. Checked out connections are closed when released. '''
+        with self._condition:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle = {}
+            for conn in idle:
+                self._open[conn.key] -= 1
+            self._condition.notify_all()
+
+        for conn in idle:
+            conn.client.close()
+
+def _connect(client, host):
+    ''' Connects a client, recording the time taken '''
+    started = time.time()
+    record_connect(host, started, client.connect() is not False)
+
+def _is_open(client):
+    ''' Returns True if the client's socket is still open and holds no unread data
+
+    The socket is polled without blocking. A device that closed the connection leaves it readable
+    at the end of stream, and any other readable data is a late response that would be mistaken
+    for the answer to the next request, so neither connection is reused. A connection the device
+    dropped without closing it cleanly is only noticed by the next request.
+    '''
+    sock = getattr(client, 'socket', None)
+    if sock is None:
+        return False
+
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return False
+
+    return not readable
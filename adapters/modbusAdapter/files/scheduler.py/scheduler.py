@@ -0,0 +1,195 @@
+'''
+cbModbus scheduler
+-----------------
+
+Polls scan lists configured for the client adapter and reports values by exception: a scan only
+publishes the addresses whose values changed by more than their deadband since they were last
+published.
+
+Scan list entry structure
+
+{
+    'ModbusHost': host,
+    'ModbusPort': port,
+    'FunctionCode': 1|2|3|4,
+    'UnitID': int,
+    'StartAddress': int,
+    'AddressCount': int,
+    'Interval': seconds,
+    'Deadband': number,
+    'Deadbands': {'address': number}
+}
+'''
+import heapq
+import logging
+import threading
+import time
+
+class Scan(object):
+    ''' A single scan list entry and the values last published for it
+
+    :param entry: The scan list entry
+    :param offset: The number of seconds to wait before the first poll
+    '''
+
+    def __init__(self, entry, offset=0):
+        self.entry = entry
+        self.interval = float(entry.get('Interval', 1))
+        self.deadband = entry.get('Deadband', 0)
+        self.deadbands = dict([(int(address), deadband) for address, deadband in \
+            entry.get('Deadbands', {}).items()])
+        self.next_run = time.time() + offset
+        self.in_flight = False
+        #The number of the latest poll, so results of abandoned polls can be told apart
+        self.poll = 0
+        self.submitted = None
+        self.failing = False
+        #address -> value last published
+        self.published = {}
+
+    def request(self):
+        ''' Returns the Modbus read request polled by the scan '''
+        return dict([(key, value) for key, value in self.entry.items() \
+            if key not in ('Interval', 'Deadband', 'Deadbands')])
+
+    def changes(self, values):
+        ''' Records a poll result and returns the values that should be published
+
+        :param values: The values read, starting at the entry's StartAddress
+
+        :returns: A dictionary of address -> value for every value outside its deadband
+        '''
+        changed = {}
+        for ndx, value in enumerate(values):
+            address = self.entry['StartAddress'] + ndx
+            if address not in self.published or \
+                _outside_deadband(value, self.published[address], \
+                self.deadbands.get(address, self.deadband)):
+                changed[address] = value
+                self.published[address] = value
+
+        return changed
+
+class ScanScheduler(object):
+    ''' Polls scan list entries at their configured intervals
+
+    :param scans: The array of scan list entries
+    :param submit: A callable accepting (request, on_result) that executes a Modbus request
+    :param on_changes: Invoked with (request, changes) when a poll finds changed values
+    :param on_error: Invoked with (request, error) when a scan that was succeeding fails
+    :param poll_timeout: The number of seconds after which a poll that has not completed is
+                         treated as failed, so the scan is polled again when next due
+    '''
+
+    def __init__(self, scans, submit, on_changes, on_error, poll_timeout=30.0):
+        self.submit = submit
+        self.on_changes = on_changes
+        self.on_error = on_error
+        self.poll_timeout = poll_timeout
+        self._scans = []
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        #Spread the first polls of entries sharing an interval across that interval, so they
+        #don't all hit the network at the same moment
+        by_interval = {}
+        for entry in scans:
+            by_interval.setdefault(float(entry.get('Interval', 1)), []).append(entry)
+        for interval, entries in by_interval.items():
+            for ndx, entry in enumerate(entries):
+                self._scans.append(Scan(entry, offset=interval * ndx / len(entries)))
+
+        self._thread = threading.Thread(target=self._run, name="ScanScheduler")
+        self._thread.daemon = True
+
+    def start(self):
+        ''' Starts polling '''
+        logging.info("Starting scan scheduler with %d scan list entries", len(self._scans))
+        self._thread.start()
+
+    def stop(self):
+        ''' Stops polling. Polls in flight still complete. '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        ''' Submits each scan when it is due '''
+        heap = [(scan.next_run, ndx) for ndx, scan in enumerate(self._scans)]
+        heapq.heapify(heap)
+
+        while heap:
+            with self._condition:
+                while not self._stopping and heap[0][0] > time.time():
+                    self._condition.wait(heap[0][0] - time.time())
+                if self._stopping:
+                    return
+
+            _, ndx = heapq.heappop(heap)
+            scan = self._scans[ndx]
+
+            #Skip the poll if the previous one has not completed, rather than queueing behind it
+            if scan.in_flight and time.time() - scan.submitted < self.poll_timeout:
+                logging.debug("Previous poll of %s still in flight, skipping", scan.entry)
+            else:
+                if scan.in_flight:
+                    logging.warning("Poll of %s did not complete within %s seconds", scan.entry, \
+                        self.poll_timeout)
+                    self._complete(scan, scan.poll, {'error': "No response received for Modbus " \
+                        "scan within " + str(self.poll_timeout) + " seconds."})
+                self._poll(scan)
+
+            #Schedule from the previous due time so polls don't drift
+            scan.next_run = max(scan.next_run + scan.interval, time.time())
+            heapq.heappush(heap, (scan.next_run, ndx))
+
+    def _poll(self, scan):
+        ''' Submits the read of a scan, treating a failure to submit it as a failed poll '''
+        with self._condition:
+            scan.poll += 1
+            scan.in_flight = True
+            scan.submitted = time.time()
+            poll = scan.poll
+
+        try:
+            self.submit(scan.request(), lambda response: self._complete(scan, poll, response))
+        except Exception as exc:
+            logging.error("Unable to submit poll of %s: %s", scan.entry, str(exc))
+            self._complete(scan, poll, {'error': "Unable to submit Modbus scan: " + str(exc)})
+
+    def _complete(self, scan, poll, response):
+        ''' Publishes the changes found by a poll
+
+        :param scan: The Scan polled
+        :param poll: The number of the poll, results of earlier polls are ignored
+        :param response: The response dictionary, containing either 'Data' or 'error'
+        '''
+        with self._condition:
+            if poll != scan.poll or not scan.in_flight:
+                logging.debug("Ignoring the result of an abandoned poll of %s", scan.entry)
+                return
+            scan.in_flight = False
+
+        if response is None or response.get('error') is not None:
+            if not scan.failing:
+                scan.failing = True
+                self.on_error(scan.request(), response.get('error') if response is not None \
+                    else "No response received for Modbus scan.")
+            return
+
+        if scan.failing:
+            #Republish every value once the device recovers
+            scan.failing = False
+            scan.published = {}
+
+        changes = scan.changes(response['Data'])
+        if changes:
+            self.on_changes(scan.request(), changes)
+
+def _outside_deadband(value, published, deadband):
+    ''' Returns True if value differs from the published value by more than the deadband '''
+    if isinstance(value, bool) or isinstance(published, bool) or not deadband:
+        return value != published
+    return abs(value - published) > deadband
@@ -0,0 +1,148 @@
+'''
+cbModbus server
+-----------------
+
+The Twisted Modbus TCP server used by the server adapter. It behaves like pymodbus'
+StartTcpServer, but reports failures raised by the ClearBlade datastore with the Modbus exception
+code they carry rather than always answering with Slave Device Failure.
+
+Requests are executed on the reactor's thread pool, since the datastore makes blocking calls to
+the ClearBlade Platform. A slow platform query then only delays the request that made it, while
+other masters and units are served in parallel.
+
+The time taken to answer each request is recorded per function code and unit id, along with the
+number of exception responses sent for each exception code.
+'''
+import logging
+import socket
+import time
+from constants import ModbusErrorCodes
+from metrics import METRICS
+from pymodbus.constants import Defaults
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.server.async import ModbusServerFactory, ModbusTcpProtocol
+from pymodbus.transaction import ModbusSocketFramer
+from twisted.internet import reactor, threads
+
+REQUEST_SECONDS = METRICS.histogram("modbus_server_request_seconds", \
+    "Time taken to answer Modbus requests", ('function_code', 'unit_id'))
+EXCEPTION_RESPONSES = METRICS.counter("modbus_server_exception_responses_total", \
+    "Modbus exception responses sent", ('function_code', 'exception'))
+UNANSWERED_REQUESTS = METRICS.counter("modbus_server_unanswered_requests_total", \
+    "Modbus requests for missing units that were not answered", ('unit_id',))
+
+#ModbusErrorCodes value -> name, used to label exception responses
+EXCEPTION_NAMES = dict([(value, name) for name, value in vars(ModbusErrorCodes).items() \
+    if isinstance(value, int)])
+
+class ClearBladeModbusTcpProtocol(ModbusTcpProtocol):
+    ''' Implements a modbus server in twisted which maps datastore errors to exception codes '''
+
+    def _execute(self, request):
+        ''' Executes the request on a pool thread and sends the result once it is available
+
+        :param request: The decoded request message
+        '''
+        finished = []
+        started = time.time()
+
+        def respond(response):
+            ''' Sends the response unless the deadline already answered the request '''
+            if finished:
+                return
+            finished.append(True)
+            if timer is not None and timer.active():
+                timer.cancel()
+            if response is None:
+                UNANSWERED_REQUESTS.increment((str(request.unit_id),))
+                return # the client will simply timeout waiting for a response
+
+            REQUEST_SECONDS.observe(time.time() - started, \
+                (str(request.function_code), str(request.unit_id)))
+            if hasattr(response, 'exception_code'):
+                EXCEPTION_RESPONSES.increment((str(request.function_code), \
+                    EXCEPTION_NAMES.get(response.exception_code, str(response.exception_code))))
+
+            response.transaction_id = request.transaction_id
+            response.unit_id = request.unit_id
+            self._send(response)
+
+        def timed_out():
+            ''' Answers a request the datastore did not complete within the deadline '''
+            logging.error("Datastore did not fulfill request within %s seconds", \
+                self.factory.request_timeout)
+            respond(request.doException(ModbusErrorCodes.GatewayDeviceFailedtoRespond))
+
+        timer = None
+        if self.factory.request_timeout:
+            timer = reactor.callLater(self.factory.request_timeout, timed_out)
+
+        def failed(failure):
+            ''' Answers a request whose execution raised something _process does not catch '''
+            logging.error("Datastore unable to fulfill request: %s", failure.getErrorMessage())
+            respond(request.doException(ModbusErrorCodes.SlaveDeviceFailure))
+
+        threads.deferToThread(self._process, request).addCallbacks(respond, failed)
+
+    def _process(self, request):
+        ''' Executes the request against the datastore. Runs on a pool thread.
+
+        :param request: The decoded request message
+
+        :returns: The response to send, or None if the request should not be answered
+        '''
+        try:
+            context = self.factory.store[request.unit_id]
+            return request.execute(context)
+        except NoSuchSlaveException:
+            logging.debug("Requested slave does not exist: %s", request.unit_id)
+            if getattr(self.factory, 'ignore_missing_slaves', False):
+                return None
+            return request.doException(ModbusErrorCodes.GatewayDeviceFailedtoRespond)
+        except Exception as exc:
+            logging.error("Datastore unable to fulfill request: %s", str(exc))
+            return request.doException(getattr(exc, 'error_code', \
+                ModbusErrorCodes.SlaveDeviceFailure))
+
+class ClearBladeModbusServerFactory(ModbusServerFactory):
+    ''' Builder class for a ClearBlade modbus server
+
+    :param request_timeout: The number of seconds the datastore may take to fulfill a request
+                            before Gateway Target Device Failed to Respond is returned. 0 waits
+                            for the datastore indefinitely.
+    '''
+
+    protocol = ClearBladeModbusTcpProtocol
+
+    def __init__(self, store, framer=None, identity=None, request_timeout=0):
+        ModbusServerFactory.__init__(self, store, framer, identity)
+        self.request_timeout = request_timeout
+
+def start_tcp_server(context, identity=None, address=None, datastore_threads=10, \
+    request_timeout=0, sock=None):
+    ''' Starts the Modbus TCP server and runs the Twisted reactor until it is stopped
+
+    :param context: The ClearBladeModbusServerContext to serve requests from
+    :param identity: An optional ModbusDeviceIdentification describing the server
+    :param address: An optional (host, port) tuple to listen on
+    :param datastore_threads: The maximum number of requests executed against the datastore at once
+    :param request_timeout: The number of seconds the datastore may take to fulfill a request
+    :param sock: An optional listening socket, shared with other worker processes, to accept
+                 connections on instead of listening on address
+
+    The reactor handles SIGINT and SIGTERM by closing the listening socket, so no new masters
+    connect while it shuts down, and returning once the requests executing on its thread pool
+    have completed.
+    '''
+    address = address or ("", Defaults.Port)
+    factory = ClearBladeModbusServerFactory(context, ModbusSocketFramer, identity, \
+        request_timeout=request_timeout)
+    reactor.suggestThreadPoolSize(datastore_threads)
+
+    logging.info("Starting Modbus TCP Server on %s:%s", address[0], address[1])
+    if sock is not None:
+        port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    else:
+        port = reactor.listenTCP(int(address[1]), factory, interface=address[0])
+    reactor.addSystemEventTrigger('before', 'shutdown', port.stopListening)
+    reactor.run()
@@ -0,0 +1,233 @@
+'''
+cbModbus snapshot
+-----------------
+
+A memory-mapped, fixed layout snapshot of the register image of the server adapter. Every value
+stored in or discarded from the register image is mirrored to the snapshot as it happens, so the
+image can be reloaded within milliseconds when the adapter restarts, before the ClearBlade
+Platform has been queried.
+
+The file holds a header, a table of the unit ids occupying each unit slot, then one block per
+slot. A block holds, for each of the four Modbus tables, a presence bitmap followed by a 16 bit
+value for every address below the snapshot's address limit:
+
+    header      magic (8 bytes), version (uint16), slots (uint16), addresses (uint32)
+    unit table  slots * uint16 unit id, FREE_SLOT when unused
+    blocks      slots * 4 tables * (presence bitmap of addresses bits, addresses * uint16)
+
+All integers are little-endian. Values of addresses beyond the limit, or that do not fit in 16
+bits, are not stored.
+'''
+import logging
+import mmap
+import os
+import struct
+import threading
+
+SNAPSHOT_MAGIC = b"CBMODBUS"
+SNAPSHOT_VERSION = 1
+
+#The order of the tables within a unit block
+SNAPSHOT_TABLES = (
+    'COILS_COLLECTION',
+    'CONTACTS_COLLECTION',
+    'INPUT_REGISTERS_COLLECTION',
+    'OUTPUT_REGISTERS_COLLECTION'
+)
+
+#The unit id recorded for an unused unit slot
+FREE_SLOT = 0xFFFF
+
+_HEADER = struct.Struct("<8sHHI")
+
+class RegisterSnapshot(object):
+    ''' A memory-mapped file holding the values of the register image
+
+    :param path: The path of the snapshot file. It is created if it does not exist, and recreated
+                 if it was written with a different layout.
+    :param slots: The maximum number of unit ids whose values are stored
+    :param addresses: The number of addresses, starting at 0, stored per table
+    '''
+
+    def __init__(self, path, slots=64, addresses=10000):
+        self.path = path
+        self.slots = slots
+        self.addresses = addresses
+
+        self._bitmap_size = (addresses + 7) // 8
+        self._table_size = self._bitmap_size + 2 * addresses
+        self._units_offset = _HEADER.size
+        self._blocks_offset = self._units_offset + 2 * slots
+        self._size = self._blocks_offset + slots * len(SNAPSHOT_TABLES) * self._table_size
+
+        #unit id -> slot
+        self._units = {}
+        self._lock = threading.Lock()
+        self._full_logged = False
+
+        self._file, self._map = self._open()
+        for slot in range(0, slots):
+            unit = struct.unpack_from("<H", self._map, self._units_offset + 2 * slot)[0]
+            if unit != FREE_SLOT:
+                self._units[unit] = slot
+
+    def load(self):
+        ''' Returns every stored value
+
+        :returns: An array of (unit id, table, dictionary of address -> value) tuples
+        '''
+        loaded = []
+        with self._lock:
+            for unit, slot in self._units.items():
+                for table in SNAPSHOT_TABLES:
+                    offset = self._table_offset(slot, table)
+                    bitmap = bytearray(self._map[offset:offset + self._bitmap_size])
+                    values = struct.unpack_from("<%dH" % self.addresses, self._map, \
+                        offset + self._bitmap_size)
+
+                    entries = {}
+                    for ndx, byte in enumerate(bitmap):
+                        if byte == 0xFF:
+                            start = ndx * 8
+                            entries.update(zip(range(start, start + 8), values[start:start + 8]))
+                        elif byte:
+                            for bit in range(0, 8):
+                                if byte & (1 << bit):
+                                    entries[ndx * 8 + bit] = values[ndx * 8 + bit]
+                    if entries:
+                        loaded.append((unit, table, entries))
+
+        return loaded
+
+    def put(self, slave, table, entries):
+        ''' Stores values of a unit
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the values belong to
+        :param entries: An iterable of (address, value) tuples
+        '''
+        with self._lock:
+            slot = self._slot(slave, True)
+            if slot is None:
+                return
+
+            offset = self._table_offset(slot, table)
+            for address, value in entries:
+                if address < 0 or address >= self.addresses:
+                    continue
+
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    value = -1
+
+                if 0 <= value <= 0xFFFF:
+                    struct.pack_into("<H", self._map, offset + self._bitmap_size + 2 * address, \
+                        value)
+                    self._set_present(offset, address, True)
+                else:
+                    self._set_present(offset, address, False)
+
+    def clear(self, slave=None, table=None, address=None, count=1):
+        ''' Discards stored values
+
+        :param slave: The unit id to discard, or None for every unit
+        :param table: The table to discard, or None for every table
+        :param address: The starting address to discard, or None for the whole table
+        :param count: The number of addresses to discard
+        '''
+        with self._lock:
+            units = list(self._units.keys()) if slave is None else [slave]
+            for unit in units:
+                slot = self._slot(unit, False)
+                if slot is None:
+                    continue
+
+                for name in SNAPSHOT_TABLES if table is None else (table,):
+                    offset = self._table_offset(slot, name)
+                    if address is None:
+                        self._map[offset:offset + self._bitmap_size] = \
+                            b"\x00" * self._bitmap_size
+                    else:
+                        for addr in range(max(address, 0), min(address + count, \
+                            self.addresses)):
+                            self._set_present(offset, addr, False)
+
+                if table is None and address is None:
+                    #Free the slot of a unit that no longer has any values
+                    struct.pack_into("<H", self._map, self._units_offset + 2 * slot, FREE_SLOT)
+                    del self._units[unit]
+
+    def flush(self):
+        ''' Writes the snapshot to disk '''
+        with self._lock:
+            self._map.flush()
+
+    def close(self):
+        ''' Writes the snapshot to disk and unmaps it '''
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+    def _open(self):
+        ''' Maps the snapshot file, creating it if it does not have the expected layout '''
+        header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.slots, self.addresses)
+
+        handle = open(self.path, "a+b")
+        handle.seek(0)
+        if handle.read(_HEADER.size) != header or os.path.getsize(self.path) != self._size:
+            if os.path.getsize(self.path) > 0:
+                logging.warning("Register snapshot %s has a different layout, discarding it", \
+                    self.path)
+            handle.truncate(0)
+            handle.seek(0)
+            handle.write(header)
+            handle.write(struct.pack("<%dH" % self.slots, *([FREE_SLOT] * self.slots)))
+            handle.truncate(self._size)
+            handle.flush()
+        else:
+            logging.info("Loading register snapshot %s", self.path)
+
+        return handle, mmap.mmap(handle.fileno(), self._size)
+
+    def _slot(self, slave, allocate):
+        ''' Returns the slot of a unit, allocating a free one if allocate is True
+
+        :returns: The slot, or None if the unit has none
+        '''
+        slot = self._units.get(slave)
+        if slot is not None or not allocate:
+            return slot
+
+        if not 0 <= slave < FREE_SLOT:
+            return None
+
+        used = set(self._units.values())
+        for slot in range(0, self.slots):
+            if slot not in used:
+                #The presence bitmaps of a slot are cleared when it is freed
+                struct.pack_into("<H", self._map, self._units_offset + 2 * slot, slave)
+                self._units[slave] = slot
+                return slot
+
+        if not self._full_logged:
+            logging.warning("Register snapshot %s has no free unit slots, unit %s is not stored", \
+                self.path, slave)
+            self._full_logged = True
+        return None
+
+    def _table_offset(self, slot, table):
+        ''' Returns the offset of the presence bitmap of a table of a slot '''
+        return self._blocks_offset + (slot * len(SNAPSHOT_TABLES) + \
+            SNAPSHOT_TABLES.index(table)) * self._table_size
+
+    def _set_present(self, offset, address, present):
+        ''' Sets or clears the presence bit of an address '''
+        position = offset + address // 8
+        byte = struct.unpack_from("<B", self._map, position)[0]
+        if present:
+            byte |= 1 << (address % 8)
+        else:
+            byte &= ~(1 << (address % 8)) & 0xFF
+        struct.pack_into("<B", self._map, position, byte)
@@ -5,23 +5,203 @@ cbModbus store
 A class representing a Modbus datastore which integrates with a ClearBlade Platform.
 '''
 import logging
+import threading
+import time
 import cbData
 from constants import ModbusFunctionCodes, ModbusErrorCodes
 from pymodbus.datastore.store import BaseModbusDataBlock
 from pymodbus.exceptions import ParameterException
 
+#Maps each supported function code to the key of the MODBUS_DATA_COLLECTIONS entry holding
+#the table the function code operates on
+FUNCTION_CODE_COLLECTIONS = {
+    ModbusFunctionCodes.ReadCoil: 'COILS_COLLECTION',
+    ModbusFunctionCodes.WriteSingleCoil: 'COILS_COLLECTION',
+    ModbusFunctionCodes.WriteMultipleCoils: 'COILS_COLLECTION',
+    ModbusFunctionCodes.ReadDiscreteInput: 'CONTACTS_COLLECTION',
+    ModbusFunctionCodes.ReadHoldingRegisters: 'OUTPUT_REGISTERS_COLLECTION',
+    ModbusFunctionCodes.WriteSingleHoldingRegister: 'OUTPUT_REGISTERS_COLLECTION',
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters: 'OUTPUT_REGISTERS_COLLECTION',
+    ModbusFunctionCodes.MaskWriteRegister: 'OUTPUT_REGISTERS_COLLECTION',
+    ModbusFunctionCodes.ReadWriteMultipleRegisters: 'OUTPUT_REGISTERS_COLLECTION',
+    ModbusFunctionCodes.ReadInputRegisters: 'INPUT_REGISTERS_COLLECTION'
+}
+
+WRITE_FUNCTION_CODES = (
+    ModbusFunctionCodes.WriteSingleCoil,
+    ModbusFunctionCodes.WriteMultipleCoils,
+    ModbusFunctionCodes.WriteSingleHoldingRegister,
+    ModbusFunctionCodes.WriteMultipleHoldingRegisters,
+    ModbusFunctionCodes.MaskWriteRegister,
+    ModbusFunctionCodes.ReadWriteMultipleRegisters
+)
+
+#Maps each writable table to the cbData function writing it through to the ClearBlade Platform.
+#pymodbus executes FC22 as a getValues/setValues pair and FC23 as a setValues/getValues pair, so
+#both only need their table mapped.
+TABLE_WRITERS = {
+    'COILS_COLLECTION': cbData.write_coils,
+    'OUTPUT_REGISTERS_COLLECTION': cbData.write_holding_registers
+}
+
+class RegisterImage(object):
+    ''' An in-memory image of the Modbus data collections, keyed by unit id and table
+
+    :param ttl: The number of seconds a value remains valid after it was loaded from or written to
+                the ClearBlade Platform. A negative value means values never expire.
+    :param snapshot: An optional RegisterSnapshot the image is loaded from and mirrored to. Values
+                     loaded from it are valid for ttl seconds, and stale values are served when
+                     the ClearBlade Platform cannot be reached.
+    '''
+
+    def __init__(self, ttl=-1, snapshot=None):
+        self.ttl = ttl
+        self.snapshot = snapshot
+        self._tables = {}
+        self._lock = threading.RLock()
+
+        if snapshot is not None:
+            self._load_snapshot()
+
+    def get(self, slave, table, address, count=1, stale=False):
+        ''' Returns the values for a range of addresses if all of them are present and fresh
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param address: The starting address
+        :param count: The number of values to retrieve
+        :param stale: Set to True to return values regardless of their age
+
+        :returns: An array of values, or None if any address is missing or stale
+        '''
+        now = time.time()
+        with self._lock:
+            entries = self._tables.get((slave, table))
+            if entries is None:
+                return None
+
+            values = []
+            for addr in range(address, address + count):
+                entry = entries.get(addr)
+                if entry is None or (not stale and (entry[1] is None or \
+                    (self.ttl >= 0 and now - entry[1] > self.ttl))):
+                    return None
+                values.append(entry[0])
+            return values
+
+    def put(self, slave, table, address, values):
+        ''' Stores the values for a contiguous range of addresses
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the addresses belong to
+        :param address: The starting address
+        :param values: The values to store
+        '''
+        now = time.time()
+        with self._lock:
+            entries = self._tables.setdefault((slave, table), {})
+            for ndx, value in enumerate(values):
+                entries[address + ndx] = (value, now)
+
+            if self.snapshot is not None:
+                self.snapshot.put(slave, table, [(address + ndx, value) \
+                    for ndx, value in enumerate(values)])
+
+    def load_rows(self, slave, table, rows):
+        ''' Stores the rows returned from a ClearBlade Platform collection query
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the rows were read from
+        :param rows: The rows returned by cbData.read_collection_data
+        '''
+        now = time.time()
+        with self._lock:
+            entries = self._tables.setdefault((slave, table), {})
+            for row in rows:
+                entries[row["data_address"]] = (row["data_value"], now)
+
+            if self.snapshot is not None:
+                self.snapshot.put(slave, table, [(row["data_address"], row["data_value"]) \
+                    for row in rows])
+
+    def invalidate(self, slave=None, table=None, address=None, count=1):
+        ''' Discards stored values so they are reloaded from the ClearBlade Platform
+
+        :param slave: The unit id to invalidate, or None for every unit
+        :param table: The table to invalidate, or None for every table
+        :param address: The starting address to invalidate, or None for the whole table
+        :param count: The number of addresses to invalidate
+        '''
+        with self._lock:
+            for key in list(self._tables.keys()):
+                if (slave is not None and key[0] != slave) or \
+                    (table is not None and key[1] != table):
+                    continue
+
+                if address is None:
+                    del self._tables[key]
+                else:
+                    entries = self._tables[key]
+                    for addr in range(address, address + count):
+                        entries.pop(addr, None)
+
+            if self.snapshot is not None:
+                self.snapshot.clear(slave, table, address, count)
+
+    def expire(self, slave=None):
+        ''' Marks stored values as stale so they are reloaded from the ClearBlade Platform when next
+        read. Unlike invalidate, the values and the snapshot are kept and can still be served when
+        the ClearBlade Platform cannot be reached.
+
+        :param slave: The unit id to expire, or None for every unit
+        '''
+        with self._lock:
+            for key, entries in self._tables.items():
+                if slave is not None and key[0] != slave:
+                    continue
+
+                for addr, entry in list(entries.items()):
+                    entries[addr] = (entry[0], None)
+
+    def _load_snapshot(self):
+        ''' Loads the values stored in the snapshot '''
+        started = time.time()
+        loaded = 0
+        with self._lock:
+            for slave, table, values in self.snapshot.load():
+                entries = self._tables.setdefault((slave, table), {})
+                for address, value in values.items():
+                    entries[address] = (value, started)
+                loaded += len(values)
+
+        logging.info("Loaded %d register values from the snapshot in %.3f seconds", loaded, \
+            time.time() - started)
+
 class CbModbusDatastore(BaseModbusDataBlock):
     ''' A modbus datastore integrated with the ClearBlade Platform '''
 
-    def __init__(self, cbsystem, cbauth):
+    def __init__(self, cbsystem, cbauth, image=None, writer=None, index=None, relay=None):
         ''' Initializes the datastore
 
         :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
                          will communicate with.
         :param cbauth:   The object representing the ClearBlade Platform authentication credentials.
+        :param image:    An optional RegisterImage used to serve reads from memory. Writes update
+                         the image and are written through to the ClearBlade Platform.
+        :param writer:   An optional WriteBehindQueue. When present, writes are acknowledged once
+                         queued and saved to the ClearBlade Platform in the background.
+        :param index:    An optional AddressIndex. When present, requests are validated against it
+                         instead of the ClearBlade Platform.
+        :param relay:    An optional WriteRelay that successful writes are sent to, so the other
+                         worker processes can update their register images.
         '''
         self.cbsystem = cbsystem
         self.cbauth = cbauth
+        self.image = image
+        self.writer = writer
+        self.index = index
+        self.relay = relay
+        self._request = threading.local()
 
     def validate(self, slave, fx, address, count=1):
         ''' Checks to see if the request is in range
@@ -33,28 +213,20 @@ class CbModbusDatastore(BaseModbusDataBlock):
         '''
         logging.debug("In CbModbusDatastore.validate")
 
-        if fx == ModbusFunctionCodes.ReadCoil or \
-            fx == ModbusFunctionCodes.WriteSingleCoil or \
-            fx == ModbusFunctionCodes.WriteMultipleCoils:
+        if self.index is not None:
+            return self.index.validate(slave, self._get_table(fx, "validate"), address, count)
 
-            return cbData.validate_coil_address(self.cbsystem, self.cbauth, slave, address, count)
-        elif fx == ModbusFunctionCodes.ReadDiscreteInput:
-            return cbData.validate_discrete_input_address(self.cbsystem, self.cbauth, slave, \
-                address, count)
-        elif fx == ModbusFunctionCodes.ReadHoldingRegisters or \
-            fx == ModbusFunctionCodes.WriteSingleHoldingRegister or \
-            fx == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
-
-            return cbData.validate_holding_reg_address(self.cbsystem, self.cbauth, slave, \
-                    address, count)
-        elif fx == ModbusFunctionCodes.ReadInputRegisters:
-            return cbData.validate_input_reg_address(self.cbsystem, self.cbauth, slave, \
-                    address, count)
-        else:
-            raise ParameterException("Invalid function code received for \
-                CbModbusDatastore.validate request. Function code received = " + str(fx))
+        if self.image is not None:
+            return len(self._read_image(slave, fx, address, count, "validate")) >= count
+
+        #pymodbus invokes getValues with the same range right after a successful validate, so
+        #keep the rows around for it rather than querying the collection a second time
+        table = self._get_table(fx, "validate")
+        rows = self._read_rows(slave, table, address, count)
+        self._request.rows = (slave, table, address, count, rows)
 
-        return True
+        return cbData.validate_address(self.cbsystem, self.cbauth, slave, address, count, \
+            cbData.MODBUS_DATA_COLLECTIONS[table], rows=rows)
 
     def getValues(self, slave, fx, address, count=1):
         ''' Returns the requested values of the datastore
@@ -66,23 +238,16 @@ class CbModbusDatastore(BaseModbusDataBlock):
         '''
         logging.debug("In CbModbusDatastore.getValues")
 
-        if fx == ModbusFunctionCodes.ReadCoil or \
-            fx == ModbusFunctionCodes.WriteSingleCoil or \
-            fx == ModbusFunctionCodes.WriteMultipleCoils:
-
-            return cbData.read_coils(self.cbsystem, self.cbauth, slave, address, count)
-        elif fx == ModbusFunctionCodes.ReadDiscreteInput:
-            return cbData.read_discrete_inputs(self.cbsystem, self.cbauth, slave, address, count)
-        elif fx == ModbusFunctionCodes.ReadHoldingRegisters or \
-            fx == ModbusFunctionCodes.WriteSingleHoldingRegister or \
-            fx == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
-
-            return cbData.read_holding_registers(self.cbsystem, self.cbauth, slave, address, count)
-        elif fx == ModbusFunctionCodes.ReadInputRegisters:
-            return cbData.read_input_registers(self.cbsystem, self.cbauth, slave, address, count)
-        else:
-            raise ParameterException("Invalid function code received for \
-                CbModbusDatastore.getValues request. Function code received = " + str(fx))
+        if self.image is not None:
+            return self._read_image(slave, fx, address, count, "getValues")
+
+        table = self._get_table(fx, "getValues")
+        rows = self._take_validated_rows(slave, table, address, count)
+        if rows is None:
+            rows = self._read_rows(slave, table, address, count)
+
+        return cbData.read_modbus_data(self.cbsystem, self.cbauth, slave, address, count, \
+            cbData.MODBUS_DATA_COLLECTIONS[table], rows=rows)
 
     def setValues(self, slave, fx, address, values):
         ''' Sets the requested values of the datastore
@@ -92,14 +257,131 @@ class CbModbusDatastore(BaseModbusDataBlock):
         '''
         logging.debug("In CbModbusDatastore.setValues")
 
-        if fx == ModbusFunctionCodes.WriteSingleCoil or \
-            fx == ModbusFunctionCodes.WriteMultipleCoils:
+        #Rows read during validation no longer reflect the collection once it is written to
+        self._request.rows = None
 
-            cbData.write_coils(self.cbsystem, self.cbauth, slave, address, values)
-        elif fx == ModbusFunctionCodes.WriteSingleHoldingRegister or \
-            fx == ModbusFunctionCodes.WriteMultipleHoldingRegisters:
+        if self.writer is not None and fx in WRITE_FUNCTION_CODES:
+            self.writer.submit(slave, FUNCTION_CODE_COLLECTIONS[fx], address, values)
+            self._put_image(slave, fx, address, values)
+            self._relay_write(slave, fx, address, values)
+            return
 
-            cbData.write_holding_registers(self.cbsystem, self.cbauth, slave, address, values)
-        else:
+        try:
+            if fx not in WRITE_FUNCTION_CODES:
+                raise ParameterException("Invalid function code received for \
+                    CbModbusDatastore.setValues request.  Function code received = " + str(fx))
+
+            self._put_image(slave, fx, address, values)
+            TABLE_WRITERS[FUNCTION_CODE_COLLECTIONS[fx]](self.cbsystem, self.cbauth, slave, \
+                address, values)
+            self._relay_write(slave, fx, address, values)
+        except cbData.CbDataWriteException as exc:
+            #Don't serve values the ClearBlade Platform never received
+            if self.image is not None:
+                for addr in exc.addresses:
+                    self.image.invalidate(slave, FUNCTION_CODE_COLLECTIONS[fx], addr)
+            raise
+        except Exception:
+            if self.image is not None and fx in FUNCTION_CODE_COLLECTIONS:
+                self.image.invalidate(slave, FUNCTION_CODE_COLLECTIONS[fx], address, len(values))
+            raise
+
+    def _put_image(self, slave, fx, address, values):
+        ''' Records written values in the register image before they are written through
+
+        :param fx: The function code of the request
+        :param address: The starting address
+        :param values: The new values to be set
+        '''
+        if self.image is not None:
+            self.image.put(slave, FUNCTION_CODE_COLLECTIONS[fx], address, values)
+
+    def _relay_write(self, slave, fx, address, values):
+        ''' Sends a successful write to the other worker processes
+
+        :param fx: The function code of the request
+        :param address: The starting address
+        :param values: The values written
+        '''
+        if self.relay is not None:
+            self.relay.publish(slave, FUNCTION_CODE_COLLECTIONS[fx], address, values)
+
+    def _get_table(self, fx, operation):
+        ''' Returns the MODBUS_DATA_COLLECTIONS key of the table a function code operates on
+
+        :param fx: The function code of the request
+        :param operation: The name of the calling operation, used in error messages
+        '''
+        if fx not in FUNCTION_CODE_COLLECTIONS:
             raise ParameterException("Invalid function code received for \
-                CbModbusDatastore.setValues request.  Function code received = " + str(fx))
+                CbModbusDatastore." + operation + " request. Function code received = " + str(fx))
+
+        return FUNCTION_CODE_COLLECTIONS[fx]
+
+    def _read_rows(self, slave, table, address, count):
+        ''' Reads the rows for a range of addresses from the ClearBlade Platform
+
+        :param table: The table being read
+        :param address: The starting address
+        :param count: The number of values to retrieve
+
+        :returns: The rows, including any queued writes that have not been saved yet
+        '''
+        rows = cbData.read_collection_data(self.cbsystem, self.cbauth, slave, address, count, \
+            cbData.MODBUS_DATA_COLLECTIONS[table])
+        if self.writer is not None:
+            self.writer.overlay_rows(slave, table, rows)
+
+        return rows
+
+    def _take_validated_rows(self, slave, table, address, count):
+        ''' Returns the rows fetched by the preceding validate call of the current request
+
+        :param table: The table being read
+        :param address: The starting address
+        :param count: The number of values to retrieve
+
+        :returns: The rows if the preceding validate call read the same range, None otherwise
+        '''
+        pending = getattr(self._request, 'rows', None)
+        self._request.rows = None
+
+        if pending is not None and pending[0:4] == (slave, table, address, count):
+            logging.debug("Reusing rows read by validate for unit %s, %s %d:%d", slave, table, \
+                address, count)
+            return pending[4]
+
+        return None
+
+    def _read_image(self, slave, fx, address, count, operation):
+        ''' Returns values from the register image, loading them from the platform when needed
+
+        :param fx: The function code of the request
+        :param address: The starting address
+        :param count: The number of values to retrieve
+        :param operation: The name of the calling operation, used in error messages
+
+        :returns: The values present for address:address+count
+        '''
+        table = self._get_table(fx, operation)
+        values = self.image.get(slave, table, address, count)
+        if values is not None:
+            logging.debug("Register image hit for unit %s, %s %d:%d", slave, table, address, count)
+            return values
+
+        logging.debug("Register image miss for unit %s, %s %d:%d", slave, table, address, count)
+        try:
+            rows = self._read_rows(slave, table, address, count)
+        except Exception as exc:
+            #Keep serving the last known values while the platform cannot be reached
+            values = None if self.image.snapshot is None else \
+                self.image.get(slave, table, address, count, stale=True)
+            if values is None:
+                raise
+
+            logging.warning("Serving last known values for unit %s, %s %d:%d: %s", slave, table, \
+                address, count, str(exc))
+            return values
+        self.image.load_rows(slave, table, rows)
+
+        return [row["data_value"] for row in sorted(rows, key=lambda row: row["data_address"])]
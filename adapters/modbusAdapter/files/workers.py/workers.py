@@ -0,0 +1,326 @@
+'''
+cbModbus workers
+-----------------
+
+Runs the server adapter as several worker processes sharing a single listening socket, so Modbus
+requests are served on every core. The supervisor opens the socket and forks the workers, each of
+which accepts connections on it with its own server context and ClearBlade Platform session.
+
+Writes made by one worker are relayed to the others through the supervisor, over a pair of pipes
+per worker, so the register images of every worker stay coherent. The supervisor relays writes
+and restarts workers from a single thread, so it never forks while another thread holds a lock
+the worker would inherit.
+'''
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+#The number of seconds the supervisor waits for relayed writes before checking for exited workers
+POLL_INTERVAL = 0.5
+
+#The number of seconds before a worker that exited soon after it was started is restarted. The
+#delay doubles with every consecutive early exit of the workers in a slot.
+RESTART_BACKOFF = 1.0
+
+class WriteRelay(object):
+    ''' The worker side of the write relay
+
+    :param send_fd: The pipe file descriptor writes are sent to the supervisor on
+    :param receive_fd: The pipe file descriptor the writes of other workers are received on
+    '''
+
+    def __init__(self, send_fd, receive_fd):
+        self._send = os.fdopen(send_fd, 'w')
+        self._receive_fd = receive_fd
+        self._lock = threading.Lock()
+
+    def start(self, on_write):
+        ''' Starts applying the writes made by other workers
+
+        :param on_write: Invoked with (slave, table, address, values) for every relayed write
+        '''
+        def receive():
+            ''' Applies relayed writes until the supervisor closes the pipe '''
+            for line in os.fdopen(self._receive_fd, 'r'):
+                try:
+                    on_write(*json.loads(line))
+                except Exception as exc:
+                    logging.error("Unable to apply relayed write %s: %s", line.strip(), str(exc))
+
+        thread = threading.Thread(target=receive, name="WriteRelay")
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, slave, table, address, values):
+        ''' Sends a write made by this worker to the other workers
+
+        :param slave: The unit id written to
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry written to
+        :param address: The starting address
+        :param values: The values written
+        '''
+        line = json.dumps([slave, table, address, list(values)]) + "\n"
+        try:
+            with self._lock:
+                self._send.write(line)
+                self._send.flush()
+        except (IOError, OSError) as exc:
+            logging.error("Unable to relay write to the other workers: %s", str(exc))
+
+class _Worker(object):
+    ''' The supervisor side of a worker process '''
+
+    def __init__(self, pid, slot, receive_fd, send_fd):
+        self.pid = pid
+        self.slot = slot
+        self.started = time.time()
+        self.receive_fd = receive_fd
+        self.send_fd = send_fd
+        #The start of a write whose end has not been received yet
+        self.partial = b""
+
+    def received(self, data):
+        ''' Returns the complete writes, one per line, that data finishes '''
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return [line + b"\n" for line in lines]
+
+class WorkerSupervisor(object):
+    ''' Forks the worker processes, relays writes between them and restarts any that exit
+
+    :param count: The number of worker processes
+    :param address: The (host, port) tuple to listen on
+    :param start_worker: Invoked in each worker process with (listening socket, WriteRelay, slot),
+                         where slot is the index of the worker between 0 and count - 1. A
+                         restarted worker keeps the slot of the worker it replaces. It serves
+                         requests until the worker is asked to stop.
+    :param shutdown_timeout: The number of seconds workers are given to exit once asked to stop
+    :param stable_uptime: The number of seconds a worker must run for before it exiting is no
+                          longer counted as a failure to start
+    :param max_restart_backoff: The maximum number of seconds before a worker that keeps failing
+                                to start is restarted
+    '''
+
+    def __init__(self, count, address, start_worker, shutdown_timeout=10, stable_uptime=30.0, \
+        max_restart_backoff=60.0):
+        self.count = count
+        self.address = address
+        self.start_worker = start_worker
+        self.shutdown_timeout = shutdown_timeout
+        self.stable_uptime = stable_uptime
+        self.max_restart_backoff = max_restart_backoff
+        self.socket = None
+
+        self._workers = {}
+        self._stopping = False
+        #slot -> the restart delay of the last worker of the slot that exited before stable_uptime
+        self._backoff = {}
+        #slot -> the time the worker of the slot is due to be restarted
+        self._restarts = {}
+
+    def run(self):
+        ''' Runs the workers until the supervisor receives SIGINT or SIGTERM '''
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.address[0], int(self.address[1])))
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+
+        logging.info("Starting %d Modbus server workers on %s:%s", self.count, self.address[0], \
+            self.address[1])
+        for slot in range(0, self.count):
+            self._spawn(slot)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        while not self._stopping:
+            self._relay(POLL_INTERVAL)
+
+            for pid, status in _exited():
+                worker = self._forget(pid)
+                if worker is not None and not self._stopping:
+                    self._schedule_restart(worker, status)
+
+            now = time.time()
+            for slot, restart_at in list(self._restarts.items()):
+                if restart_at <= now and not self._stopping:
+                    del self._restarts[slot]
+                    self._spawn(slot)
+
+        self._wait_for_workers()
+        self.socket.close()
+        logging.info("Modbus server workers stopped")
+
+    def stop(self):
+        ''' Asks every worker to stop '''
+        self._stopping = True
+        for pid in list(self._workers.keys()):
+            _signal(pid, signal.SIGTERM)
+
+    def _schedule_restart(self, worker, status):
+        ''' Schedules the restart of an exited worker, backing off while its slot keeps failing
+
+        :param worker: The _Worker that exited
+        :param status: The exit status of the worker process
+        '''
+        if time.time() - worker.started >= self.stable_uptime:
+            self._backoff.pop(worker.slot, None)
+            delay = 0
+        else:
+            delay = min(self._backoff.get(worker.slot, RESTART_BACKOFF / 2) * 2, \
+                self.max_restart_backoff)
+            self._backoff[worker.slot] = delay
+
+        logging.error("Modbus server worker %d exited with status %d, restarting it in %.1f " \
+            "seconds", worker.pid, status, delay)
+        self._restarts[worker.slot] = time.time() + delay
+
+    def _spawn(self, slot):
+        ''' Forks a worker process
+
+        :param slot: The index of the worker
+        '''
+        to_supervisor = os.pipe()
+        from_supervisor = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            #Worker process. Only keep the pipe ends of this worker.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.close(to_supervisor[0])
+            os.close(from_supervisor[1])
+            for worker in self._workers.values():
+                _close(worker.receive_fd)
+                _close(worker.send_fd)
+
+            code = 0
+            try:
+                self.start_worker(self.socket, WriteRelay(to_supervisor[1], from_supervisor[0]), \
+                    slot)
+            except Exception as exc:
+                logging.error("Modbus server worker failed: %s", str(exc))
+                code = 1
+            finally:
+                os._exit(code)
+
+        os.close(to_supervisor[1])
+        os.close(from_supervisor[0])
+        self._workers[pid] = _Worker(pid, slot, to_supervisor[0], from_supervisor[1])
+        logging.info("Started Modbus server worker %d", pid)
+
+    def _relay(self, timeout):
+        ''' Forwards the writes received from workers to every other worker
+
+        :param timeout: The maximum number of seconds to wait for writes
+        '''
+        sources = dict([(worker.receive_fd, worker) for worker in self._workers.values() \
+            if worker.receive_fd is not None])
+        try:
+            readable, _, _ = select.select(list(sources.keys()), [], [], timeout)
+        except (select.error, OSError) as exc:
+            if exc.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            source = sources[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                #The worker is exiting, it is forgotten once it has been reaped
+                os.close(fd)
+                source.receive_fd = None
+                continue
+
+            lines = source.received(data)
+            for worker in list(self._workers.values()):
+                if worker is source or worker.send_fd is None:
+                    continue
+                try:
+                    for line in lines:
+                        _write_all(worker.send_fd, line)
+                except OSError:
+                    #The worker exited, it is restarted with an empty register image
+                    pass
+
+    def _forget(self, pid):
+        ''' Discards an exited worker
+
+        :returns: The _Worker that exited, or None if pid was not a worker
+        '''
+        worker = self._workers.pop(pid, None)
+        if worker is None:
+            return None
+
+        _close(worker.receive_fd)
+        _close(worker.send_fd)
+        worker.receive_fd = None
+        worker.send_fd = None
+        return worker
+
+    def _wait_for_workers(self):
+        ''' Waits for the workers to exit, killing any still running after the shutdown timeout '''
+        deadline = time.time() + self.shutdown_timeout
+        while self._workers and time.time() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    break
+                continue
+            if pid == 0:
+                time.sleep(0.1)
+            else:
+                self._forget(pid)
+
+        for pid in list(self._workers.keys()):
+            logging.error("Modbus server worker %d did not stop, killing it", pid)
+            _signal(pid, signal.SIGKILL)
+            self._forget(pid)
+
+def _exited():
+    ''' Reaps the child processes that have exited
+
+    :returns: An array of (pid, status) tuples
+    '''
+    exited = []
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            if exc.errno == errno.ECHILD:
+                return exited
+            raise
+        if pid == 0:
+            return exited
+        exited.append((pid, status))
+
+def _write_all(fd, data):
+    ''' Writes every byte of data to a file descriptor '''
+    while data:
+        data = data[os.write(fd, data):]
+
+def _close(fd):
+    ''' Closes a file descriptor that may already be closed '''
+    if fd is None:
+        return
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+def _signal(pid, signum):
+    ''' Sends a signal to a process that may have already exited '''
+    try:
+        os.kill(pid, signum)
+    except OSError:
+        pass
@@ -0,0 +1,256 @@
+'''
+cbModbus writebehind
+-----------------
+
+A write-behind queue that lets the server adapter acknowledge Modbus writes as soon as they are
+recorded locally. Values are flushed to the ClearBlade Platform data collections from a
+background thread, and repeated writes to the same address are collapsed into a single update.
+Values the platform does not accept are retried with an increasing delay, and dropped once they
+have failed too many times.
+'''
+import logging
+import threading
+import time
+import cbData
+from constants import ModbusErrorCodes
+from metrics import METRICS
+
+DROPPED_WRITES = METRICS.counter("modbus_server_write_behind_dropped_total", \
+    "Queued writes dropped after repeatedly failing to save", ('table',))
+
+class WriteBehindQueue(object):
+    ''' A bounded, coalescing queue of pending collection writes
+
+    :param cbsystem: The ClearBlade system object representing the ClearBlade System the adapter
+                     will communicate with.
+    :param cbauth: The object representing the ClearBlade Platform authentication credentials.
+    :param interval: The maximum number of seconds a write waits before being flushed
+    :param batch_size: The number of pending addresses that triggers an immediate flush
+    :param max_pending: The maximum number of pending addresses. Writes that would exceed it wait
+                        for the worker to make room, unless nothing is pending.
+    :param block_timeout: The number of seconds a write waits for room before it is rejected with
+                          SlaveDeviceBusy
+    :param max_retries: The number of times a value that failed to save is retried before it is
+                        dropped
+    :param max_backoff: The maximum number of seconds the worker waits before retrying after a
+                        failed flush. The wait starts at interval and doubles after every failure.
+    '''
+
+    def __init__(self, cbsystem, cbauth, interval=1.0, batch_size=100, max_pending=10000, \
+        block_timeout=5.0, max_retries=10, max_backoff=60.0):
+        self.cbsystem = cbsystem
+        self.cbauth = cbauth
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+        #(unit id, table, address) -> value, for writes not yet taken by the worker
+        self._pending = {}
+        #(unit id, table, address) -> value, for writes the worker is currently saving
+        self._inflight = {}
+        #(unit id, table, address) -> the number of failed attempts to save the pending value
+        self._attempts = {}
+        self._first_pending = None
+        #The time before which failed writes are not retried, None unless the last flush failed
+        self._retry_at = None
+        self._backoff = 0
+        self._stopping = False
+        self._condition = threading.Condition()
+
+        self._worker = threading.Thread(target=self._run, name="WriteBehindQueue")
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, slave, table, address, values):
+        ''' Records a write to be flushed to the ClearBlade Platform
+
+        :param slave: The unit id of the modbus device
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry being written
+        :param address: The starting address
+        :param values: The new values to be set
+
+        :raises CbDataWriteException: If the queue stays full for longer than block_timeout
+        '''
+        keys = [(slave, table, address + ndx) for ndx in range(0, len(values))]
+        deadline = time.time() + self.block_timeout
+
+        with self._condition:
+            if self._stopping:
+                raise cbData.CbDataWriteException("Write-behind queue is stopping", \
+                    ModbusErrorCodes.SlaveDeviceBusy, [key[2] for key in keys])
+
+            #A write larger than max_pending is accepted once nothing else is pending
+            while self._pending and len(self._pending) + \
+                len([key for key in keys if key not in self._pending]) > self.max_pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning("Write-behind queue full, rejecting write to unit %s, %s %d:%d", \
+                        slave, table, address, len(values))
+                    raise cbData.CbDataWriteException("Write-behind queue is full", \
+                        ModbusErrorCodes.SlaveDeviceBusy, [key[2] for key in keys])
+                self._condition.wait(remaining)
+
+            for ndx, key in enumerate(keys):
+                self._pending[key] = values[ndx]
+                self._attempts.pop(key, None)
+
+            if self._first_pending is None:
+                self._first_pending = time.time()
+            self._condition.notify_all()
+
+    def overlay_rows(self, slave, table, rows):
+        ''' Replaces collection values with any newer values that have not been flushed yet
+
+        :param slave: The unit id the rows were read for
+        :param table: The key of the MODBUS_DATA_COLLECTIONS entry the rows were read from
+        :param rows: Rows returned by cbData.read_collection_data. They are updated in place.
+        '''
+        with self._condition:
+            if not self._pending and not self._inflight:
+                return
+
+            for row in rows:
+                key = (slave, table, row["data_address"])
+                if key in self._pending:
+                    row["data_value"] = self._pending[key]
+                elif key in self._inflight:
+                    row["data_value"] = self._inflight[key]
+
+    def flush(self):
+        ''' Saves every pending write before returning '''
+        self._flush(self._take_pending())
+
+    def stop(self, timeout=None):
+        ''' Stops the worker after flushing every pending write
+
+        :param timeout: The maximum number of seconds to wait for the flush to complete
+        '''
+        logging.info("Stopping write-behind queue")
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            logging.error("Write-behind queue did not finish flushing within %s seconds, %d " \
+                "writes were not saved", timeout, len(self._pending) + len(self._inflight))
+
+    def _run(self):
+        ''' Flushes pending writes whenever the interval elapses or the batch size is reached '''
+        while True:
+            with self._condition:
+                while not self._stopping and not self._flush_due():
+                    if self._first_pending is None:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(max(0, max(self._first_pending + self.interval, \
+                            self._retry_at or 0) - time.time()))
+
+                stopping = self._stopping
+
+            self._flush(self._take_pending())
+
+            if stopping:
+                with self._condition:
+                    if self._pending:
+                        logging.error("%d queued writes could not be saved before stopping", \
+                            len(self._pending))
+                return
+
+    def _flush_due(self):
+        ''' Returns True if the pending writes should be flushed now '''
+        if self._retry_at is not None and time.time() < self._retry_at:
+            return False
+        return len(self._pending) >= self.batch_size or (self._first_pending is not None and \
+            time.time() - self._first_pending >= self.interval)
+
+    def _take_pending(self):
+        ''' Moves every pending write to the in-flight set
+
+        :returns: The writes that were moved
+        '''
+        with self._condition:
+            batch = self._pending
+            self._pending = {}
+            self._first_pending = None
+            self._inflight.update(batch)
+            self._condition.notify_all()
+            return batch
+
+    def _flush(self, batch):
+        ''' Saves a batch of writes, requeueing any values the platform did not accept until they
+        have failed max_retries times
+
+        :param batch: A dictionary of (unit id, table, address) -> value
+        '''
+        if not batch:
+            return
+
+        logging.debug("Flushing %d queued writes", len(batch))
+        retrying = False
+        for slave, table, address, values in _contiguous_runs(batch):
+            try:
+                cbData.write_collection_data(self.cbsystem, self.cbauth, slave, address, values, \
+                    cbData.MODBUS_DATA_COLLECTIONS[table])
+                failed = []
+            except cbData.CbDataWriteException as exc:
+                failed = exc.addresses
+            except Exception as exc:
+                logging.error("Unable to flush queued writes: %s", str(exc))
+                failed = range(address, address + len(values))
+
+            dropped = []
+            with self._condition:
+                for ndx in range(0, len(values)):
+                    key = (slave, table, address + ndx)
+                    #Retry failed values unless a newer write has replaced them
+                    if address + ndx in failed and key not in self._pending:
+                        self._attempts[key] = self._attempts.get(key, 0) + 1
+                        if self._attempts[key] > self.max_retries:
+                            del self._attempts[key]
+                            dropped.append(address + ndx)
+                        else:
+                            self._pending[key] = values[ndx]
+                            if self._first_pending is None:
+                                self._first_pending = time.time()
+                            retrying = True
+                    elif key not in self._pending:
+                        self._attempts.pop(key, None)
+                    if self._inflight.get(key) == values[ndx]:
+                        del self._inflight[key]
+
+            if dropped:
+                DROPPED_WRITES.increment((table,), len(dropped))
+                logging.error("Dropping queued writes to unit %s, %s addresses %s after %d " \
+                    "failed attempts", slave, table, str(dropped), self.max_retries + 1)
+
+        with self._condition:
+            if retrying:
+                self._backoff = min(self.max_backoff, max(self.interval, self._backoff * 2))
+                self._retry_at = time.time() + self._backoff
+                logging.warning("Retrying failed queued writes in %s seconds", self._backoff)
+            else:
+                self._backoff = 0
+                self._retry_at = None
+            self._condition.notify_all()
+
+def _contiguous_runs(batch):
+    ''' Splits a batch of writes into runs of consecutive addresses
+
+    :param batch: A dictionary of (unit id, table, address) -> value
+
+    :returns: An array of (unit id, table, start address, values) tuples
+    '''
+    runs = []
+    for key in sorted(batch.keys()):
+        slave, table, address = key
+        if runs and runs[-1][0:2] == (slave, table) and \
+            runs[-1][2] + len(runs[-1][3]) == address:
+            runs[-1][3].append(batch[key])
+        else:
+            runs.append((slave, table, address, [batch[key]]))
+
+    return runs
@@ -0,0 +1,15 @@
+"""Makes the adapter modules importable the way the adapter runtime lays them out, each in a
+directory of its own below files/"""
+import glob
+import logging
+import os
+import sys
+
+FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "files")
+
+for directory in sorted(glob.glob(os.path.join(FILES, "*.py"))):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+#pymodbus logs every exception response it builds
+logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
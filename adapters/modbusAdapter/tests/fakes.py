@@ -0,0 +1,27 @@
+"""In-process stand-ins for the ClearBlade Platform shared by the tests"""
+import socket
+
+from benchmark_server import FakePlatform
+from cbData import MODBUS_DATA_COLLECTIONS
+from clearblade.ClearBladeCore import System
+
+class FakeAuth(object):
+    """Authentication credentials that were never checked by a platform"""
+    headers = {}
+
+def unreachable_system():
+    """Return a ClearBlade System whose platform refuses every connection"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return System("key", "secret", "http://127.0.0.1:%d" % port, safe=False)
+
+def platform_with_units():
+    """Return a FakePlatform with unit 1 at addresses 0-20 of every table and unit 2 only at
+    address 5 of the output registers"""
+    platform = FakePlatform()
+    platform.populate(1, 20)
+    platform.rows[MODBUS_DATA_COLLECTIONS['OUTPUT_REGISTERS_COLLECTION']].append({ \
+        "item_id": "unit-2", "unit_id": 2, "data_address": 5, "data_value": 3})
+    return platform
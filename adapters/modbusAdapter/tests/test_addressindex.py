@@ -0,0 +1,101 @@
+"""Tests for the local index of Modbus addresses"""
+import unittest
+
+import cbData
+from addressindex import AddressIndex
+from constants import ModbusErrorCodes
+from fakes import FakePlatform
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+
+class AddressIndexTest(unittest.TestCase):
+
+    def test_check_requires_every_address(self):
+        index = AddressIndex()
+        index.load_table(TABLE, {1: [0, 1, 2, 5]})
+
+        self.assertTrue(index.validate(1, TABLE, 0, 3))
+        self.assertEqual(index.check(1, TABLE, 1, 3), ModbusErrorCodes.IllegalDataAddress)
+        self.assertFalse(index.validate(2, TABLE, 0))
+        self.assertFalse(index.validate(1, 'COILS_COLLECTION', 0))
+        self.assertFalse(index.validate(1, TABLE, -1))
+        self.assertFalse(index.validate(1, TABLE, 0, 0))
+
+    def test_add_and_remove(self):
+        index = AddressIndex()
+        index.add(3, TABLE, 10, 4)
+        self.assertTrue(index.validate(3, TABLE, 10, 4))
+        self.assertEqual(index.units(), set([3]))
+
+        index.remove(3, TABLE, 12)
+        self.assertFalse(index.validate(3, TABLE, 10, 4))
+        self.assertTrue(index.validate(3, TABLE, 13))
+
+        index.remove(3, TABLE, 10, 4)
+        self.assertEqual(index.units(), set())
+
+    def test_negative_addresses_are_rejected(self):
+        index = AddressIndex()
+        index.add(3, TABLE, 0, 2)
+        with self.assertRaises(ValueError):
+            index.add(3, TABLE, -1, 4)
+        with self.assertRaises(ValueError):
+            index.remove(3, TABLE, -1, 2)
+        self.assertTrue(index.validate(3, TABLE, 0, 2))
+        self.assertFalse(index.validate(3, TABLE, 2))
+
+    def test_load_table_skips_invalid_addresses(self):
+        index = AddressIndex()
+        index.load_table(TABLE, {1: [0, -1, 2.5, None, "3", 4], 2: [1]})
+
+        self.assertTrue(index.validate(1, TABLE, 0))
+        self.assertTrue(index.validate(1, TABLE, 4))
+        self.assertFalse(index.validate(1, TABLE, 2))
+        self.assertFalse(index.validate(1, TABLE, 3))
+        self.assertTrue(index.validate(2, TABLE, 1))
+
+    def test_load_table_replaces_only_that_table(self):
+        index = AddressIndex()
+        index.load_table(TABLE, {1: [0], 2: [0]})
+        index.load_table('COILS_COLLECTION', {2: [0]})
+        index.load_table(TABLE, {1: [1]})
+
+        self.assertFalse(index.validate(1, TABLE, 0))
+        self.assertTrue(index.validate(1, TABLE, 1))
+        self.assertFalse(index.validate(2, TABLE, 0))
+        self.assertTrue(index.validate(2, 'COILS_COLLECTION', 0))
+
+    def test_load_reads_every_page(self):
+        platform = FakePlatform()
+        platform.populate(3, 149)
+
+        index = AddressIndex()
+        index.load(platform, None)
+
+        #450 rows per collection, five pages of the default size of 100
+        self.assertEqual(index.units(), set([1, 2, 3]))
+        for table in cbData.MODBUS_DATA_COLLECTIONS:
+            self.assertTrue(index.validate(3, table, 0, 150))
+        self.assertEqual(platform.calls, 5 * len(cbData.MODBUS_DATA_COLLECTIONS))
+
+class ReadCollectionDataTest(unittest.TestCase):
+
+    def test_range_reads_span_pages(self):
+        platform = FakePlatform()
+        platform.populate(1, 1999)
+
+        rows = cbData.read_collection_data(platform, None, 1, 0, 2000, \
+            cbData.MODBUS_DATA_COLLECTIONS['COILS_COLLECTION'])
+        self.assertEqual(sorted([row["data_address"] for row in rows]), list(range(0, 2000)))
+
+    def test_a_full_last_page_is_followed_by_an_empty_one(self):
+        platform = FakePlatform()
+        platform.populate(1, 99)
+
+        rows = cbData.read_collection_data(platform, None, 1, 0, 100, \
+            cbData.MODBUS_DATA_COLLECTIONS['COILS_COLLECTION'])
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(platform.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
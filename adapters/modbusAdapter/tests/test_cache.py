@@ -0,0 +1,135 @@
+"""Tests for the cache of Modbus read responses"""
+import time
+import unittest
+
+from cache import ReadCache
+
+def read(address=0, count=2, unit=1, function_code=3):
+    return {'ModbusHost': "plc", 'UnitID': unit, 'FunctionCode': function_code, \
+        'StartAddress': address, 'AddressCount': count}
+
+class Device(object):
+    """Records the reads submitted to it, answering them when asked"""
+
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, on_read):
+        self.pending.append(on_read)
+
+    def answer(self, response):
+        on_read = self.pending.pop(0)
+        on_read(response)
+
+class ReadCacheTest(unittest.TestCase):
+
+    def test_responses_are_served_until_they_expire(self):
+        cache = ReadCache(0.1)
+        device = Device()
+        results = []
+        cache.read(read(), 502, results.append, device.submit)
+        device.answer({'Data': [1, 2]})
+
+        cache.read(read(), 502, results.append, device.submit)
+        self.assertEqual(device.pending, [])
+        self.assertEqual(results, [{'Data': [1, 2]}, {'Data': [1, 2]}])
+
+        time.sleep(0.15)
+        cache.read(read(), 502, results.append, device.submit)
+        self.assertEqual(len(device.pending), 1)
+
+    def test_identical_reads_share_a_request(self):
+        cache = ReadCache(60)
+        device = Device()
+        results = []
+        for _ in range(0, 3):
+            cache.read(read(), 502, results.append, device.submit)
+        cache.read(read(count=3), 502, results.append, device.submit)
+        cache.read(read(), 503, results.append, device.submit)
+        self.assertEqual(len(device.pending), 3)
+
+        device.answer({'Data': [4, 5]})
+        self.assertEqual(results, [{'Data': [4, 5]}] * 3)
+
+    def test_errors_are_not_cached(self):
+        cache = ReadCache(60)
+        device = Device()
+        results = []
+        cache.read(read(), 502, results.append, device.submit)
+        cache.read(read(), 502, results.append, device.submit)
+        device.answer({'error': "timed out"})
+        self.assertEqual(results, [{'error': "timed out"}] * 2)
+
+        cache.read(read(), 502, results.append, device.submit)
+        self.assertEqual(len(device.pending), 1)
+
+    def test_writes_invalidate_overlapping_reads(self):
+        cache = ReadCache(60)
+        device = Device()
+        for address in (0, 10):
+            cache.read(read(address), 502, lambda response: None, device.submit)
+            device.answer({'Data': [1, 2]})
+        cache.read(read(0, function_code=1), 502, lambda response: None, device.submit)
+        device.answer({'Data': [True, False]})
+
+        cache.invalidate({'ModbusHost': "plc", 'UnitID': 1, 'FunctionCode': 16, \
+            'StartAddress': 1, 'Data': [7, 8]}, 502)
+        for address, function_code in ((0, 3), (10, 3), (0, 1)):
+            cache.read(read(address, function_code=function_code), 502, \
+                lambda response: None, device.submit)
+        self.assertEqual(len(device.pending), 1)
+
+    def test_read_write_requests_invalidate_their_write_range(self):
+        cache = ReadCache(60)
+        device = Device()
+        for address in (0, 10):
+            cache.read(read(address), 502, lambda response: None, device.submit)
+            device.answer({'Data': [1, 2]})
+
+        cache.invalidate({'ModbusHost': "plc", 'UnitID': 1, 'FunctionCode': 23, \
+            'StartAddress': 0, 'AddressCount': 2, 'WriteAddress': 11, 'Data': [7]}, 502)
+        for address in (0, 10):
+            cache.read(read(address), 502, lambda response: None, device.submit)
+        self.assertEqual(len(device.pending), 1)
+        device.answer({'Data': [1, 7]})
+
+        cache.read(read(10), 502, lambda response: None, device.submit)
+        self.assertEqual(device.pending, [])
+
+    def test_reads_overlapping_a_write_in_flight_are_not_cached(self):
+        cache = ReadCache(60)
+        device = Device()
+        results = []
+        cache.read(read(), 502, results.append, device.submit)
+        cache.invalidate({'ModbusHost': "plc", 'UnitID': 1, 'FunctionCode': 6, \
+            'StartAddress': 1, 'Data': [9]}, 502)
+        device.answer({'Data': [1, 2]})
+        self.assertEqual(results, [{'Data': [1, 2]}])
+
+        cache.read(read(), 502, results.append, device.submit)
+        self.assertEqual(len(device.pending), 1)
+
+    def test_least_recently_used_responses_are_evicted(self):
+        cache = ReadCache(60, max_entries=2)
+        device = Device()
+        for address in (0, 10, 20):
+            if address == 20:
+                #Use the read of address 0 so the read of address 10 is the least recently used
+                cache.read(read(0), 502, lambda response: None, device.submit)
+            cache.read(read(address), 502, lambda response: None, device.submit)
+            device.answer({'Data': [address, address]})
+
+        cache.read(read(0), 502, lambda response: None, device.submit)
+        cache.read(read(20), 502, lambda response: None, device.submit)
+        self.assertEqual(device.pending, [])
+        cache.read(read(10), 502, lambda response: None, device.submit)
+        self.assertEqual(len(device.pending), 1)
+
+    def test_only_reads_are_cached(self):
+        cache = ReadCache(60)
+        self.assertTrue(cache.accepts(read(function_code=4)))
+        self.assertFalse(cache.accepts(read(function_code=16)))
+        self.assertFalse(cache.accepts(read(function_code=23)))
+
+if __name__ == '__main__':
+    unittest.main()
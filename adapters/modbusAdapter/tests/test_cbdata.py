@@ -0,0 +1,97 @@
+"""Tests for the calls made to the Modbus data collections"""
+import socket
+import threading
+import unittest
+
+import cbData
+import requests
+from clearblade import cbErrors, restcall
+from clearblade.ClearBladeCore import System
+from constants import ModbusErrorCodes
+from fakes import FakePlatform
+
+COLLECTION = cbData.MODBUS_DATA_COLLECTIONS['OUTPUT_REGISTERS_COLLECTION']
+
+class FakeAuth(object):
+    """Authentication credentials that were never checked by a platform"""
+    headers = {}
+
+def unused_port():
+    """Return a local port nothing is listening on"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class PlatformCallsTest(unittest.TestCase):
+    """Drives the ClearBlade SDK against local sockets"""
+
+    def setUp(self):
+        self.handler = cbErrors.ERROR_HANDLER
+        cbData.configure_platform_calls(0.2)
+
+        #Accepts connections but never answers
+        self.silent = socket.socket()
+        self.silent.bind(("127.0.0.1", 0))
+        self.silent.listen(16)
+
+    def tearDown(self):
+        cbErrors.ERROR_HANDLER = self.handler
+        restcall.requests = requests
+        self.silent.close()
+
+    def system(self, port):
+        return System("key", "secret", "http://127.0.0.1:%d" % port, safe=False)
+
+    def test_unreachable_platform_raises(self):
+        with self.assertRaises(cbData.PlatformError):
+            cbData.read_collection_data(self.system(unused_port()), FakeAuth(), 1, 0, 1, COLLECTION)
+
+    def test_unanswered_call_times_out(self):
+        with self.assertRaises(cbData.PlatformTimeout):
+            cbData.read_collection_data(self.system(self.silent.getsockname()[1]), FakeAuth(), 1, \
+                0, 1, COLLECTION)
+
+    def test_timed_out_write_is_a_gateway_failure(self):
+        with self.assertRaises(cbData.CbDataWriteException) as raised:
+            cbData.write_collection_data(self.system(self.silent.getsockname()[1]), FakeAuth(), 1, \
+                0, [1, 2, 3], COLLECTION)
+        self.assertEqual(raised.exception.error_code, ModbusErrorCodes.GatewayDeviceFailedtoRespond)
+        self.assertEqual(raised.exception.addresses, [0, 1, 2])
+
+    def test_failed_write_is_a_device_failure(self):
+        with self.assertRaises(cbData.CbDataWriteException) as raised:
+            cbData.write_collection_data(self.system(unused_port()), FakeAuth(), 1, 0, [1, 2], \
+                COLLECTION)
+        self.assertEqual(raised.exception.error_code, ModbusErrorCodes.SlaveDeviceFailure)
+
+class WriteCollectionDataTest(unittest.TestCase):
+
+    def test_group_write_data(self):
+        self.assertEqual(cbData.group_write_data(10, [1, 1, 2, 1, 1, 1]), \
+            [(10, 2, 1), (12, 1, 2), (13, 3, 1)])
+        self.assertEqual(cbData.group_write_data(0, []), [])
+
+    def test_runs_of_values_are_saved(self):
+        platform = FakePlatform()
+        platform.populate(1, 20)
+
+        cbData.write_collection_data(platform, None, 1, 2, [5, 5, 6, 7, 7], COLLECTION)
+        values = dict([(row["data_address"], row["data_value"]) \
+            for row in platform.rows[COLLECTION] if row["unit_id"] == 1])
+        self.assertEqual([values[addr] for addr in range(0, 9)], [0, 0, 5, 5, 6, 7, 7, 0, 0])
+        self.assertEqual(platform.calls, 3)
+
+    def test_update_threads_are_reused(self):
+        platform = FakePlatform()
+        platform.populate(1, 20)
+
+        cbData.write_collection_data(platform, None, 1, 0, list(range(0, 20)), COLLECTION)
+        threads = threading.active_count()
+        for _ in range(0, 5):
+            cbData.write_collection_data(platform, None, 1, 0, list(range(0, 20)), COLLECTION)
+        self.assertEqual(threading.active_count(), threads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""Tests for the validation of Modbus commands received by the client adapter"""
+import importlib
+import unittest
+
+#The adapter script's name is not a valid module name. It imports exceptions that were removed
+#from later pymodbus releases.
+REASON = None
+try:
+    adapter = importlib.import_module("modbus-client-adapter")
+except ImportError as exc:
+    adapter = None
+    REASON = "The client adapter cannot be imported: " + str(exc)
+
+def command(function_code, **parameters):
+    payload = {'ModbusHost': "plc", 'FunctionCode': function_code, 'UnitID': 1, \
+        'StartAddress': 4}
+    payload.update(parameters)
+    return payload
+
+@unittest.skipIf(adapter is None, REASON)
+class CheckModbusRequestTest(unittest.TestCase):
+
+    def test_mask_write_requires_both_masks(self):
+        self.assertIsNone(adapter.check_modbus_request(command(22, AndMask=0xFF, OrMask=1)))
+        self.assertEqual(adapter.check_modbus_request(command(22, OrMask=1)), \
+            "Modbus AndMask not specified. Unable to process Modbus command.")
+        self.assertEqual(adapter.check_modbus_request(command(22, AndMask=0xFF)), \
+            "Modbus OrMask not specified. Unable to process Modbus command.")
+
+    def test_read_write_requires_a_write_address(self):
+        self.assertIsNone(adapter.check_modbus_request(command(23, AddressCount=3, \
+            Data=[7, 8], WriteAddress=10)))
+        self.assertEqual(adapter.check_modbus_request(command(23, AddressCount=3, \
+            Data=[7, 8])), "Modbus WriteAddress not specified. Unable to process Modbus command.")
+        self.assertEqual(adapter.check_modbus_request(command(23, AddressCount=3, \
+            WriteAddress=10)), "Modbus Data not specified. Unable to process Modbus command.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for coalescing nearby Modbus reads"""
+import threading
+import unittest
+
+from coalesce import ReadCoalescer, plan_reads
+
+class PlanReadsTest(unittest.TestCase):
+
+    def test_adjacent_and_overlapping_ranges_are_merged(self):
+        self.assertEqual(plan_reads([(10, 2), (0, 5), (5, 5), (12, 3)], 0, 125), \
+            [(0, 15, [1, 2, 0, 3])])
+        self.assertEqual(plan_reads([(0, 10), (2, 3)], 0, 125), [(0, 10, [0, 1])])
+
+    def test_gaps_up_to_max_gap_are_spanned(self):
+        ranges = [(0, 2), (5, 2), (20, 1)]
+        self.assertEqual(plan_reads(ranges, 3, 125), [(0, 7, [0, 1]), (20, 1, [2])])
+        self.assertEqual(plan_reads(ranges, 2, 125), [(0, 2, [0]), (5, 2, [1]), (20, 1, [2])])
+        self.assertEqual(plan_reads(ranges, 13, 125), [(0, 21, [0, 1, 2])])
+
+    def test_reads_are_limited_to_max_count(self):
+        self.assertEqual(plan_reads([(0, 100), (100, 25), (125, 1)], 0, 125), \
+            [(0, 125, [0, 1]), (125, 1, [2])])
+        self.assertEqual(plan_reads([(0, 200)], 0, 125), [(0, 200, [0])])
+
+    def test_no_ranges(self):
+        self.assertEqual(plan_reads([], 0, 125), [])
+
+class ReadCoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.submitted = []
+        self.lock = threading.Lock()
+
+    def submit(self, payload, modbus_port, on_result):
+        with self.lock:
+            self.submitted.append((payload, on_result))
+
+    def add(self, coalescer, address, count, results):
+        coalescer.add({'ModbusHost': "plc", 'UnitID': 1, 'FunctionCode': 3, \
+            'StartAddress': address, 'AddressCount': count}, 502, \
+            lambda response: results.append((address, response)))
+
+    def test_merged_reads_are_split_between_their_members(self):
+        coalescer = ReadCoalescer(self.submit, window=60, max_gap=1)
+        results = []
+        self.add(coalescer, 4, 2, results)
+        self.add(coalescer, 0, 3, results)
+        coalescer.stop()
+
+        self.assertEqual(len(self.submitted), 1)
+        payload, on_result = self.submitted[0]
+        self.assertEqual((payload['StartAddress'], payload['AddressCount']), (0, 6))
+        on_result({'Data': [0, 1, 2, 3, 4, 5]})
+        self.assertEqual(sorted(results), [(0, {'Data': [0, 1, 2]}), (4, {'Data': [4, 5]})])
+
+    def test_errors_are_passed_to_every_member(self):
+        coalescer = ReadCoalescer(self.submit, window=60)
+        results = []
+        self.add(coalescer, 0, 2, results)
+        self.add(coalescer, 2, 2, results)
+        coalescer.stop()
+
+        self.submitted[0][1]({'error': "timed out"})
+        self.assertEqual(sorted(results), [(0, {'error': "timed out"}), (2, {'error': "timed out"})])
+
+    def test_rejected_reads_spanning_a_gap_are_retried_separately(self):
+        coalescer = ReadCoalescer(self.submit, window=60, max_gap=5)
+        results = []
+        self.add(coalescer, 0, 2, results)
+        self.add(coalescer, 6, 2, results)
+        coalescer.stop()
+
+        self.submitted[0][1]({'error': "Illegal data address", 'exception': 'ExceptionResponse'})
+        self.assertEqual(sorted([payload['StartAddress'] for payload, _ in self.submitted[1:]]), \
+            [0, 6])
+        self.assertEqual(results, [])
+
+if __name__ == '__main__':
+    unittest.main()
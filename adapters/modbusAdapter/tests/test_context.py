@@ -0,0 +1,86 @@
+"""Tests for the server context holding the slave contexts of the Modbus unit ids"""
+import unittest
+
+from context import ClearBladeModbusServerContext
+from fakes import FakePlatform, platform_with_units
+from pymodbus.exceptions import NoSuchSlaveException
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+
+class SlaveContextTest(unittest.TestCase):
+
+    def setUp(self):
+        platform = FakePlatform()
+        platform.populate(3, 20)
+        self.context = ClearBladeModbusServerContext(cbsystem=platform, cbauth=None, \
+            cache_ttl=60, max_units=2, zero_mode=True)
+
+    def test_contexts_are_reused(self):
+        self.assertIs(self.context[1], self.context[1])
+        self.assertIs(self.context[1].store.index, self.context.index)
+
+    def test_least_recently_used_contexts_are_evicted(self):
+        first = self.context[1]
+        self.context[2]
+        self.context[1]
+        self.context[3]
+
+        self.assertEqual(list(self.context._slaves.keys()), [1, 3])
+        self.assertIs(self.context[1], first)
+
+    def test_eviction_discards_the_register_image_of_the_unit(self):
+        for slave in (1, 2):
+            self.context[slave].getValues(3, 0, 2)
+        self.context[3]
+
+        self.assertIsNone(self.context.image.get(1, TABLE, 0, 2, stale=True))
+        self.assertEqual(self.context.image.get(2, TABLE, 0, 2), [0, 0])
+
+    def test_units_without_addresses_do_not_exist(self):
+        self.assertNotIn(4, self.context)
+        with self.assertRaises(NoSuchSlaveException):
+            self.context[4]
+
+class ApplyChangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.platform = platform_with_units()
+        self.context = ClearBladeModbusServerContext(cbsystem=self.platform, cbauth=None, \
+            cache_ttl=60, zero_mode=True)
+
+    def test_values_update_the_image_and_index(self):
+        self.context.apply_change(1, TABLE, 30, values=[5, 6])
+
+        self.assertEqual(self.context.image.get(1, TABLE, 30, 2), [5, 6])
+        self.assertTrue(self.context.index.validate(1, TABLE, 30, 2))
+        calls = self.platform.calls
+        self.assertEqual(self.context[1].getValues(3, 30, 2), [5, 6])
+        self.assertEqual(self.platform.calls, calls)
+
+    def test_count_invalidates_the_image(self):
+        self.assertEqual(self.context[1].getValues(3, 0, 4), [0, 0, 0, 0])
+        self.context.apply_change(1, TABLE, 1, count=2)
+
+        self.assertEqual(self.context.image.get(1, TABLE, 0), [0])
+        self.assertIsNone(self.context.image.get(1, TABLE, 1))
+        self.assertIsNone(self.context.image.get(1, TABLE, 2))
+        self.assertEqual(self.context.image.get(1, TABLE, 3), [0])
+        self.assertTrue(self.context.index.validate(1, TABLE, 0, 4))
+
+    def test_removed_addresses_leave_the_index(self):
+        self.context.apply_change(1, TABLE, 2, values=[9], removed=True)
+
+        self.assertFalse(self.context.index.validate(1, TABLE, 2))
+        self.assertIsNone(self.context.image.get(1, TABLE, 2))
+        self.assertIn(1, self.context)
+
+    def test_removing_the_last_address_evicts_the_unit(self):
+        self.assertEqual(self.context[2].getValues(3, 5), [3])
+        self.context.apply_change(2, TABLE, 5, removed=True)
+
+        self.assertNotIn(2, self.context)
+        self.assertNotIn(2, self.context._slaves)
+        self.assertIsNone(self.context.image.get(2, TABLE, 5, stale=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Tests for the worker pool executing Modbus requests and the batches built on it"""
+import threading
+import time
+import unittest
+
+from batch import ModbusBatch
+from dispatcher import OVERFLOW_POLICIES, RequestDispatcher
+
+class Recorder(object):
+    """Collects the results and rejections of dispatched requests"""
+
+    def __init__(self):
+        self.results = []
+        self.lock = threading.Lock()
+
+    def run(self, name, delay=0.0):
+        def run():
+            time.sleep(delay)
+            with self.lock:
+                self.results.append(name)
+        return run
+
+    def reject(self, name):
+        def reject(reason):
+            with self.lock:
+                self.results.append((name, reason))
+        return reject
+
+class RequestDispatcherTest(unittest.TestCase):
+
+    def test_requests_to_a_host_run_in_order(self):
+        recorder = Recorder()
+        dispatcher = RequestDispatcher(workers=4, per_host=1)
+        for ndx in range(0, 20):
+            dispatcher.dispatch("host", recorder.run(ndx), recorder.reject(ndx))
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results, list(range(0, 20)))
+
+    def test_hosts_are_limited_to_per_host_requests(self):
+        running = {}
+        peak = {}
+        lock = threading.Lock()
+
+        def run(key):
+            def run():
+                with lock:
+                    running[key] = running.get(key, 0) + 1
+                    peak[key] = max(peak.get(key, 0), running[key])
+                time.sleep(0.01)
+                with lock:
+                    running[key] -= 1
+            return run
+
+        dispatcher = RequestDispatcher(workers=8, per_host=2)
+        for ndx in range(0, 24):
+            key = "host" + str(ndx % 3)
+            dispatcher.dispatch(key, run(key), lambda reason: None)
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(peak, {"host0": 2, "host1": 2, "host2": 2})
+
+    def test_full_queue_rejects_requests(self):
+        recorder = Recorder()
+        release = threading.Event()
+        dispatcher = RequestDispatcher(workers=1, max_queued=1)
+        dispatcher.dispatch("host", release.wait, recorder.reject("busy"))
+        time.sleep(0.05)
+        self.assertTrue(dispatcher.dispatch("host", recorder.run(1), recorder.reject(1)))
+        self.assertFalse(dispatcher.dispatch("host", recorder.run(2), recorder.reject(2)))
+        release.set()
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results, [(2, "Modbus request queue is full"), 1])
+
+    def test_drop_oldest_rejects_the_oldest_request(self):
+        recorder = Recorder()
+        release = threading.Event()
+        dispatcher = RequestDispatcher(workers=1, max_queued=2, \
+            overflow=OVERFLOW_POLICIES['DROP_OLDEST'])
+        dispatcher.dispatch("host", release.wait, recorder.reject("busy"))
+        time.sleep(0.05)
+        for ndx in range(1, 4):
+            self.assertTrue(dispatcher.dispatch("other" if ndx == 1 else "host", \
+                recorder.run(ndx), recorder.reject(ndx)))
+        release.set()
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results[0][0], 1)
+        self.assertEqual(sorted(recorder.results[1:]), [2, 3])
+
+    def test_block_waits_for_room(self):
+        recorder = Recorder()
+        dispatcher = RequestDispatcher(workers=1, max_queued=1, \
+            overflow=OVERFLOW_POLICIES['BLOCK'], block_timeout=5)
+        dispatcher.dispatch("host", recorder.run(0, 0.1), recorder.reject(0))
+        dispatcher.dispatch("host", recorder.run(1, 0.1), recorder.reject(1))
+        self.assertTrue(dispatcher.dispatch("host", recorder.run(2), recorder.reject(2)))
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results, [0, 1, 2])
+
+    def test_block_rejects_after_the_timeout(self):
+        recorder = Recorder()
+        release = threading.Event()
+        dispatcher = RequestDispatcher(workers=1, max_queued=1, \
+            overflow=OVERFLOW_POLICIES['BLOCK'], block_timeout=0.1)
+        dispatcher.dispatch("host", release.wait, recorder.reject("busy"))
+        time.sleep(0.05)
+        dispatcher.dispatch("host", recorder.run(1), recorder.reject(1))
+
+        started = time.time()
+        self.assertFalse(dispatcher.dispatch("host", recorder.run(2), recorder.reject(2)))
+        self.assertLess(time.time() - started, 1)
+        release.set()
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results, \
+            [(2, "Timed out waiting for room in the Modbus request queue"), 1])
+
+    def test_requests_that_raise_are_rejected(self):
+        recorder = Recorder()
+        dispatcher = RequestDispatcher(workers=1)
+
+        def fail():
+            raise IOError("Connection refused")
+
+        dispatcher.dispatch("host", fail, recorder.reject("failed"))
+        dispatcher.dispatch("host", recorder.run("next"), recorder.reject("next"))
+        self.assertTrue(dispatcher.stop(5))
+        self.assertEqual(recorder.results, [("failed", \
+            "Error while executing Modbus request: Connection refused"), "next"])
+
+    def test_stopped_dispatcher_rejects_requests(self):
+        recorder = Recorder()
+        dispatcher = RequestDispatcher(workers=1)
+        dispatcher.stop(5)
+        self.assertFalse(dispatcher.dispatch("host", recorder.run(1), recorder.reject(1)))
+        self.assertEqual(recorder.results, [(1, "Modbus adapter is shutting down")])
+
+class ModbusBatchTest(unittest.TestCase):
+
+    def test_batch_completes_when_a_command_raises(self):
+        done = threading.Event()
+        results = []
+
+        def on_done(batch_results):
+            results.extend(batch_results)
+            done.set()
+
+        commands = [{"StartAddress": 0}, {"StartAddress": 1}, {"StartAddress": 2}]
+        batch = ModbusBatch(commands, on_done)
+        dispatcher = RequestDispatcher(workers=2)
+
+        def run(ndx):
+            def run():
+                if ndx == 1:
+                    raise ValueError("Unable to connect")
+                batch.complete(ndx, {"Data": [ndx]})
+            return run
+
+        for ndx in range(0, len(commands)):
+            dispatcher.dispatch("host", run(ndx), \
+                lambda reason, ndx=ndx: batch.complete(ndx, {"error": reason}))
+
+        self.assertTrue(done.wait(5))
+        dispatcher.stop(5)
+        self.assertEqual([result["request"] for result in results], commands)
+        self.assertEqual(results[0]["response"], {"Data": [0]})
+        self.assertEqual(results[1]["error"], \
+            "Error while executing Modbus request: Unable to connect")
+        self.assertEqual(results[2]["response"], {"Data": [2]})
+
+    def test_empty_batch_completes_immediately(self):
+        results = []
+        ModbusBatch([], results.append)
+        self.assertEqual(results, [[]])
+
+    def test_duplicate_results_are_ignored(self):
+        results = []
+        batch = ModbusBatch([{}, {}], results.append)
+        batch.complete(0, {"Data": [1]})
+        batch.complete(0, {"error": "late"})
+        batch.complete(1, None)
+        self.assertEqual(results, [[{"request": {}, "response": {"Data": [1]}}, \
+            {"request": {}, "error": "No response received for Modbus command."}]])
+
+if __name__ == '__main__':
+    unittest.main()
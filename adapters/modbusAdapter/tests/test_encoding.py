@@ -0,0 +1,97 @@
+"""Tests for the encodings of the Modbus MQTT messages"""
+import json
+import unittest
+
+import encoding
+from constants import ModbusFunctionCodes
+from encoding import ENCODINGS, decode_request, encode_message, encode_request
+
+MSGPACK = ENCODINGS['MSGPACK']
+
+def request(function_code, data=None):
+    command = {'ModbusHost': "plc", 'ModbusPort': 502, 'FunctionCode': function_code, 'UnitID': 1, \
+        'StartAddress': 10, 'AddressCount': 2}
+    if data is not None:
+        command['Data'] = data
+    return command
+
+def decode_message(payload):
+    """Decodes a msgpack encoded response the way a subscriber would"""
+    message = encoding.msgpack.unpackb(payload, raw=False)
+    data = message.get('response', {}).get('Data')
+    if isinstance(data, bytes):
+        message['response']['Data'] = encoding.unpack_registers(data)
+    return message
+
+class JsonTest(unittest.TestCase):
+
+    def test_request_round_trip(self):
+        command = request(ModbusFunctionCodes.WriteMultipleHoldingRegisters, [1, 2])
+        self.assertEqual(decode_request(encode_request(command, ENCODINGS['JSON']), \
+            ENCODINGS['JSON']), command)
+
+    def test_python_reprs_are_accepted(self):
+        self.assertEqual(decode_request("{'FunctionCode': 3, 'ModbusHost': 'plc'}", \
+            ENCODINGS['JSON']), {'FunctionCode': 3, 'ModbusHost': "plc"})
+
+    def test_topics(self):
+        self.assertEqual(encoding.encoded_topic("modbus/command/response", MSGPACK), \
+            "modbus/command/response/msgpack")
+        self.assertEqual(encoding.topic_encoding("root/modbus/command/request/msgpack"), MSGPACK)
+        self.assertEqual(encoding.topic_encoding("root/modbus/command/request"), \
+            ENCODINGS['JSON'])
+
+@unittest.skipIf(encoding.msgpack is None, "msgpack is not installed")
+class MsgpackTest(unittest.TestCase):
+
+    def assert_response_round_trip(self, function_code, data):
+        message = {'request': request(function_code), 'response': {'Data': data}}
+        self.assertEqual(decode_message(encode_message(message, MSGPACK)), message)
+
+    def test_register_reads_are_packed(self):
+        message = {'request': request(ModbusFunctionCodes.ReadHoldingRegisters), \
+            'response': {'Data': [0, 1, 65535]}}
+        payload = encode_message(message, MSGPACK)
+
+        self.assertEqual(encoding.msgpack.unpackb(payload, raw=False)['response']['Data'], \
+            b'\x00\x00\x00\x01\xff\xff')
+        self.assertEqual(decode_message(payload), message)
+
+    def test_write_responses(self):
+        #FC6 echoes the value written and FC16 the number of registers written
+        self.assert_response_round_trip(ModbusFunctionCodes.WriteSingleHoldingRegister, 7)
+        self.assert_response_round_trip(ModbusFunctionCodes.WriteMultipleHoldingRegisters, 2)
+        self.assert_response_round_trip(ModbusFunctionCodes.MaskWriteRegister, [0xF2, 0x25])
+        self.assert_response_round_trip(ModbusFunctionCodes.ReadWriteMultipleRegisters, [4, 5])
+        self.assert_response_round_trip(ModbusFunctionCodes.ReadCoil, [True, False])
+
+    def test_requests_round_trip(self):
+        for command in [request(ModbusFunctionCodes.WriteSingleHoldingRegister, [7]), \
+            request(ModbusFunctionCodes.WriteMultipleHoldingRegisters, [1, 65535]), \
+            request(ModbusFunctionCodes.WriteMultipleCoils, [True, False]), \
+            request(ModbusFunctionCodes.ReadHoldingRegisters)]:
+            self.assertEqual(decode_request(encode_request(command, MSGPACK), MSGPACK), command)
+
+        command = request(ModbusFunctionCodes.MaskWriteRegister)
+        command.update({'AndMask': 0xF2, 'OrMask': 0x25})
+        self.assertEqual(decode_request(encode_request(command, MSGPACK), MSGPACK), command)
+
+    def test_batches(self):
+        commands = [request(ModbusFunctionCodes.WriteMultipleHoldingRegisters, [1, 2]), \
+            request(ModbusFunctionCodes.ReadCoil)]
+        self.assertEqual(decode_request(encode_request(commands, MSGPACK), MSGPACK), commands)
+
+        message = {'results': [
+            {'request': commands[0], 'response': {'Data': 2}},
+            {'request': commands[1], 'error': "timed out"}]}
+        self.assertEqual(encoding.msgpack.unpackb(encode_message(message, MSGPACK), raw=False), \
+            message)
+
+    def test_errors(self):
+        message = {'request': request(ModbusFunctionCodes.ReadHoldingRegisters), 'error': "boom"}
+        self.assertEqual(encoding.msgpack.unpackb(encode_message(message, MSGPACK), raw=False), \
+            message)
+        self.assertEqual(json.loads(encode_message(message, ENCODINGS['JSON'])), message)
+
+if __name__ == '__main__':
+    unittest.main()
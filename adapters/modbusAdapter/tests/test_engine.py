@@ -0,0 +1,149 @@
+"""Tests for the asynchronous engine of the client adapter, run on a fake reactor and clock"""
+import unittest
+
+from engine import ModbusEngine
+from pymodbus.register_read_message import ReadHoldingRegistersResponse
+from twisted.internet import defer, error, protocol
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.python.failure import Failure
+
+def read(host="plc", address=0):
+    return {'ModbusHost': host, 'UnitID': 1, 'FunctionCode': 3, 'StartAddress': address, \
+        'AddressCount': 2}
+
+class FakeReactor(MemoryReactorClock):
+    """A reactor whose calls from other threads run at once"""
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+class FakeClient(protocol.Protocol):
+    """A Modbus client protocol recording the reads sent on it, answering them when asked"""
+
+    on_lost = None
+
+    def __init__(self):
+        self.pending = []
+
+    def read_holding_registers(self, address, count, unit=1):
+        deferred = defer.Deferred()
+        self.pending.append((address, deferred))
+        return deferred
+
+    def answer(self, values):
+        address, deferred = self.pending.pop(0)
+        deferred.callback(ReadHoldingRegistersResponse(values))
+        return address
+
+    def connectionLost(self, reason=None):
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+class ModbusEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.results = []
+
+    def engine(self, **kwargs):
+        engine = ModbusEngine(reactor=self.reactor, **kwargs)
+        engine.client_protocol = FakeClient
+        return engine
+
+    def submit(self, engine, payload):
+        engine.submit(payload, 502, lambda result, payload=payload: \
+            self.results.append((payload['ModbusHost'], payload['StartAddress'], result)))
+
+    def connect(self, attempt):
+        """Completes a connection attempt, returning the client connected"""
+        factory = self.reactor.tcpClients[attempt][2]
+        client = factory.buildProtocol(None)
+        client.makeConnection(StringTransport())
+        self.reactor.advance(0)
+        return client
+
+    def test_requests_to_a_host_run_one_at_a_time(self):
+        engine = self.engine()
+        for address in range(0, 3):
+            self.submit(engine, read("plc", address))
+        self.submit(engine, read("other"))
+
+        #One connection per host
+        self.assertEqual([(host, port) for host, port, _, _, _ in self.reactor.tcpClients], \
+            [("plc", 502), ("other", 502)])
+        plc = self.connect(0)
+        other = self.connect(1)
+        self.assertEqual(len(plc.pending), 1)
+        self.assertEqual(len(other.pending), 1)
+
+        other.answer([9, 9])
+        self.assertEqual([plc.answer([address, address]) for address in range(0, 3)], [0, 1, 2])
+        self.assertEqual(self.results, [("other", 0, {'Data': [9, 9]})] + \
+            [("plc", address, {'Data': [address, address]}) for address in range(0, 3)])
+
+    def test_requests_in_flight_are_limited_per_host(self):
+        engine = self.engine(max_in_flight_per_host=2)
+        for address in range(0, 3):
+            self.submit(engine, read("plc", address))
+
+        client = self.connect(0)
+        self.assertEqual([address for address, _ in client.pending], [0, 1])
+        client.answer([0, 0])
+        self.assertEqual([address for address, _ in client.pending], [1, 2])
+
+    def test_timed_out_requests_drop_the_connection(self):
+        engine = self.engine(timeout=5)
+        self.submit(engine, read("plc", 0))
+        self.submit(engine, read("plc", 1))
+        client = self.connect(0)
+
+        self.reactor.advance(5)
+        self.assertEqual(self.results, [("plc", 0, {'error': "Modbus IO Exception: No response " \
+            "received within 5 seconds", 'exception': 'ModbusIOException'})])
+        self.assertTrue(client.transport.disconnecting)
+
+        #The next request is sent on a new connection, and the late response is discarded
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        client.answer([7, 7])
+        client.connectionLost()
+        reconnected = self.connect(1)
+        reconnected.answer([1, 1])
+        self.assertEqual(self.results[1:], [("plc", 1, {'Data': [1, 1]})])
+
+    def test_failed_connections_fail_the_queued_requests(self):
+        engine = self.engine()
+        self.submit(engine, read("plc", 0))
+        self.submit(engine, read("plc", 1))
+
+        factory = self.reactor.tcpClients[0][2]
+        factory.clientConnectionFailed(self.reactor.connectors[0], \
+            Failure(error.ConnectionRefusedError()))
+        self.reactor.advance(0)
+        self.assertEqual([address for _, address, _ in self.results], [0, 1])
+        for _, _, result in self.results:
+            self.assertEqual(result['exception'], 'ConnectionException')
+
+        #The next request tries to connect again
+        self.submit(engine, read("plc", 2))
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+
+    def test_drain_waits_for_outstanding_requests(self):
+        engine = self.engine()
+        self.submit(engine, read("plc", 0))
+        self.submit(engine, read("plc", 1))
+        client = self.connect(0)
+
+        self.assertEqual(engine.queue_depth(), 2)
+        self.assertFalse(engine.drain(0))
+        client.answer([0, 0])
+        self.assertEqual(engine.queue_depth(), 1)
+        client.answer([1, 1])
+        self.assertEqual(engine.queue_depth(), 0)
+        self.assertTrue(engine.drain(0))
+
+        engine.stop()
+        self.assertTrue(client.transport.disconnecting)
+        self.assertTrue(self.reactor.hasStopped)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Tests for the metrics exposed by the adapters"""
+import unittest
+
+from metrics import MetricsRegistry
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("requests_total", "Requests received", ('host',))
+        counter.increment(('plc',))
+        counter.increment(('plc',), 2)
+        counter.increment(('a "quoted" \\ host',))
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP requests_total Requests received",
+            "# TYPE requests_total counter",
+            'requests_total{host="a \\"quoted\\" \\\\ host"} 1',
+            'requests_total{host="plc"} 3']) + "\n")
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("queue_depth", "Queued requests")
+        gauge.increment(amount=5)
+        gauge.set(2)
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP queue_depth Queued requests",
+            "# TYPE queue_depth gauge",
+            "queue_depth 2"]) + "\n")
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", "Request latency", ('host',), \
+            buckets=(0.25, 1.0))
+        for value in (0.25, 0.5, 4.0):
+            histogram.observe(value, ('plc',))
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP latency_seconds Request latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{host="plc",le="0.25"} 1',
+            'latency_seconds_bucket{host="plc",le="1.0"} 2',
+            'latency_seconds_bucket{host="plc",le="+Inf"} 3',
+            'latency_seconds_sum{host="plc"} 4.75',
+            'latency_seconds_count{host="plc"} 3']) + "\n")
+
+    def test_observe_counts_each_value_in_its_own_bucket(self):
+        histogram = self.registry.histogram("latency_seconds", "Request latency", \
+            buckets=(0.1, 1.0, 10.0))
+        for value in (0.05, 0.1, 0.5, 20.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.snapshot(), [{'labels': {}, 'count': 4, 'sum': 20.65, \
+            'buckets': {'0.1': 2, '1.0': 1, '10.0': 0}}])
+
+    def test_metrics_are_registered_once(self):
+        counter = self.registry.counter("requests_total", "Requests received", ('host',))
+        self.assertIs(self.registry.counter("requests_total", "Requests received", ('host',)), \
+            counter)
+
+    def test_snapshot(self):
+        self.registry.counter("requests_total", "Requests received", ('host', 'unit')).increment( \
+            ('plc', 1))
+        self.registry.gauge("queue_depth", "Queued requests")
+
+        self.assertEqual(self.registry.snapshot(), {
+            'requests_total': [{'labels': {'host': 'plc', 'unit': 1}, 'value': 1}],
+            'queue_depth': []})
+
+    def test_collectors_run_before_rendering(self):
+        gauge = self.registry.gauge("queue_depth", "Queued requests")
+        depth = [3]
+
+        def fail():
+            raise ValueError("queue is gone")
+
+        self.registry.on_collect(fail)
+        self.registry.on_collect(lambda: gauge.set(depth[0]))
+        self.assertIn("queue_depth 3\n", self.registry.render())
+
+        depth[0] = 1
+        self.assertEqual(self.registry.snapshot()['queue_depth'], [{'labels': {}, 'value': 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+"""Tests for the store-and-forward of client adapter messages"""
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import outbox
+from outbox import Outbox, RingBuffer
+
+#The size of a record holding a topic of one character and a payload of size bytes
+def record_size(size):
+    return 4 + 3 + 1 + size
+
+class RecordingClient(object):
+    """Records the messages published through it. The first publish blocks until released is set,
+    when block_first is True."""
+
+    def __init__(self, block_first=False):
+        self.messages = []
+        self.blocked = threading.Event()
+        self.released = threading.Event()
+        if not block_first:
+            self.released.set()
+        self._lock = threading.Lock()
+
+    def publish(self, topic, message):
+        with self._lock:
+            first = not self.messages and not self.blocked.is_set()
+            if first:
+                self.blocked.set()
+        if first:
+            self.released.wait(5)
+        with self._lock:
+            self.messages.append(message)
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+class RingBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "outbox")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fifo_with_text_and_bytes(self):
+        buffer = RingBuffer(self.path, 1024)
+        buffer.append(u"a/b", u"caf\u00e9")
+        buffer.append(u"c", b"\x00\xff")
+
+        self.assertEqual(buffer.peek(5), [(u"a/b", u"caf\u00e9"), (u"c", b"\x00\xff")])
+        buffer.remove(1)
+        self.assertEqual(buffer.peek(5), [(u"c", b"\x00\xff")])
+        buffer.close()
+
+    def test_full_buffer_drops_oldest(self):
+        buffer = RingBuffer(self.path, record_size(10) * 3)
+        for ndx in range(0, 3):
+            self.assertEqual(buffer.append(u"t", b"%010d" % ndx), 0)
+
+        self.assertEqual(buffer.append(u"t", b"%010d" % 3), 1)
+        self.assertEqual([payload for _, payload in buffer.peek(5)], \
+            [b"%010d" % ndx for ndx in range(1, 4)])
+        buffer.close()
+
+    def test_records_wrap_around_the_end(self):
+        #Room for two and a half records, so the third starts again at the beginning
+        buffer = RingBuffer(self.path, record_size(10) * 5 // 2)
+        buffer.append(u"t", b"0" * 10)
+        buffer.append(u"t", b"1" * 10)
+        buffer.remove(1)
+
+        self.assertEqual(buffer.append(u"t", b"2" * 10), 0)
+        self.assertEqual(buffer.tail, record_size(10))
+        self.assertEqual([payload for _, payload in buffer.peek(5)], [b"1" * 10, b"2" * 10])
+
+        #Dropping the record before the wrap marker leaves the wrapped one
+        self.assertEqual(buffer.append(u"t", b"3" * 10), 1)
+        self.assertEqual([payload for _, payload in buffer.peek(5)], [b"2" * 10, b"3" * 10])
+        buffer.close()
+
+    def test_oversize_message_is_discarded(self):
+        buffer = RingBuffer(self.path, 32)
+        buffer.append(u"t", b"kept")
+        self.assertEqual(buffer.append(u"t", b"x" * 64), 1)
+        self.assertEqual(buffer.peek(5), [(u"t", b"kept")])
+        buffer.close()
+
+    def test_messages_survive_reopening(self):
+        buffer = RingBuffer(self.path, 256)
+        buffer.append(u"t", u"one")
+        buffer.append(u"t", u"two")
+        buffer.remove(1)
+        buffer.close()
+
+        buffer = RingBuffer(self.path, 256)
+        self.assertEqual(buffer.peek(5), [(u"t", u"two")])
+        buffer.close()
+
+        #A different capacity discards the messages
+        buffer = RingBuffer(self.path, 512)
+        self.assertEqual(buffer.count, 0)
+        buffer.close()
+
+    def test_matches_a_list_under_random_use(self):
+        rng = random.Random(7)
+        buffer = RingBuffer(self.path, 500)
+        expected = []
+        for step in range(0, 5000):
+            choice = rng.random()
+            if choice < 0.6:
+                message = (u"t/%d" % step, b"x" * rng.randint(0, 60))
+                dropped = buffer.append(*message)
+                expected.append(message)
+                del expected[0:dropped]
+            elif choice < 0.9:
+                count = rng.randint(0, 5)
+                self.assertEqual(buffer.peek(count), expected[0:count])
+                buffer.remove(count)
+                del expected[0:count]
+            else:
+                buffer.close()
+                buffer = RingBuffer(self.path, 500)
+            self.assertEqual(buffer.count, len(expected))
+        buffer.close()
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(RingBuffer(os.path.join(self.directory, "outbox"), 1 << 16), \
+            batch_size=2, batch_interval=0.01)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+
+    def test_buffered_messages_are_replayed_before_new_ones(self):
+        client = RecordingClient()
+        for ndx in range(0, 10):
+            self.outbox.publish(client, u"t", u"%d" % ndx)
+        self.assertEqual(client.messages, [])
+
+        self.outbox.connected(client)
+        for ndx in range(10, 20):
+            self.outbox.publish(client, u"t", u"%d" % ndx)
+
+        self.assertTrue(wait_for(lambda: len(client.messages) == 20))
+        self.assertEqual(client.messages, [u"%d" % ndx for ndx in range(0, 20)])
+
+        self.outbox.disconnected()
+        self.outbox.publish(client, u"t", u"20")
+        self.assertEqual(self.outbox.buffer.count, 1)
+
+    def test_reconnect_during_replay_loses_nothing(self):
+        for ndx in range(0, 10):
+            self.outbox.publish(None, u"t", u"%d" % ndx)
+
+        #The first replay is stuck publishing its first batch when the connection flaps
+        first = RecordingClient(block_first=True)
+        self.outbox.connected(first)
+        self.assertTrue(first.blocked.wait(5))
+        self.outbox.disconnected()
+
+        second = RecordingClient()
+        self.outbox.connected(second)
+        self.assertTrue(wait_for(lambda: len(second.messages) >= 4))
+        first.released.set()
+
+        self.assertTrue(wait_for(lambda: self.outbox.buffer.count == 0))
+        self.assertEqual(second.messages, [u"%d" % ndx for ndx in range(0, 10)])
+        #The superseded replay finishes its batch, which is published twice rather than lost
+        self.assertTrue(wait_for(lambda: len(first.messages) == 2))
+        self.assertEqual(first.messages, [u"0", u"1"])
+
+if __name__ == '__main__':
+    unittest.main()
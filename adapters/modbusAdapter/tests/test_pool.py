@@ -0,0 +1,100 @@
+"""Tests for the pool of Modbus TCP client connections"""
+import socket
+import unittest
+
+from pool import ModbusClientPool
+
+class FakeClient(object):
+    """A Modbus client stand-in that only opens the TCP connection
+
+    :param listener: The listening socket the client connects to, None to fail connecting
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.socket = None
+        self.peer = None
+
+    def connect(self):
+        if self.listener is None:
+            raise socket.error("Connection refused")
+        self.socket = socket.create_connection(self.listener.getsockname())
+        self.peer, _ = self.listener.accept()
+        return True
+
+    def close(self):
+        for sock in (self.socket, self.peer):
+            if sock is not None:
+                sock.close()
+        self.socket = None
+        self.peer = None
+
+class ModbusClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.failing = []
+
+    def tearDown(self):
+        self.listener.close()
+
+    def factory(self, host, port):
+        if self.failing:
+            failure = self.failing.pop(0)
+            if failure == 'factory':
+                raise ValueError("Unable to create client")
+            return FakeClient(None)
+        return FakeClient(self.listener)
+
+    def test_connections_are_reused(self):
+        pool = ModbusClientPool(client_factory=self.factory)
+        conn = pool.acquire("127.0.0.1", 502)
+        self.assertFalse(conn.reused)
+        pool.release(conn)
+
+        again = pool.acquire("127.0.0.1", 502)
+        self.assertIs(again, conn)
+        self.assertTrue(again.reused)
+        pool.release(again)
+        pool.close_all()
+
+    def test_failed_connects_do_not_use_up_the_host_limit(self):
+        pool = ModbusClientPool(max_per_host=1, client_factory=self.factory)
+        self.failing = ['factory', 'connect']
+        with self.assertRaises(ValueError):
+            pool.acquire("127.0.0.1", 502, timeout=0.1)
+        with self.assertRaises(socket.error):
+            pool.acquire("127.0.0.1", 502, timeout=0.1)
+
+        conn = pool.acquire("127.0.0.1", 502, timeout=0.1)
+        self.assertIsNotNone(conn)
+        pool.release(conn)
+        pool.close_all()
+
+    def test_connections_closed_by_the_device_are_reopened(self):
+        pool = ModbusClientPool(client_factory=self.factory)
+        conn = pool.acquire("127.0.0.1", 502)
+        pool.release(conn)
+        conn.client.peer.close()
+
+        again = pool.acquire("127.0.0.1", 502)
+        self.assertFalse(again.reused)
+        self.assertIsNotNone(again.client.socket)
+        pool.release(again)
+        pool.close_all()
+
+    def test_connections_holding_late_responses_are_not_reused(self):
+        pool = ModbusClientPool(client_factory=self.factory)
+        conn = pool.acquire("127.0.0.1", 502)
+        conn.client.peer.sendall(b"\x00\x01\x00\x00\x00\x03\x01\x83\x02")
+        pool.release(conn)
+
+        again = pool.acquire("127.0.0.1", 502)
+        self.assertFalse(again.reused)
+        pool.release(again)
+        pool.close_all()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""Tests for the scan list scheduler"""
+import threading
+import time
+import unittest
+
+from scheduler import Scan, ScanScheduler
+
+ENTRY = {'ModbusHost': "plc", 'FunctionCode': 3, 'UnitID': 1, 'StartAddress': 10, \
+    'AddressCount': 3, 'Interval': 0.05, 'Deadband': 2, 'Deadbands': {'11': 0}}
+
+class Polls(object):
+    """Records the polls submitted by a scheduler and the results it reports"""
+
+    def __init__(self, respond=None):
+        self.respond = respond
+        self.submitted = []
+        self.changes = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, request, on_result):
+        with self.lock:
+            self.submitted.append(on_result)
+        if self.respond is not None:
+            self.respond(len(self.submitted), on_result)
+
+    def on_changes(self, request, changes):
+        with self.lock:
+            self.changes.append(changes)
+
+    def on_error(self, request, error):
+        with self.lock:
+            self.errors.append(error)
+
+    def scheduler(self, poll_timeout=30.0):
+        return ScanScheduler([ENTRY], self.submit, self.on_changes, self.on_error, \
+            poll_timeout=poll_timeout)
+
+class ScanTest(unittest.TestCase):
+
+    def test_only_changes_outside_the_deadband_are_published(self):
+        scan = Scan(ENTRY)
+        self.assertEqual(scan.changes([100, 5, 7]), {10: 100, 11: 5, 12: 7})
+        self.assertEqual(scan.changes([102, 6, 10]), {11: 6, 12: 10})
+        self.assertEqual(scan.changes([103, 6, 10]), {10: 103})
+        self.assertEqual(scan.request(), {'ModbusHost': "plc", 'FunctionCode': 3, 'UnitID': 1, \
+            'StartAddress': 10, 'AddressCount': 3})
+
+class ScanSchedulerTest(unittest.TestCase):
+
+    def test_changes_are_published(self):
+        polls = Polls(lambda count, on_result: on_result({'Data': [count // 3, 0, 0]}))
+        scheduler = polls.scheduler()
+        scheduler.start()
+        time.sleep(0.7)
+        scheduler.stop()
+        self.assertEqual(polls.changes[0], {10: 0, 11: 0, 12: 0})
+        self.assertEqual(polls.changes[1], {10: 3})
+        self.assertEqual(polls.errors, [])
+
+    def test_polls_in_flight_are_not_repeated(self):
+        polls = Polls()
+        scheduler = polls.scheduler()
+        scheduler.start()
+        time.sleep(0.3)
+        self.assertEqual(len(polls.submitted), 1)
+
+        polls.submitted[0]({'Data': [1, 2, 3]})
+        time.sleep(0.2)
+        scheduler.stop()
+        self.assertGreater(len(polls.submitted), 1)
+
+    def test_failing_submits_do_not_stop_polling(self):
+        def respond(count, on_result):
+            if count < 4:
+                raise IOError("Modbus request queue is full")
+            on_result({'Data': [1, 2, 3]})
+
+        polls = Polls(respond)
+        scheduler = polls.scheduler()
+        scheduler.start()
+        time.sleep(0.5)
+        scheduler.stop()
+        self.assertEqual(polls.errors, ["Unable to submit Modbus scan: Modbus request queue is full"])
+        self.assertEqual(polls.changes, [{10: 1, 11: 2, 12: 3}])
+        self.assertGreater(len(polls.submitted), 4)
+
+    def test_polls_that_never_complete_are_abandoned(self):
+        polls = Polls()
+        scheduler = polls.scheduler(poll_timeout=0.2)
+        scheduler.start()
+        time.sleep(0.35)
+        self.assertEqual(len(polls.submitted), 2)
+        self.assertEqual(polls.errors, \
+            ["No response received for Modbus scan within 0.2 seconds."])
+
+        #The abandoned poll's late response is ignored
+        polls.submitted[0]({'Data': [1, 2, 3]})
+        polls.submitted[1]({'Data': [4, 5, 6]})
+        scheduler.stop()
+        self.assertEqual(polls.changes, [{10: 4, 11: 5, 12: 6}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""Tests for the MQTT callbacks of the Modbus server adapter"""
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import cbData
+from context import ClearBladeModbusServerContext
+from fakes import FakePlatform, platform_with_units
+from snapshot import RegisterSnapshot
+
+#The adapter script's name is not a valid module name
+adapter = importlib.import_module("modbus-server-adapter")
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+COLLECTION = cbData.MODBUS_DATA_COLLECTIONS[TABLE]
+
+class FakeMessage(object):
+    """An MQTT message received on the server changes topic"""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+def notifications():
+    return dict([(entry['labels']['kind'], entry['value']) \
+        for entry in adapter.CHANGE_NOTIFICATIONS.snapshot()])
+
+class FakeMqttClient(object):
+    """Records the topics subscribed to"""
+
+    def __init__(self):
+        self.topics = []
+
+    def subscribe(self, topic):
+        self.topics.append(topic)
+
+    def message_callback_add(self, topic, callback):
+        pass
+
+class ReconnectTest(unittest.TestCase):
+    """Reloading the register image when change notifications may have been missed"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = RegisterSnapshot(os.path.join(self.directory, "snapshot"), slots=4, \
+            addresses=100)
+        self.snapshot.put(1, TABLE, [(2, 7), (3, 8)])
+
+        self.platform = FakePlatform()
+        self.platform.populate(1, 20)
+        adapter.CB_CONFIG = {'changeNotifications': True, 'adapterTopicRoot': "modbus"}
+        adapter.SERVER_CONTEXT = ClearBladeModbusServerContext(cbsystem=self.platform, \
+            cbauth=None, cache_ttl=60, snapshot=self.snapshot)
+        adapter.RECONNECTING.clear()
+
+    def tearDown(self):
+        adapter.RECONNECTING.clear()
+        adapter.SERVER_CONTEXT = None
+        self.snapshot.close()
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        return adapter.SERVER_CONTEXT[1].getValues(3, 1, 2)
+
+    def test_first_connect_keeps_the_snapshot(self):
+        client = FakeMqttClient()
+        adapter.on_connect(client, None, None, 0)
+        calls = self.platform.calls
+
+        self.assertEqual(self.read(), [7, 8])
+        self.assertEqual(self.platform.calls, calls)
+        self.assertEqual(client.topics, [adapter.changes_topic()])
+
+    def test_reconnect_reloads_the_register_image(self):
+        adapter.on_connect(FakeMqttClient(), None, None, 0)
+        adapter.on_disconnect(FakeMqttClient(), None, 1)
+        adapter.on_connect(FakeMqttClient(), None, None, 0)
+
+        self.assertEqual(self.read(), [0, 0])
+        self.assertEqual(self.snapshot.load()[0][2], {2: 0, 3: 0})
+
+class ChangeNotificationTest(unittest.TestCase):
+    """Applying the changes announced on the server changes topic"""
+
+    def setUp(self):
+        self.platform = platform_with_units()
+        adapter.SERVER_CONTEXT = ClearBladeModbusServerContext(cbsystem=self.platform, \
+            cbauth=None, cache_ttl=60, zero_mode=True)
+        self.before = notifications()
+
+    def tearDown(self):
+        adapter.SERVER_CONTEXT = None
+
+    def notify(self, payload):
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        adapter.handle_change_notification(None, None, FakeMessage(payload))
+
+    def counted(self, kind):
+        return notifications().get(kind, 0) - self.before.get(kind, 0)
+
+    def test_data_updates_the_register_image(self):
+        self.notify({'Collection': COLLECTION, 'UnitID': 1, 'Address': 30, 'Data': [5, 6]})
+
+        self.assertEqual(adapter.SERVER_CONTEXT.image.get(1, TABLE, 30, 2), [5, 6])
+        self.assertTrue(adapter.SERVER_CONTEXT.index.validate(1, TABLE, 30, 2))
+        self.assertEqual(self.counted('updated'), 1)
+
+    def test_count_invalidates_the_register_image(self):
+        adapter.SERVER_CONTEXT[1].getValues(3, 0, 4)
+        self.notify([{'Collection': COLLECTION, 'UnitID': 1, 'Address': 1, 'Count': 2}])
+
+        self.assertEqual(adapter.SERVER_CONTEXT.image.get(1, TABLE, 0), [0])
+        self.assertIsNone(adapter.SERVER_CONTEXT.image.get(1, TABLE, 1))
+        self.assertIsNone(adapter.SERVER_CONTEXT.image.get(1, TABLE, 2))
+        self.assertEqual(adapter.SERVER_CONTEXT.image.get(1, TABLE, 3), [0])
+        self.assertEqual(self.counted('invalidated'), 1)
+
+    def test_removed_evicts_a_unit_without_addresses(self):
+        adapter.SERVER_CONTEXT[2].getValues(3, 5)
+        self.notify({'Collection': COLLECTION, 'UnitID': 2, 'Address': 5, 'Removed': True})
+
+        self.assertNotIn(2, adapter.SERVER_CONTEXT)
+        self.assertIsNone(adapter.SERVER_CONTEXT.image.get(2, TABLE, 5, stale=True))
+        self.assertEqual(self.counted('removed'), 1)
+
+    def test_invalid_json_is_discarded(self):
+        self.notify("{'Collection': ")
+        self.assertEqual(self.counted('invalid'), 1)
+
+    def test_changes_that_are_not_objects_are_discarded(self):
+        self.notify([5, "changes", {'Collection': COLLECTION, 'UnitID': 1, 'Address': 30, \
+            'Data': [5]}])
+
+        self.assertEqual(self.counted('invalid'), 2)
+        self.assertEqual(self.counted('updated'), 1)
+        self.assertEqual(adapter.SERVER_CONTEXT.image.get(1, TABLE, 30), [5])
+
+    def test_incomplete_changes_are_discarded(self):
+        self.notify([{'Collection': "unknown", 'UnitID': 1, 'Address': 1}, \
+            {'Collection': COLLECTION, 'Address': 1}, \
+            {'Collection': COLLECTION, 'UnitID': 1, 'Address': "x"}])
+        self.assertEqual(self.counted('invalid'), 3)
+
+if __name__ == '__main__':
+    unittest.main()
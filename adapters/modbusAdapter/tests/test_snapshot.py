@@ -0,0 +1,78 @@
+"""Tests for the memory-mapped snapshot of the register image"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from snapshot import RegisterSnapshot
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+
+def stored(snapshot):
+    return sorted([(slave, table, sorted(values.items())) \
+        for slave, table, values in snapshot.load()])
+
+class RegisterSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_values_survive_reopening(self):
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        snapshot.put(1, TABLE, [(0, 10), (99, 65535)])
+        snapshot.put(2, 'COILS_COLLECTION', [(3, True)])
+        snapshot.close()
+
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        self.assertEqual(stored(snapshot), [(1, TABLE, [(0, 10), (99, 65535)]), \
+            (2, 'COILS_COLLECTION', [(3, 1)])])
+        snapshot.close()
+
+    def test_values_that_do_not_fit_are_not_stored(self):
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        snapshot.put(1, TABLE, [(100, 1), (-1, 1), (5, 70000), (6, "x"), (7, -2), (8, 8)])
+        snapshot.put(1, TABLE, [(8, 70000)])
+        self.assertEqual(stored(snapshot), [])
+        snapshot.close()
+
+    def test_clear(self):
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        snapshot.put(1, TABLE, [(addr, addr) for addr in range(0, 10)])
+        snapshot.put(1, 'COILS_COLLECTION', [(0, 1)])
+        snapshot.put(2, TABLE, [(0, 1)])
+
+        snapshot.clear(1, TABLE, 2, 6)
+        self.assertEqual(stored(snapshot)[1], (1, TABLE, [(0, 0), (1, 1), (8, 8), (9, 9)]))
+
+        snapshot.clear(1, 'COILS_COLLECTION')
+        snapshot.clear(2)
+        self.assertEqual(stored(snapshot), [(1, TABLE, [(0, 0), (1, 1), (8, 8), (9, 9)])])
+        snapshot.close()
+
+    def test_units_beyond_the_slots_are_not_stored(self):
+        snapshot = RegisterSnapshot(self.path, slots=2, addresses=10)
+        for slave in range(1, 4):
+            snapshot.put(slave, TABLE, [(0, slave)])
+        self.assertEqual([slave for slave, _, _ in stored(snapshot)], [1, 2])
+
+        #Clearing a unit frees its slot for another
+        snapshot.clear(1)
+        snapshot.put(3, TABLE, [(0, 3)])
+        self.assertEqual([slave for slave, _, _ in stored(snapshot)], [2, 3])
+        snapshot.close()
+
+    def test_a_different_layout_is_discarded(self):
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        snapshot.put(1, TABLE, [(0, 1)])
+        snapshot.close()
+
+        snapshot = RegisterSnapshot(self.path, slots=8, addresses=100)
+        self.assertEqual(snapshot.load(), [])
+        snapshot.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""Tests for the datastore serving Modbus requests from the data collections"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import cbData
+import requests
+from clearblade import cbErrors, restcall
+from context import ClearBladeModbusServerContext
+from fakes import FakeAuth, FakePlatform, unreachable_system
+from snapshot import RegisterSnapshot
+from store import CbModbusDatastore, RegisterImage
+
+from pymodbus.register_read_message import ReadHoldingRegistersRequest, \
+    ReadWriteMultipleRegistersRequest
+from pymodbus.register_write_message import MaskWriteRegisterRequest, \
+    WriteMultipleRegistersRequest
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+
+def execute(context, request, unit=1):
+    request.unit_id = unit
+    return request.execute(context[unit])
+
+class RegisterImageTest(unittest.TestCase):
+
+    def test_values_expire(self):
+        image = RegisterImage(ttl=0.05)
+        image.put(1, TABLE, 0, [1, 2])
+        self.assertEqual(image.get(1, TABLE, 0, 2), [1, 2])
+        self.assertIsNone(image.get(1, TABLE, 0, 3))
+
+        time.sleep(0.1)
+        self.assertIsNone(image.get(1, TABLE, 0, 2))
+        self.assertEqual(image.get(1, TABLE, 0, 2, stale=True), [1, 2])
+
+    def test_invalidate(self):
+        image = RegisterImage()
+        image.put(1, TABLE, 0, [1, 2, 3])
+        image.put(2, TABLE, 0, [4])
+
+        image.invalidate(1, TABLE, 1)
+        self.assertEqual(image.get(1, TABLE, 0), [1])
+        self.assertIsNone(image.get(1, TABLE, 1))
+        image.invalidate(2)
+        self.assertIsNone(image.get(2, TABLE, 0))
+
+    def test_expire(self):
+        image = RegisterImage()
+        image.put(1, TABLE, 0, [1, 2])
+        image.put(2, TABLE, 0, [3])
+
+        image.expire(1)
+        self.assertIsNone(image.get(1, TABLE, 0, 2))
+        self.assertEqual(image.get(1, TABLE, 0, 2, stale=True), [1, 2])
+        self.assertEqual(image.get(2, TABLE, 0), [3])
+
+        #Values stored after expiring are fresh
+        image.put(1, TABLE, 0, [4])
+        self.assertEqual(image.get(1, TABLE, 0), [4])
+
+class RegisterFunctionsTest(unittest.TestCase):
+    """Serving the mask write and read/write multiple registers function codes"""
+
+    def setUp(self):
+        platform = FakePlatform()
+        platform.populate(1, 20)
+        self.context = ClearBladeModbusServerContext(cbsystem=platform, cbauth=None)
+
+    def test_read_write_multiple_registers(self):
+        response = execute(self.context, ReadWriteMultipleRegistersRequest(read_address=0, \
+            read_count=5, write_address=2, write_registers=[7, 8]))
+        self.assertEqual(response.registers, [0, 0, 7, 8, 0])
+
+    def test_mask_write_register(self):
+        execute(self.context, WriteMultipleRegistersRequest(4, [0x0F0F]))
+        response = execute(self.context, MaskWriteRegisterRequest(4, 0x00FF, 0x1000))
+        self.assertEqual((response.and_mask, response.or_mask), (0x00FF, 0x1000))
+
+        response = execute(self.context, ReadHoldingRegistersRequest(4, 1))
+        self.assertEqual(response.registers, [0x100F])
+
+class ValidatedRowsTest(unittest.TestCase):
+    """Reusing the rows read by validate for the getValues of the same request"""
+
+    def setUp(self):
+        self.platform = FakePlatform()
+        self.platform.populate(2, 20)
+        self.store = CbModbusDatastore(self.platform, None)
+
+    def calls(self, *operations):
+        before = self.platform.calls
+        for operation, args in operations:
+            getattr(self.store, operation)(*args)
+        return self.platform.calls - before
+
+    def test_get_values_reuses_the_validated_rows(self):
+        self.assertEqual(self.calls(("validate", (1, 3, 2, 3)), ("getValues", (1, 3, 2, 3))), 1)
+
+    def test_rows_of_a_different_range_are_not_reused(self):
+        for other in ((2, 3, 2, 3), (1, 3, 3, 3), (1, 3, 2, 2), (1, 4, 2, 3)):
+            self.assertEqual(self.calls(("validate", (1, 3, 2, 3)), ("getValues", other)), 2)
+
+    def test_rows_are_only_reused_once(self):
+        self.assertEqual(self.calls(("validate", (1, 3, 2, 3)), ("getValues", (1, 3, 2, 3)), \
+            ("getValues", (1, 3, 2, 3))), 2)
+
+    def test_rows_are_not_reused_after_a_write(self):
+        self.assertEqual(self.calls(("validate", (1, 3, 2, 3)), ("setValues", (1, 16, 2, [5])), \
+            ("getValues", (1, 3, 2, 3))), 3)
+        self.assertEqual(self.store.getValues(1, 3, 2, 3), [5, 0, 0])
+
+class SnapshotFallbackTest(unittest.TestCase):
+    """Serving last known values while the platform cannot be reached"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot")
+        self.handler = cbErrors.ERROR_HANDLER
+        cbData.configure_platform_calls(0.5)
+
+        #Values written while the platform was available
+        platform = FakePlatform()
+        platform.populate(1, 20)
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        context = ClearBladeModbusServerContext(cbsystem=platform, cbauth=None, cache_ttl=60, \
+            snapshot=snapshot)
+        execute(context, WriteMultipleRegistersRequest(2, [7, 8, 9]))
+        snapshot.close()
+
+    def tearDown(self):
+        cbErrors.ERROR_HANDLER = self.handler
+        restcall.requests = requests
+        shutil.rmtree(self.directory)
+
+    def test_last_known_values_are_served(self):
+        snapshot = RegisterSnapshot(self.path, slots=4, addresses=100)
+        context = ClearBladeModbusServerContext(cbsystem=unreachable_system(), cbauth=FakeAuth(), \
+            cache_ttl=0.01, snapshot=snapshot)
+        time.sleep(0.05)
+
+        response = execute(context, ReadHoldingRegistersRequest(2, 3))
+        self.assertEqual(response.registers, [7, 8, 9])
+
+        #Values the snapshot never held are still a failure
+        with self.assertRaises(cbData.PlatformError):
+            context[1].getValues(3, 10, 1)
+        snapshot.close()
+
+    def test_without_snapshot_the_failure_is_raised(self):
+        context = ClearBladeModbusServerContext(cbsystem=unreachable_system(), cbauth=FakeAuth(), \
+            cache_ttl=60)
+        with self.assertRaises(cbData.PlatformError):
+            context[1].getValues(3, 2, 3)
+
+if __name__ == '__main__':
+    unittest.main()
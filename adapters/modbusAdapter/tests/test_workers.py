@@ -0,0 +1,141 @@
+"""Tests for the worker processes of the server adapter and the write relay between them"""
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+
+import workers
+from workers import WorkerSupervisor, WriteRelay, _Worker
+
+#Runs a supervisor whose workers record the writes relayed to them. The first life of the worker
+#in slot 0 publishes a write and exits, so it is restarted and publishes again.
+SUPERVISOR = textwrap.dedent("""
+    import os, sys, time
+    from workers import WorkerSupervisor
+
+    directory = sys.argv[1]
+
+    def start_worker(sock, relay, slot):
+        received = open(os.path.join(directory, "received-%d-%d" % (slot, os.getpid())), "a")
+
+        def on_write(*write):
+            received.write(repr(write) + "\\n")
+            received.flush()
+
+        relay.start(on_write)
+        if slot == 0:
+            marker = os.path.join(directory, "restarted")
+            time.sleep(0.5)
+            relay.publish(1, "OUTPUT_REGISTERS_COLLECTION", 5, [os.getpid(), 2])
+            if not os.path.exists(marker):
+                open(marker, "w").close()
+                return
+        while True:
+            time.sleep(1)
+
+    WorkerSupervisor(2, ("127.0.0.1", 0), start_worker, shutdown_timeout=5).run()
+""")
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+class WorkerFramingTest(unittest.TestCase):
+
+    def test_writes_split_across_reads_are_reassembled(self):
+        worker = _Worker(1, 0, None, None)
+        self.assertEqual(worker.received(b'[1, "T", 0'), [])
+        self.assertEqual(worker.received(b', [1]]\n[2, "T"'), [b'[1, "T", 0, [1]]\n'])
+        self.assertEqual(worker.received(b', 1, [2]]\n[3, "T", 2, [3]]\n'), \
+            [b'[2, "T", 1, [2]]\n', b'[3, "T", 2, [3]]\n'])
+        self.assertEqual(worker.partial, b"")
+
+    def test_relayed_writes_round_trip(self):
+        to_supervisor = os.pipe()
+        from_supervisor = os.pipe()
+        relay = WriteRelay(to_supervisor[1], from_supervisor[0])
+
+        received = []
+        done = threading.Event()
+
+        def on_write(*write):
+            received.append(write)
+            done.set()
+
+        relay.start(on_write)
+        relay.publish(3, "COILS_COLLECTION", 7, (True, False))
+        self.assertEqual(json.loads(os.read(to_supervisor[0], 4096).decode()), \
+            [3, "COILS_COLLECTION", 7, [True, False]])
+
+        os.write(from_supervisor[1], b'[2, "OUTPUT_REGISTERS_COLLECTION", 1, [65535]]\n')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(received, [(2, "OUTPUT_REGISTERS_COLLECTION", 1, [65535])])
+        os.close(from_supervisor[1])
+        os.close(to_supervisor[0])
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Workers are forked")
+class RestartBackoffTest(unittest.TestCase):
+
+    def restart_delay(self, supervisor, uptime):
+        worker = _Worker(os.getpid(), 0, None, None)
+        worker.started -= uptime
+        supervisor._schedule_restart(worker, 1)
+        return round(supervisor._restarts.pop(0) - time.time(), 1)
+
+    def test_workers_failing_to_start_are_restarted_with_backoff(self):
+        supervisor = WorkerSupervisor(1, ("127.0.0.1", 0), None, stable_uptime=30, \
+            max_restart_backoff=5)
+        delays = [self.restart_delay(supervisor, 0) for _ in range(0, 5)]
+        self.assertEqual(delays, [workers.RESTART_BACKOFF * 1, workers.RESTART_BACKOFF * 2, \
+            workers.RESTART_BACKOFF * 4, 5, 5])
+
+        #A worker that ran for stable_uptime is restarted at once and resets the backoff
+        self.assertEqual(self.restart_delay(supervisor, 30), 0)
+        self.assertEqual(self.restart_delay(supervisor, 0), workers.RESTART_BACKOFF)
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def received(self, slot):
+        writes = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith("received-%d-" % slot):
+                with open(os.path.join(self.directory, name)) as received:
+                    writes.extend(received.read().splitlines())
+        return writes
+
+    def test_writes_are_relayed_to_restarted_workers(self):
+        script = os.path.join(self.directory, "supervisor.py")
+        with open(script, "w") as source:
+            source.write(SUPERVISOR)
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([path for path in sys.path if path])
+        supervisor = subprocess.Popen([sys.executable, script, self.directory], env=env)
+        try:
+            self.assertTrue(wait_for(lambda: len(self.received(1)) == 2))
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            self.assertEqual(supervisor.wait(10), 0)
+
+        #Both lives of the worker in slot 0 published a write of its pid
+        self.assertEqual(len(set(self.received(1))), 2)
+        self.assertEqual(self.received(0), [])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "restarted")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Tests for the write-behind queue of server writes"""
+import time
+import unittest
+
+import cbData
+import requests
+import writebehind
+from benchmark_server import FakeCollection
+from clearblade import cbErrors, restcall
+from constants import ModbusErrorCodes
+from fakes import FakeAuth, FakePlatform, unreachable_system
+from writebehind import WriteBehindQueue
+
+TABLE = 'OUTPUT_REGISTERS_COLLECTION'
+COLLECTION = cbData.MODBUS_DATA_COLLECTIONS[TABLE]
+
+class FlakyCollection(FakeCollection):
+    """A collection whose updates fail while the platform has failures left"""
+
+    def updateItems(self, query, changes):
+        with self.platform.lock:
+            self.platform.update_times.append(time.time())
+            failing = self.platform.failures != 0
+            if failing:
+                self.platform.failures -= 1
+        if failing:
+            raise cbData.PlatformError("rejected")
+        FakeCollection.updateItems(self, query, changes)
+
+class FlakyPlatform(FakePlatform):
+    """A FakePlatform that rejects the first failures updates, or every update if failures is -1"""
+
+    def __init__(self, failures):
+        FakePlatform.__init__(self)
+        self.failures = failures
+        self.update_times = []
+        self.populate(1, 20)
+
+    def Collection(self, cbauth, collectionName=None):
+        return FlakyCollection(self, collectionName)
+
+    def value(self, address):
+        with self.lock:
+            return [row["data_value"] for row in self.rows[COLLECTION] \
+                if row["unit_id"] == 1 and row["data_address"] == address][0]
+
+def dropped():
+    return sum([entry['value'] for entry in writebehind.DROPPED_WRITES.snapshot() \
+        if entry['labels']['table'] == TABLE])
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class WriteBehindQueueTest(unittest.TestCase):
+
+    def test_repeated_writes_are_saved_once(self):
+        platform = FlakyPlatform(0)
+        queue = WriteBehindQueue(platform, None, interval=60)
+        queue.submit(1, TABLE, 2, [1, 2, 3])
+        queue.submit(1, TABLE, 3, [20])
+        queue.flush()
+
+        self.assertEqual([platform.value(address) for address in range(1, 6)], [0, 1, 20, 3, 0])
+        self.assertEqual(len(platform.update_times), 3)
+        queue.stop(5)
+
+    def test_unsaved_values_are_overlaid(self):
+        platform = FlakyPlatform(0)
+        queue = WriteBehindQueue(platform, None, interval=60)
+        queue.submit(1, TABLE, 2, [7])
+        rows = [{"data_address": 1, "data_value": 0}, {"data_address": 2, "data_value": 0}]
+        queue.overlay_rows(1, TABLE, rows)
+        self.assertEqual([row["data_value"] for row in rows], [0, 7])
+        queue.stop(5)
+        self.assertEqual(platform.value(2), 7)
+
+    def test_full_queue_rejects_writes(self):
+        queue = WriteBehindQueue(FlakyPlatform(0), None, interval=60, max_pending=2, \
+            block_timeout=0.05)
+        queue.submit(1, TABLE, 0, [1, 2])
+        #Rewriting pending addresses needs no room
+        queue.submit(1, TABLE, 1, [3])
+        with self.assertRaises(cbData.CbDataWriteException) as raised:
+            queue.submit(1, TABLE, 5, [1])
+        self.assertEqual(raised.exception.error_code, ModbusErrorCodes.SlaveDeviceBusy)
+        queue.stop(5)
+
+    def test_writes_larger_than_the_queue_are_accepted_when_it_is_empty(self):
+        platform = FlakyPlatform(0)
+        queue = WriteBehindQueue(platform, None, interval=60, max_pending=2, block_timeout=0.05)
+        queue.submit(1, TABLE, 0, [1, 2, 3, 4, 5])
+        queue.stop(5)
+        self.assertEqual([platform.value(address) for address in range(0, 5)], [1, 2, 3, 4, 5])
+
+    def test_failed_writes_are_retried_with_backoff(self):
+        platform = FlakyPlatform(3)
+        queue = WriteBehindQueue(platform, None, interval=0.05, max_retries=5, max_backoff=1)
+        queue.submit(1, TABLE, 4, [9])
+
+        self.assertTrue(wait_for(lambda: platform.value(4) == 9))
+        times = platform.update_times
+        self.assertEqual(len(times), 4)
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        self.assertGreaterEqual(gaps[0], 0.04)
+        self.assertGreaterEqual(gaps[2], 0.15)
+        queue.stop(5)
+
+    def test_values_are_dropped_after_max_retries(self):
+        before = dropped()
+        platform = FlakyPlatform(-1)
+        queue = WriteBehindQueue(platform, None, interval=0.01, max_retries=2, max_backoff=0.02)
+        queue.submit(1, TABLE, 4, [9, 10])
+
+        self.assertTrue(wait_for(lambda: dropped() - before == 2))
+        #Three attempts, each saving the two values with an update of their own
+        self.assertEqual(len(platform.update_times), 6)
+        rows = [{"data_address": 4, "data_value": 0}]
+        queue.overlay_rows(1, TABLE, rows)
+        self.assertEqual(rows[0]["data_value"], 0)
+
+        #The queue keeps saving later writes
+        platform.failures = 0
+        queue.submit(1, TABLE, 6, [11])
+        queue.stop(5)
+        self.assertEqual(platform.value(6), 11)
+
+    def test_newer_writes_reset_the_retry_count(self):
+        before = dropped()
+        platform = FlakyPlatform(2)
+        queue = WriteBehindQueue(platform, None, interval=60, max_retries=1)
+        queue.submit(1, TABLE, 4, [9])
+        queue.flush()
+        queue.submit(1, TABLE, 4, [10])
+        queue.flush()
+        queue.flush()
+        self.assertEqual(dropped(), before)
+        self.assertEqual(platform.value(4), 10)
+        queue.stop(5)
+
+class UnreachablePlatformTest(unittest.TestCase):
+    """Queued writes while the platform cannot be reached through the ClearBlade SDK"""
+
+    def setUp(self):
+        self.handler = cbErrors.ERROR_HANDLER
+        cbData.configure_platform_calls(0.5)
+
+    def tearDown(self):
+        cbErrors.ERROR_HANDLER = self.handler
+        restcall.requests = requests
+
+    def test_writes_stay_queued(self):
+        queue = WriteBehindQueue(unreachable_system(), FakeAuth(), interval=60)
+        queue.submit(1, TABLE, 4, [9])
+        queue.flush()
+
+        rows = [{"data_address": 4, "data_value": 0}]
+        queue.overlay_rows(1, TABLE, rows)
+        self.assertEqual(rows[0]["data_value"], 9)
+        self.assertTrue(queue._worker.is_alive())
+        queue.stop(5)
+        self.assertFalse(queue._worker.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()